@@ -20,6 +20,7 @@ from pyramid.view import view_config
 from cachetools import cached
 
 from . import models
+from .page_cache import start_warm_up
 
 
 basic_auth = {}
@@ -86,7 +87,23 @@ def main(global_config, **settings):
         config.include('pyramid_jinja2')
         config.include('.routes')
         config.include('.models')
+        config.include('.page_cache')
+        config.include('.http_cache')
+        config.include('.release_resolver')
         config.scan()
         config.add_tween("pyramidprj.tweens.request_middleware_tween_factory", under="pyramid_tm.tm_tween_factory")
         config.add_tween("pyramidprj.tweens.response_middleware_tween_factory", under="pyramidprj.tweens.request_middleware_tween_factory")
-    return config.make_wsgi_app()
+        config.add_tween(
+            "pyramidprj.tweens.page_cache_tween_factory",
+            under="pyramidprj.tweens.request_middleware_tween_factory",
+            over="pyramidprj.tweens.response_middleware_tween_factory",
+        )
+        config.add_tween(
+            "pyramidprj.tweens.conditional_response_tween_factory",
+            under="pyramidprj.tweens.request_middleware_tween_factory",
+            over="pyramidprj.tweens.page_cache_tween_factory",
+        )
+        app = config.make_wsgi_app()
+
+    start_warm_up(app, config.registry)
+    return app
@@ -0,0 +1,34 @@
+"""IndexRecord/ReleasePage: rewritten content
+
+Revision ID: 5f2a9c1e7d34
+Revises: bd8b43606410
+Create Date: 2026-10-18 10:12:31.418207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a9c1e7d34'
+down_revision = 'bd8b43606410'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('index_record', sa.Column('body_rewritten', sa.Text(), nullable=True))
+    op.add_column('index_record', sa.Column('custom_date_section_rewritten', sa.Text(), nullable=True))
+    op.add_column('index_record', sa.Column('rewrite_fingerprint', sa.Text(), nullable=True))
+    op.add_column('release_page', sa.Column('content_rewritten', sa.Text(), nullable=True))
+    op.add_column('release_page', sa.Column('custom_body_rewritten', sa.Text(), nullable=True))
+    op.add_column('release_page', sa.Column('custom_tracklist_rewritten', sa.Text(), nullable=True))
+    op.add_column('release_page', sa.Column('rewrite_fingerprint', sa.Text(), nullable=True))
+
+def downgrade():
+    op.drop_column('release_page', 'rewrite_fingerprint')
+    op.drop_column('release_page', 'custom_tracklist_rewritten')
+    op.drop_column('release_page', 'custom_body_rewritten')
+    op.drop_column('release_page', 'content_rewritten')
+    op.drop_column('index_record', 'rewrite_fingerprint')
+    op.drop_column('index_record', 'custom_date_section_rewritten')
+    op.drop_column('index_record', 'body_rewritten')
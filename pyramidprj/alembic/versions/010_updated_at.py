@@ -0,0 +1,29 @@
+"""IndexRecord/Release: updated_at
+
+Revision ID: 8c41d7e2b0a5
+Revises: 5f2a9c1e7d34
+Create Date: 2026-10-18 13:47:02.611394
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41d7e2b0a5'
+down_revision = '5f2a9c1e7d34'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('index_record', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('release', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    now = datetime.utcnow()
+    op.execute(sa.table('index_record', sa.column('updated_at')).update().values(updated_at=now))
+    op.execute(sa.table('release', sa.column('updated_at')).update().values(updated_at=now))
+
+def downgrade():
+    op.drop_column('release', 'updated_at')
+    op.drop_column('index_record', 'updated_at')
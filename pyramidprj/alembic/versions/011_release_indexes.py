@@ -0,0 +1,26 @@
+"""Release: indexes on release_dir, file, catalog_no
+
+Revision ID: 2e9b6f4d81c3
+Revises: 8c41d7e2b0a5
+Create Date: 2026-10-18 14:32:18.905127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e9b6f4d81c3'
+down_revision = '8c41d7e2b0a5'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_index(op.f('ix_release_release_dir'), 'release', ['release_dir'], unique=False)
+    op.create_index(op.f('ix_release_file'), 'release', ['file'], unique=False)
+    op.create_index(op.f('ix_release_catalog_no'), 'release', ['catalog_no'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_release_catalog_no'), table_name='release')
+    op.drop_index(op.f('ix_release_file'), table_name='release')
+    op.drop_index(op.f('ix_release_release_dir'), table_name='release')
@@ -0,0 +1,42 @@
+"""PublicReleasePage read model
+
+Revision ID: 71c0a4e95b2f
+Revises: 2e9b6f4d81c3
+Create Date: 2026-10-18 15:20:44.187530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '71c0a4e95b2f'
+down_revision = '2e9b6f4d81c3'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # The table is filled by `rewrite_pyramidprj_links`. Until then, rows are built on the first request.
+    op.create_table('public_release_page',
+    sa.Column('release_dir', sa.Text(), nullable=False),
+    sa.Column('release_id', sa.Integer(), nullable=True),
+    sa.Column('file', sa.Text(), nullable=True),
+    sa.Column('release_data', sa.JSON(), nullable=True),
+    sa.Column('release_data_rewritten', sa.JSON(), nullable=True),
+    sa.Column('content', sa.Text(), nullable=True),
+    sa.Column('content_rewritten', sa.Text(), nullable=True),
+    sa.Column('custom_body', sa.Text(), nullable=True),
+    sa.Column('custom_body_rewritten', sa.Text(), nullable=True),
+    sa.Column('custom_tracklist', sa.Text(), nullable=True),
+    sa.Column('custom_tracklist_rewritten', sa.Text(), nullable=True),
+    sa.Column('tracklist', sa.JSON(), nullable=True),
+    sa.Column('rewrite_fingerprint', sa.Text(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['release_id'], ['release.id'], name=op.f('fk_public_release_page_release_id_release')),
+    sa.PrimaryKeyConstraint('release_dir', name=op.f('pk_public_release_page'))
+    )
+    op.create_index(op.f('ix_public_release_page_release_id'), 'public_release_page', ['release_id'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_public_release_page_release_id'), table_name='public_release_page')
+    op.drop_table('public_release_page')
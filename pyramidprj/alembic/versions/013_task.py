@@ -0,0 +1,39 @@
+"""Task table for ReleaseService
+
+Revision ID: c6f18a3d2e47
+Revises: 71c0a4e95b2f
+Create Date: 2026-10-18 17:05:12.730981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f18a3d2e47'
+down_revision = '71c0a4e95b2f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('task',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('request_type', sa.Integer(), nullable=False),
+    sa.Column('file', sa.Text(), nullable=False),
+    sa.Column('state', sa.Text(), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=True),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.Column('exception', sa.Text(), nullable=True),
+    sa.Column('claim_token', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_task')),
+    sa.UniqueConstraint('request_type', 'file', name=op.f('uq_task_request_type'))
+    )
+    op.create_index(op.f('ix_task_state'), 'task', ['state'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_task_state'), table_name='task')
+    op.drop_table('task')
@@ -0,0 +1,22 @@
+"""Release: manifest
+
+Revision ID: 9d3e5b7a1f60
+Revises: c6f18a3d2e47
+Create Date: 2026-10-18 19:05:41.228390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3e5b7a1f60'
+down_revision = 'c6f18a3d2e47'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('release', sa.Column('manifest', sa.JSON(), nullable=True))
+
+def downgrade():
+    op.drop_column('release', 'manifest')
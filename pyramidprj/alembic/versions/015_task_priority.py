@@ -0,0 +1,28 @@
+"""Task: priority
+
+Revision ID: 3b7e2c9f5a14
+Revises: 9d3e5b7a1f60
+Create Date: 2026-10-18 21:12:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e2c9f5a14'
+down_revision = '9d3e5b7a1f60'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('task', sa.Column('priority', sa.Integer(), nullable=False, server_default='0'))
+    task = sa.table('task', sa.column('request_type', sa.Integer()), sa.column('priority', sa.Integer()))
+    # Priority classes of WARM_UP (3) and IA_UPLOAD (2) requests
+    op.execute(task.update().where(task.c.request_type == 3).values(priority=1))
+    op.execute(task.update().where(task.c.request_type == 2).values(priority=2))
+    op.create_index(op.f('ix_task_state_priority'), 'task', ['state', 'priority', 'id'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_task_state_priority'), table_name='task')
+    op.drop_column('task', 'priority')
@@ -0,0 +1,22 @@
+"""Task: cancel_requested
+
+Revision ID: 7f1a4d8c2e93
+Revises: 3b7e2c9f5a14
+Create Date: 2026-10-18 22:41:05.307715
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f1a4d8c2e93'
+down_revision = '3b7e2c9f5a14'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('task', sa.Column('cancel_requested', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+def downgrade():
+    op.drop_column('task', 'cancel_requested')
@@ -1,18 +1,36 @@
 """Client for automated submission of new releases to archive.org.
+
+A single client is shared by all workers (see `get_archive_org_client`). The credentials are read and the `ia`
+session is built once; the session's HTTP connections are pooled and reused across submissions.
+
+Files are uploaded one by one through IA-S3, `archive_org_upload_concurrency` files at a time (default 2). The
+first file of a new item is uploaded alone, because that upload creates the item. Throttling (`503 SlowDown`),
+server and network errors are retried with backoff, up to `upload_max_attempts` attempts per file. Files that
+already exist in the item with the same MD5, from an earlier attempt, are skipped. The item is derived once,
+after all files have been uploaded.
 """
 import glob
+import hashlib
 import json
+import os
+import threading
 import typing as t
+from concurrent.futures import ThreadPoolExecutor, wait
 from copy import copy
 
+from cachetools import cached
 from pyramid.threadlocal import get_current_registry
+import requests
+from requests.adapters import HTTPAdapter
 
 import internetarchive as ia
 import shortuuid
 
+from .retry import DEFAULT_MAX_ATTEMPTS, retry_call
+from .task_store import FAILED, QUEUED, RUNNING, SUCCEEDED
+
 if t.TYPE_CHECKING:
     from .models import Release
-    from requests import Response
 
 import logging
 
@@ -22,11 +40,47 @@ log = logging.getLogger(__name__)
 settings = get_current_registry().settings
 
 
+HTTP_POOL_SIZE = 16
+DEFAULT_UPLOAD_CONCURRENCY = 2
+
+
+class ArchiveOrgError(Exception):
+    pass
+
+
+def is_transient(ex: Exception) -> bool:
+    """Throttling (`503 SlowDown`), server errors and network failures are worth retrying."""
+    if isinstance(ex, requests.HTTPError) and ex.response is not None:
+        return ex.response.status_code == 429 or ex.response.status_code >= 500
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout, ConnectionError))
+
+
+def _md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Called with the state of all files of a submission whenever one of them changes
+ProgressCallback = t.Callable[[t.List[dict]], None]
+
+
 class ArchiveOrgClient:
-    def __init__(self):
+    """Thread-safe: the metadata template is copied per release, and the `ia` session (a `requests.Session`)
+    only shares its connection pools.
+    """
+    def __init__(
+        self,
+        upload_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        upload_max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
         with open(settings["archive_org_s3_credentials"], "r") as f:
             credentials = json.loads(f.read())
-        self.session = ia.get_session(credentials)
+        self.session = ia.get_session(credentials, http_adapter_kwargs={"pool_maxsize": HTTP_POOL_SIZE})
+        # Uploads go to s3.us.archive.org, which uses the default adapter
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
         self.md_template = {
             "mediatype": "audio",
             "collection": (
@@ -35,6 +89,9 @@ class ArchiveOrgClient:
             "subject": "lobit",
             "uploader": settings["archive_org_uploader"],
         }
+        self.executor = ThreadPoolExecutor(max_workers=upload_concurrency, thread_name_prefix="ArchiveOrgClient")
+        self.upload_max_attempts = upload_max_attempts
+        self.lock = threading.Lock()
         
     def release_metadata(self, r: "Release") -> dict:
         """Generate archive.org-specific metadata from 20kbps_pyramid `Release` row.
@@ -48,7 +105,14 @@ class ArchiveOrgClient:
         })
         return md
 
-    def upload_release(self, r: "Release", local_dir: str, use_uuid: bool = False):
+    def upload_release(
+        self,
+        r: "Release",
+        local_dir: str,
+        use_uuid: bool = False,
+        on_progress: t.Optional[ProgressCallback] = None,
+        check_cancelled: t.Optional[t.Callable[[], None]] = None,
+    ):
         """Submit release to archive.org.
 
         :param local_dir: Directory containing audio files and cover. When invoked from `ReleaseService`,
@@ -56,15 +120,88 @@ class ArchiveOrgClient:
 
         :param use_uuid: When `True`, the archive.org identifier is set to a UUID. This is for testing
             purposes and is always `False` in production in order to use the catalog number.
+
+        :param on_progress: Called with an entry per file, `{file, state, size, attempts[, error, unchanged]}`,
+            whenever a file's state changes.
+
+        :param check_cancelled: Called before every file. Raises to stop the submission; files that haven't
+            been uploaded stay `queued`, and the item isn't derived.
         """
-        files = glob.glob(f"{local_dir}/*")
+        files = sorted(glob.glob(f"{local_dir}/*"))
         md = self.release_metadata(r)
         identifier = (
             shortuuid.uuid() if use_uuid else t.cast(str, r.catalog_no)
         )
         log.info(f"upload_release | identifier='{identifier}'")
         item = self.session.get_item(identifier)
-        [res, *_] = t.cast(list["Response"], item.upload(files=files, metadata=md))
-        if res.status_code != 200:
-            raise Exception(f"archive.org upload failed (res.status_code={res.status_code})")
+        existing = {f["name"]: f.get("md5") for f in item.files}
+        uploads = [
+            {"file": os.path.basename(path), "state": QUEUED, "size": os.path.getsize(path), "attempts": 0}
+            for path in files
+        ]
+
+        def update(upload, **kwargs):
+            with self.lock:
+                upload.update(kwargs)
+                snapshot = [dict(u) for u in uploads]
+            if on_progress:
+                on_progress(snapshot)
+
+        def upload_file(path, upload):
+            if check_cancelled:
+                check_cancelled()
+            try:
+                # Only hash the files that are already in the item
+                if upload["file"] in existing and existing[upload["file"]] == _md5(path):
+                    log.info(f"upload_release.unchanged | identifier='{identifier}' | file='{upload['file']}'")
+                    update(upload, state=SUCCEEDED, unchanged=True)
+                    return False
+                retry_call(
+                    lambda: self._upload_file(item, path, upload["file"], md),
+                    is_transient,
+                    self.upload_max_attempts,
+                    lambda attempt: update(upload, state=RUNNING, attempts=attempt),
+                    description=f"{identifier}/{upload['file']}",
+                )
+            except Exception as ex:
+                update(upload, state=FAILED, error=str(ex))
+                raise
+            update(upload, state=SUCCEEDED)
+            return True
+
+        if on_progress:
+            on_progress([dict(u) for u in uploads])
+        pairs = list(zip(files, uploads))
+        uploaded = False
+        if pairs and not item.exists:
+            # The first upload creates the item
+            uploaded = upload_file(*pairs.pop(0))
+        futures = [self.executor.submit(upload_file, path, upload) for path, upload in pairs]
+        wait(futures)
+        if check_cancelled:
+            check_cancelled()
+        for future in futures:
+            # Raise the first error
+            uploaded = future.result() or uploaded
+
+        if uploaded:
+            res = item.derive()
+            if res.status_code != 200:
+                raise ArchiveOrgError(f"archive.org derive failed (res.status_code={res.status_code})")
         return identifier
+
+    def _upload_file(self, item, path: str, name: str, md: dict):
+        res = item.upload_file(path, key=name, metadata=md, queue_derive=False, verify=True)
+        if res.status_code != 200:
+            raise ArchiveOrgError(f"archive.org upload of {name} failed (res.status_code={res.status_code})")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+@cached(cache={}, key=lambda: "🕉", lock=threading.Lock())
+def get_archive_org_client():
+    return ArchiveOrgClient(
+        int(settings.get("archive_org_upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY)),
+        int(settings.get("upload_max_attempts", DEFAULT_MAX_ATTEMPTS)),
+    )
@@ -0,0 +1,333 @@
+"""Local cache of release zips and their extracted trees, shared by the `PREVIEW`, `UPLOAD` and `IA_UPLOAD` steps.
+
+Entries are content-addressed: they are keyed by the MD5 of the zip object in cloud storage (or its generation,
+for objects without MD5), as reported by `StorageClient.metadata`. An entry is laid out as
+
+    <tmp_directory>/artifacts/<zip stem>/<version>/<zip file>
+    <tmp_directory>/artifacts/<zip stem>/<version>/<zip stem>/    (extracted tree)
+
+An unchanged zip is downloaded and extracted only once, a changed zip is always downloaded again, and the
+entries of older versions are dropped. The tree's path ends with the zip's stem, because the catalog number is
+parsed from it (see `ReleaseService.process_local_dir`).
+
+Downloads are streamed in chunks to a temp file over a pooled HTTP session. After a dropped connection, the
+download is resumed with an HTTP Range request (up to `DOWNLOAD_ATTEMPTS` attempts), and started over if the
+server doesn't resume it where the partial download ends (as per `Content-Range`). The MD5 (or CRC32C, for
+objects without MD5) and the size are computed while streaming and verified against the object's metadata before
+the temp file is renamed. Zips are extracted into a temp directory that is renamed when complete, so an entry
+never contains a partial zip or tree: if the tree exists, it is complete.
+
+Extraction is refused for zips that would extract to more than `zip_max_uncompressed_bytes` (default 2 GiB) or
+have more than `zip_max_members` members (default 1000).
+
+With `extract=False`, only the zip is fetched, and the files of the release are read from the zip's members
+(see `Artifact.open`). This is the zero-extraction mode of `ReleaseService` (`release_zip_streaming` setting).
+
+Using an entry touches it. Entries are deleted by the [janitor](tmp_janitor.py), which keeps the cache under
+the `tmp_directory_max_bytes` budget, least recently used first.
+"""
+import base64
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import typing as t
+import zipfile
+from dataclasses import dataclass
+
+import google_crc32c
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+ARTIFACTS_DIRECTORY = "artifacts"
+
+DEFAULT_MAX_UNCOMPRESSED_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_MEMBERS = 1000
+
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts
+DOWNLOAD_TIMEOUT = (10, 60)
+# How often download progress is reported
+PROGRESS_INTERVAL_SECS = 1
+
+ptn_content_range = re.compile(r"bytes (\d+)-")
+
+
+@dataclass(slots=True)
+class Artifact:
+    """A cached release zip. The release's files are the top-level files of the extracted tree, or the top-level
+    members of the zip when it isn't `extracted`. `local_dir` is the path of the tree either way, so file paths
+    look the same in both modes.
+    """
+    version: str
+    zip_file: str
+    local_dir: str
+    extracted: bool = True
+
+    def names(self) -> t.List[str]:
+        """Names of the release's files, sorted."""
+        if self.extracted:
+            return sorted(
+                name for name in os.listdir(self.local_dir)
+                if not name.startswith(".") and os.path.isfile(os.path.join(self.local_dir, name))
+            )
+        with zipfile.ZipFile(self.zip_file, "r") as f:
+            return sorted(
+                m.filename for m in f.infolist()
+                if not m.is_dir() and "/" not in m.filename and not m.filename.startswith(".")
+            )
+
+    def size(self, name: str) -> int:
+        if self.extracted:
+            return os.path.getsize(os.path.join(self.local_dir, name))
+        with zipfile.ZipFile(self.zip_file, "r") as f:
+            return f.getinfo(name).file_size
+
+    @contextlib.contextmanager
+    def open(self, name: str) -> t.Iterator[t.BinaryIO]:
+        """Open one of the release's files for reading. Zip members are decompressed while they are read;
+        they are seekable, but seeking backwards starts decompressing over.
+        """
+        if self.extracted:
+            with open(os.path.join(self.local_dir, name), "rb") as f:
+                yield f
+        else:
+            with zipfile.ZipFile(self.zip_file, "r") as z, z.open(name, "r") as f:
+                yield f  # type: ignore
+
+    def key(self, name: str) -> str:
+        """Identity of the content of one of the release's files, known without reading it: the name, CRC-32
+        and size of its zip member. Extracted files whose zip is gone are identified by path, size and modification
+        time.
+        """
+        if not os.path.exists(self.zip_file):
+            path = os.path.join(self.local_dir, name)
+            st = os.stat(path)
+            return f"{path}:{st.st_size}:{st.st_mtime_ns}"
+        with zipfile.ZipFile(self.zip_file, "r") as f:
+            info = f.getinfo(name)
+        return f"zip:{name}:{info.CRC:08x}:{info.file_size}"
+
+
+def get_version(metadata: t.Mapping[str, t.Any]) -> str:
+    """Get the cache version of a cloud storage object from its metadata.
+    """
+    if metadata.get("md5"):
+        return base64.b64decode(metadata["md5"]).hex()
+    return f"g{metadata['generation']}"
+
+
+# Called with the bytes downloaded so far, the total bytes and the current rate in bytes per second
+ProgressCallback = t.Callable[[int, int, float], None]
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RangeMismatch(Exception):
+    """A partial response doesn't start where the partial download ends."""
+
+
+def content_range_start(res: requests.Response) -> t.Optional[int]:
+    m = ptn_content_range.match(res.headers.get("Content-Range", ""))
+    return int(m[1]) if m else None
+
+
+class ArtifactCache:
+
+    def __init__(
+        self,
+        tmp_directory: str,
+        static_base: str,
+        get_storage_client: t.Callable[[], t.Any],
+        max_uncompressed_bytes: int = DEFAULT_MAX_UNCOMPRESSED_BYTES,
+        max_members: int = DEFAULT_MAX_MEMBERS,
+    ):
+        self.directory = os.path.join(tmp_directory, ARTIFACTS_DIRECTORY)
+        self.static_base = static_base
+        self.get_storage_client = get_storage_client
+        self.max_uncompressed_bytes = max_uncompressed_bytes
+        self.max_members = max_members
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=16))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=16))
+        self.lock = threading.Lock()
+        self.file_locks: t.Dict[str, threading.Lock] = {}
+
+    def _file_lock(self, file: str) -> threading.Lock:
+        with self.lock:
+            return self.file_locks.setdefault(file, threading.Lock())
+
+    def release_directory(self, file: str) -> str:
+        """Directory holding all cached versions of a release zip."""
+        return os.path.join(self.directory, os.path.splitext(file)[0])
+
+    def _artifact(self, file: str, version: str, extracted: bool = True) -> Artifact:
+        entry = os.path.join(self.release_directory(file), version)
+        return Artifact(
+            version=version,
+            zip_file=os.path.join(entry, file),
+            local_dir=os.path.join(entry, os.path.splitext(file)[0]),
+            extracted=extracted,
+        )
+
+    def metadata(self, file: str) -> dict:
+        metadata = self.get_storage_client().metadata(f"Releases/{file}")
+        if metadata is None:
+            raise FileNotFoundError(f"Releases/{file} doesn't exist in cloud storage")
+        return metadata
+
+    def get(
+        self,
+        file: str,
+        version: t.Optional[str] = None,
+        progress: t.Optional[ProgressCallback] = None,
+        extract: bool = True,
+    ) -> Artifact:
+        """Get the extracted tree of the current version of a release zip, downloading and extracting the zip
+        only if it isn't cached.
+
+        :param version: Expected version. If the zip in cloud storage has changed since, an error is raised.
+        :param progress: Called with the download progress every `PROGRESS_INTERVAL_SECS`, and when done.
+        :param extract: When `False`, only the zip is fetched, and the artifact's files are its members.
+        """
+        with self._file_lock(file):
+            metadata = self.metadata(file)
+            current = get_version(metadata)
+            if version is not None and current != version:
+                raise AssertionError(f"Release zip has changed (version={version} | current={current})")
+            artifact = self._artifact(file, current, extract)
+            if os.path.isdir(artifact.local_dir) or (not extract and os.path.exists(artifact.zip_file)):
+                log.info(f"ArtifactCache.hit | file='{file}' | version={current}")
+            else:
+                self._fetch(file, artifact, metadata, progress)
+            if not extract:
+                # Extracted trees have been checked before extraction
+                self._check_limits(artifact)
+            self._drop_other_versions(file, current)
+            # Mark as used, for the janitor's LRU eviction
+            now = time.time()
+            os.utime(os.path.dirname(artifact.local_dir), (now, now))
+            return artifact
+
+    def _fetch(self, file: str, artifact: Artifact, metadata: dict, progress: t.Optional[ProgressCallback]):
+        entry = os.path.dirname(artifact.local_dir)
+        os.makedirs(entry, exist_ok=True)
+        if not os.path.exists(artifact.zip_file):
+            self._download(file, artifact, metadata, progress)
+        if artifact.extracted:
+            self._extract(file, artifact)
+
+    def _download(self, file: str, artifact: Artifact, metadata: dict, progress: t.Optional[ProgressCallback]):
+        """Stream the zip to a temp file, resuming after errors, and verify it.
+        """
+        url = f"{self.static_base}/Releases/{file}"
+        total = int(metadata["size"])
+        fd, part = tempfile.mkstemp(dir=os.path.dirname(artifact.zip_file), prefix=".download-")
+        md5, crc32c = hashlib.md5(), google_crc32c.Checksum()
+        size = 0
+        started = reported = time.monotonic()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                    headers = {"Range": f"bytes={size}-"} if size else {}
+                    try:
+                        with self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as res:
+                            if size and res.status_code == 200:
+                                # Range not supported, start over
+                                f.seek(0)
+                                f.truncate()
+                                md5, crc32c = hashlib.md5(), google_crc32c.Checksum()
+                                size = 0
+                            elif res.status_code not in (200, 206):
+                                raise DownloadError(f"File download failed (res.status_code={res.status_code})")
+                            elif res.status_code == 206 and content_range_start(res) != size:
+                                raise RangeMismatch(res.headers.get("Content-Range"))
+                            for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+                                md5.update(chunk)
+                                crc32c.update(chunk)
+                                size += len(chunk)
+                                if size > total:
+                                    raise DownloadError(f"Download is larger than the object (size={total})")
+                                now = time.monotonic()
+                                if progress and now - reported >= PROGRESS_INTERVAL_SECS:
+                                    progress(size, total, size / (now - started))
+                                    reported = now
+                        if size == total:
+                            break
+                    except RangeMismatch as ex:
+                        # Start over rather than append bytes from elsewhere in the zip
+                        log.warning(f"ArtifactCache.range_mismatch | file='{file}' | size={size} | content_range='{ex}' | attempt={attempt}")
+                        f.seek(0)
+                        f.truncate()
+                        md5, crc32c = hashlib.md5(), google_crc32c.Checksum()
+                        size = 0
+                    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as ex:
+                        log.warning(f"ArtifactCache.download_interrupted | file='{file}' | size={size} | attempt={attempt} | ex='{ex}'")
+                    if attempt == DOWNLOAD_ATTEMPTS:
+                        raise DownloadError(f"File download incomplete after {attempt} attempts (size={size} | total={total})")
+
+            if metadata.get("md5"):
+                if base64.b64encode(md5.digest()).decode() != metadata["md5"]:
+                    raise DownloadError("Downloaded zip doesn't match the MD5 in cloud storage")
+            elif metadata.get("crc32c"):
+                if base64.b64encode(crc32c.digest()).decode() != metadata["crc32c"]:
+                    raise DownloadError("Downloaded zip doesn't match the CRC32C in cloud storage")
+            os.replace(part, artifact.zip_file)
+        except:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+        elapsed = time.monotonic() - started
+        if progress:
+            progress(size, total, size / elapsed if elapsed else 0)
+        log.info(f"ReleaseCreator.zip_downloaded | file='{file}' | version={artifact.version} | size={size} | secs={elapsed:.1f}")
+
+    def _extract(self, file: str, artifact: Artifact):
+        entry = os.path.dirname(artifact.local_dir)
+        extract_dir = tempfile.mkdtemp(dir=entry, prefix=".extract-")
+        try:
+            with zipfile.ZipFile(artifact.zip_file, "r") as f:
+                self._check_members(f)
+                f.extractall(extract_dir)
+            os.rename(extract_dir, artifact.local_dir)
+        except:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+            raise
+        log.info(f"ReleaseCreator.zip_extracted | file='{file}' | local_dir='{artifact.local_dir}'")
+
+    def _check_members(self, f: zipfile.ZipFile):
+        members = f.infolist()
+        assert len(members) <= self.max_members, (
+            f"Zip file has too many members ({len(members)} > {self.max_members})"
+        )
+        # Members can't extract to more than their declared size (zipfile stops there).
+        uncompressed = sum(m.file_size for m in members)
+        assert uncompressed <= self.max_uncompressed_bytes, (
+            f"Zip file is too large uncompressed ({uncompressed} > {self.max_uncompressed_bytes} bytes)"
+        )
+
+    def _check_limits(self, artifact: Artifact):
+        with zipfile.ZipFile(artifact.zip_file, "r") as f:
+            self._check_members(f)
+
+    def _drop_other_versions(self, file: str, version: str):
+        release_directory = self.release_directory(file)
+        for name in os.listdir(release_directory):
+            if name != version:
+                shutil.rmtree(os.path.join(release_directory, name), ignore_errors=True)
+                log.info(f"ArtifactCache.dropped | file='{file}' | version={name}")
@@ -0,0 +1,133 @@
+"""Reading tags and durations of audio files, in parallel and cached on disk.
+
+`ReleaseService.process_local_dir` needs artist, album and title tags and the duration of every audio file of a
+release. `AudioProbe.probe_all` opens the files with mutagen on a bounded thread pool (`audio_probe_workers`
+setting, default 4) and returns the results in the order of the given paths.
+
+Results are cached on disk, keyed by an identity of the file that is known without reading it: for the files of
+a release zip, the zip member's name, CRC-32 and size (see `Artifact.key`), so files that haven't changed are not
+probed again, even if the release zip has been changed and extracted again. Other files are keyed by path, size
+and modification time. Files can also be probed without extracting them, through file objects over zip members
+(`open_file`); they share the cache with extracted ones. The cache is stored in
+`<tmp_directory>/.audio_metadata`, one small JSON file per audio file, written atomically. Entries are never
+evicted; they are a few hundred bytes each.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import mutagen
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+ARTIST_TAG = {".mp3": "TPE1", ".ogg": "ARTIST", ".opus": "ARTIST"}
+ALBUM_TAG = {".mp3": "TALB", ".ogg": "ALBUM", ".opus": "ALBUM"}
+TITLE_TAG = {".mp3": "TIT2", ".ogg": "TITLE", ".opus": "TITLE"}
+
+PROBED_TAGS = {*ARTIST_TAG.values(), *ALBUM_TAG.values(), *TITLE_TAG.values()}
+
+CACHE_DIRECTORY = ".audio_metadata"
+# Bump when the format of cached results or keys changes
+CACHE_VERSION = 2
+
+DEFAULT_WORKERS = 4
+
+
+def get_tag_value(tags: t.Mapping[str, t.Any], key: str) -> str:
+    v = tags[key]
+    if isinstance(v, list):
+        return v[0]
+    return str(v)
+
+
+# Opens a file for reading, e.g. `Artifact.open`
+OpenFile = t.Callable[[str], t.ContextManager[t.BinaryIO]]
+
+
+def _open(path: str) -> t.ContextManager[t.BinaryIO]:
+    return open(path, "rb")
+
+
+def file_key(path: str) -> str:
+    """Identity of a file on disk, for files that aren't known to be zip members."""
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def _hash_key(key: str) -> str:
+    return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+
+class AudioProbe:
+
+    def __init__(self, tmp_directory: str, n_workers: int = DEFAULT_WORKERS):
+        self.directory = os.path.join(tmp_directory, CACHE_DIRECTORY, f"v{CACHE_VERSION}")
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="AudioProbe")
+
+    def _cache_file(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _load(self, key: str) -> t.Optional[dict]:
+        try:
+            with open(self._cache_file(key), "r") as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _store(self, key: str, result: dict):
+        cache_file = self._cache_file(key)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(result))
+        os.replace(tmp, cache_file)
+
+    def probe(self, path: str, open_file: OpenFile = _open, key: t.Optional[str] = None) -> dict:
+        """Get the probed tags (`PROBED_TAGS` that are present, as strings) and the duration in seconds of an
+        audio file, as `{"tags": {...}, "length": float}`.
+
+        :param open_file: Opens `path`. Mutagen reads from the file object it returns, which must be seekable.
+        :param key: Identity of the file's content, e.g. `Artifact.key`. By default, `file_key`.
+        """
+        key = _hash_key(key if key is not None else file_key(path))
+        result = self._load(key)
+        if result is not None:
+            return result
+
+        with open_file(path) as f:
+            mf = mutagen.File(f)  # type: ignore
+        tags = mf.tags  # type: ignore
+        probed = {}
+        for tag in PROBED_TAGS:
+            try:
+                probed[tag] = get_tag_value(tags, tag)
+            except (KeyError, ValueError, TypeError):
+                # Missing tag (or no tags at all), reported by `ReleaseService.process_local_dir`
+                pass
+        result = {"tags": probed, "length": mf.info.length}  # type: ignore
+        self._store(key, result)
+        return result
+
+    def probe_all(
+        self,
+        paths: t.Sequence[str],
+        open_file: OpenFile = _open,
+        keys: t.Optional[t.Sequence[str]] = None,
+    ) -> t.List[dict]:
+        """Probe audio files in parallel. Results are in the order of `paths`. The first error is raised.
+
+        :param keys: Identities of the files, in the order of `paths` (see `probe`)
+        """
+        return list(self.executor.map(
+            lambda path, key: self.probe(path, open_file, key), paths, keys or [None] * len(paths)
+        ))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,166 @@
+"""A cloud storage backend on the local file system, for development and tests (`storage_backend = fake`).
+
+Objects are files under `fake_storage_directory`, named like the objects. Their metadata (size, MD5, CRC32C,
+generation) is computed from the files.
+
+Resumable uploads simulate the GCS protocol (see [storage_client](storage_client.py)): a session is a directory
+under `.sessions` holding the bytes committed so far, so sessions survive restarts like real ones. Chunks must
+start at the committed offset, and all but the last one must be multiples of 256 KiB. A session is gone once
+its upload has completed. For tests, `fail_after_chunks` makes the backend fail with `503 Service Unavailable`
+after accepting the given number of chunks, and `commit_partially` makes it commit only part of a chunk (as GCS
+may do).
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import typing as t
+import uuid
+
+import google_crc32c
+from google.api_core import exceptions as api_exceptions
+
+from .storage_client import CHUNK_GRANULARITY, ResumableUploadMixin, UploadSessionExpired
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+SESSIONS_DIRECTORY = ".sessions"
+
+
+class FakeStorageClient(ResumableUploadMixin):
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self.lock = threading.Lock()
+        self.fail_after_chunks: t.Optional[int] = None
+        self.commit_partially = False
+        self.chunks = 0
+        os.makedirs(os.path.join(directory, SESSIONS_DIRECTORY), exist_ok=True)
+
+    def _path(self, remote: str) -> str:
+        path = os.path.normpath(os.path.join(self.directory, remote))
+        assert path.startswith(self.directory + os.sep), f"Invalid object name '{remote}'"
+        return path
+
+    def _write(self, remote: str, data: bytes):
+        path = self._path(remote)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def upload(self, local: str, remote: str):
+        with open(local, "rb") as f:
+            self._write(remote, f.read())
+
+    def upload_bytes(self, data: bytes, remote: str, content_type: str):
+        self._write(remote, data)
+
+    def upload_file(self, f: t.BinaryIO, remote: str, size: int):
+        data = f.read(size)
+        assert len(data) == size, f"Expected {size} bytes, got {len(data)}"
+        self._write(remote, data)
+
+    def download_bytes(self, remote: str) -> bytes:
+        try:
+            with open(self._path(remote), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise api_exceptions.NotFound(remote)
+
+    def delete(self, remote: str):
+        try:
+            os.remove(self._path(remote))
+        except FileNotFoundError:
+            raise api_exceptions.NotFound(remote)
+
+    def copy(self, src: str, dst: str) -> dict:
+        self._write(dst, self.download_bytes(src))
+        return t.cast(dict, self.metadata(dst))
+
+    def exists(self, remote: str):
+        return os.path.isfile(self._path(remote))
+
+    def metadata(self, remote: str) -> t.Optional[dict]:
+        path = self._path(remote)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            generation = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return {
+            "size": len(data),
+            "generation": generation,
+            "md5": base64.b64encode(hashlib.md5(data).digest()).decode(),
+            "crc32c": base64.b64encode(google_crc32c.Checksum(data).digest()).decode(),
+        }
+
+    def list_metadata(self, prefix: str) -> t.Dict[str, dict]:
+        objects = {}
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if d != SESSIONS_DIRECTORY]
+            for name in files:
+                remote = os.path.relpath(os.path.join(root, name), self.directory)
+                if remote.startswith(prefix) and not name.endswith(".tmp"):
+                    objects[remote] = self.metadata(remote)
+        return objects
+
+    def _session_directory(self, uri: str) -> str:
+        return os.path.join(self.directory, SESSIONS_DIRECTORY, uri.rsplit("/", 1)[-1])
+
+    def create_upload_session(self, remote: str, size: int, content_type: t.Optional[str]) -> str:
+        uri = f"fake://upload/{uuid.uuid4().hex}"
+        session_directory = self._session_directory(uri)
+        os.makedirs(session_directory)
+        with open(os.path.join(session_directory, "session.json"), "w") as f:
+            f.write(json.dumps({"remote": remote, "size": size, "content_type": content_type}))
+        open(os.path.join(session_directory, "data"), "wb").close()
+        return uri
+
+    def put_chunk(self, uri: str, data: bytes, start: t.Optional[int], size: int) -> t.Tuple[int, t.Optional[dict]]:
+        session_directory = self._session_directory(uri)
+        try:
+            with open(os.path.join(session_directory, "session.json"), "r") as f:
+                session = json.loads(f.read())
+        except FileNotFoundError:
+            raise UploadSessionExpired(uri)
+        data_file = os.path.join(session_directory, "data")
+        committed = os.path.getsize(data_file)
+
+        if start is None:
+            return committed, None
+
+        if start != committed:
+            raise api_exceptions.BadRequest(f"Chunk starts at {start}, but {committed} bytes have been committed")
+        if size != session["size"]:
+            raise api_exceptions.BadRequest(f"Size {size} doesn't match the session's size {session['size']}")
+        last = start + len(data) == size
+        if not last and len(data) % CHUNK_GRANULARITY:
+            raise api_exceptions.BadRequest(f"Chunk size {len(data)} isn't a multiple of {CHUNK_GRANULARITY}")
+
+        with self.lock:
+            if self.fail_after_chunks is not None and self.chunks >= self.fail_after_chunks:
+                raise api_exceptions.ServiceUnavailable("Simulated failure")
+            self.chunks += 1
+        if self.commit_partially and len(data) > CHUNK_GRANULARITY:
+            data = data[:CHUNK_GRANULARITY]
+            last = False
+
+        with open(data_file, "ab") as f:
+            f.write(data)
+        committed += len(data)
+        if not last:
+            return committed, None
+
+        with open(data_file, "rb") as f:
+            self._write(session["remote"], f.read())
+        shutil.rmtree(session_directory)
+        return size, self.metadata(session["remote"])
@@ -0,0 +1,145 @@
+"""HTTP caching of the public pages (index2.htm and release pages) by browsers and caching proxies / CDNs.
+
+Validators:
+    Each response carries a strong `ETag` and a `Last-Modified` header. Both are derived from the content
+    version (`updated_at`, see [models](models/models.py)) without rendering the page, so conditional requests
+    (`If-None-Match`, `If-Modified-Since`) are answered with `304 Not Modified` by the `conditional_response`
+    tween before the view runs. Besides the content version, the ETag covers everything else the page bytes
+    depend on: the link rewriter fingerprint, the templates and the host URL.
+
+    Deleting an index record doesn't advance index2.htm's `Last-Modified`, only its ETag. `If-None-Match` takes
+    precedence over `If-Modified-Since`, so this only affects clients that don't send the ETag back.
+
+Cache-Control:
+    Configured per route by the `http_cache_control` setting, e.g.
+
+        http_cache_control =
+            index2 = public, max-age=60, s-maxage=86400
+            Releases = public, max-age=300, s-maxage=86400
+
+    Routes that aren't listed don't get a `Cache-Control` header from this module.
+
+Surrogate keys:
+    Responses carry a surrogate key header (`surrogate_key_header` setting, default `Surrogate-Key`) with a key
+    for the page, derived from its page cache key (see [page_cache](page_cache.py)): `index2` for index2.htm and
+    `Releases/<quoted release_dir>` for a release page. A proxy can purge all cached variants of a page by key.
+
+Purge hook:
+    Whenever the page cache is invalidated after an admin change, the callable named by the `purge_hook` setting
+    (dotted name, e.g. `pyramidprj.http_cache:log_purge`) is called with the affected surrogate keys and the
+    settings. It should ask the proxy / CDN to purge these keys. Exceptions are logged and don't fail the
+    request. There's no hook by default.
+"""
+import functools
+import hashlib
+import os
+import typing as t
+from urllib.parse import quote
+
+from cachetools import cached
+from pyramid.path import DottedNameResolver
+from pyramid.settings import aslist
+from pyramid.threadlocal import get_current_registry
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SURROGATE_KEY_HEADER = "Surrogate-Key"
+
+TEMPLATES_DIRECTORY = os.path.join(os.path.dirname(__file__), "templates")
+
+
+def _get_templates_hash() -> str:
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(TEMPLATES_DIRECTORY)):
+        with open(os.path.join(TEMPLATES_DIRECTORY, name), "rb") as f:
+            h.update(name.encode("utf-8"))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Templates only change with a deployment, i.e. a restart.
+TEMPLATES_HASH = _get_templates_hash()
+
+
+def make_etag(version: t.Any, fingerprint: str, host_url: str) -> str:
+    """Get the strong ETag of a page from its content version, the link rewriter fingerprint and the host URL.
+    """
+    s = repr((version, fingerprint, host_url, TEMPLATES_HASH))
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def surrogate_key(cache_key: tuple) -> str:
+    return "/".join(quote(part, safe="") for part in cache_key)
+
+
+def get_cache_control(settings) -> t.Dict[str, str]:
+    """Parse the `http_cache_control` setting into a dict of route name -> Cache-Control header value.
+    """
+    cache_control = {}
+    for line in aslist(settings.get("http_cache_control", ""), flatten=False):
+        route_name, _, value = line.partition("=")
+        cache_control[route_name.strip()] = value.strip()
+    return cache_control
+
+
+def get_surrogate_key_header(settings) -> str:
+    return settings.get("surrogate_key_header", DEFAULT_SURROGATE_KEY_HEADER)
+
+
+def set_cache_headers(response, settings, route_name, etag, last_modified, cache_key):
+    """Set the validator, Cache-Control and surrogate key headers on a response (`200` or `304`) for a public page.
+    """
+    response.etag = (etag, True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    cache_control = get_cache_control(settings).get(route_name)
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    response.headers[get_surrogate_key_header(settings)] = surrogate_key(cache_key)
+
+
+def is_not_modified(request, etag, last_modified) -> bool:
+    """Evaluate the request's conditional headers against the page's validators (RFC 9110, section 13.2.2).
+    """
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since is not None and last_modified is not None:
+        # HTTP dates have a resolution of one second.
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def log_purge(surrogate_keys: t.List[str], settings):
+    """A purge hook that only logs the keys. Useful for development."""
+    log.info(f"http_cache.purge | surrogate_keys={surrogate_keys}")
+
+
+@cached(cache={}, key=lambda: "🕉")
+def get_purge_hook() -> t.Optional[t.Callable[[t.List[str]], None]]:
+    settings = get_current_registry().settings
+    name = settings.get("purge_hook")
+    if not name:
+        return None
+    return functools.partial(DottedNameResolver().resolve(name), settings=settings)
+
+
+def purge(*cache_keys: tuple):
+    """Call the purge hook with the surrogate keys of the given page cache keys."""
+    hook = get_purge_hook()
+    if hook is None:
+        return
+    surrogate_keys = [surrogate_key(key) for key in cache_keys]
+    try:
+        hook(surrogate_keys)
+    except Exception:
+        log.exception(f"http_cache.purge_failed | surrogate_keys={surrogate_keys}")
+
+
+def includeme(config):
+    # Resolve the purge hook while the app's registry is current, because `purge` is also called from the
+    # `ReleaseService` thread (see `page_cache.includeme`).
+    get_purge_hook()
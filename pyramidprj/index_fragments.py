@@ -0,0 +1,99 @@
+"""Per-record fragment cache for index2.htm.
+
+index2.htm has one `<tr valign="top">` row per `IndexRecord`. Each row is rendered from
+[index2_record.jinja2](templates/index2_record.jinja2) with its links rewritten, and cached under the record id
+together with its version: the record's `updated_at` and the link rewriter fingerprint. The `index2` view then
+only assembles the rows in `id desc` order and renders them into the page.
+
+To assemble the rows, only the ids and versions of all records are queried. Full rows are loaded and rendered
+only for records whose fragment is missing or outdated, i.e. the records touched by `upsert_index_record`,
+`update_release`, `commit_release` since the last assembly. Fragments of deleted records (`delete_index_record`,
+`delete_release`) are dropped. Since versions are read from the database, this works across processes.
+"""
+import threading
+import typing as t
+
+from cachetools import cached
+from pyramid.renderers import render
+
+from . import models
+from .link_rewriter import get_fingerprint, rewrite_fragment
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+RECORD_TEMPLATE = "pyramidprj:templates/index2_record.jinja2"
+
+
+class IndexFragmentCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # id -> (version, html)
+        self.fragments: t.Dict[int, t.Tuple[tuple, str]] = {}
+
+    def _render(self, request, ir: models.IndexRecord, fingerprint: str) -> str:
+        settings = request.registry.settings
+        if ir.rewrite_fingerprint == fingerprint:
+            body, custom_date_section = ir.body_rewritten, ir.custom_date_section_rewritten
+        else:
+            body = rewrite_fragment(ir.body, settings, context="td")  # type: ignore
+            custom_date_section = rewrite_fragment(ir.custom_date_section, settings, context="td")  # type: ignore
+        return render(
+            RECORD_TEMPLATE,
+            {"rec": ir, "body": body, "custom_date_section": custom_date_section},
+            request=request,
+        )
+
+    def assemble(self, request) -> str:
+        """Get the HTML of all index2.htm rows, rebuilding only the outdated ones.
+
+        The links in the returned HTML are rewritten.
+        """
+        dbsession = request.dbsession
+        fingerprint = get_fingerprint(request.registry.settings)
+
+        versions = [
+            (ir_id, (updated_at, fingerprint))
+            for ir_id, updated_at in (
+                dbsession.query(models.IndexRecord.id, models.IndexRecord.updated_at)
+                .order_by(models.IndexRecord.id.desc())
+            )
+        ]
+
+        with self.lock:
+            current = {
+                ir_id: self.fragments[ir_id][1]
+                for ir_id, version in versions
+                if ir_id in self.fragments and self.fragments[ir_id][0] == version
+            }
+
+        rebuilt = {}
+        outdated = [ir_id for ir_id, _ in versions if ir_id not in current]
+        if outdated:
+            for ir in dbsession.query(models.IndexRecord).filter(models.IndexRecord.id.in_(outdated)):
+                version = (ir.updated_at, fingerprint)
+                rebuilt[ir.id] = (version, self._render(request, ir, fingerprint))
+            current.update({ir_id: html for ir_id, (_, html) in rebuilt.items()})
+            log.debug(f"IndexFragmentCache.rebuilt | n_fragments={len(rebuilt)}")
+
+        with self.lock:
+            self.fragments.update(rebuilt)
+            if len(self.fragments) > len(versions):
+                # Records have been deleted
+                for ir_id in set(self.fragments) - {ir_id for ir_id, _ in versions}:
+                    del self.fragments[ir_id]
+
+        return "".join(current[ir_id] for ir_id, _ in versions if ir_id in current)
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+
+
+@cached(cache={}, key=lambda: "🕉")
+def get_index_fragment_cache():
+    return IndexFragmentCache()
@@ -0,0 +1,459 @@
+"""Link rewriting rules for legacy HTML.
+
+A lot of the imported HTML (index records, release page content, custom bodies and custom tracklists)
+has URLs that aren't valid anymore with 20kbps_pyramid. The rules in this module rewrite them to point to
+the correct resources.
+
+The rules are applied in two places:
+  - at write time, when HTML content is saved to the database. The rewritten form is stored alongside the
+    original in a `*_rewritten` column, together with a fingerprint of the rules and `static_base`
+    (see `get_fingerprint`). The original is kept untouched, so legacy documents are preserved in their
+    original state.
+  - at response time, by the `rewrite_links` middleware in [tweens](tweens.py), for any response that
+    contains content which hasn't been rewritten with the current fingerprint.
+
+There are two rewriter engines, selected by the `link_rewriter_engine` setting (see `get_engine`).
+
+When the rules, `static_base` or the engine change, the fingerprint changes, and the stored rewritten content
+becomes stale. Stale content is ignored (the middleware takes over again) until the bulk re-rewrite command
+`rewrite_pyramidprj_links` has been run.
+"""
+import functools
+import hashlib
+import html as html_lib
+import itertools
+import json
+import re
+import typing as t
+from urllib.parse import urlparse, urlunparse
+
+from bs4 import BeautifulSoup
+
+if t.TYPE_CHECKING:
+    from .models import IndexRecord, ReleasePage
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Bump this whenever the logic in `rewrite_url` changes, so stored rewritten content is recognized as stale.
+RULES_VERSION = 1
+
+
+LEGACY_STATIC_FILES = [
+    "ico/yikis.jpg",
+    "fav/rate_fav.ico",
+    "ico/humanstxt-isolated-blank.gif",
+    "ico/rate.ico",
+    "ico/last-icon.jpg",
+    "fav/orgasm.ico",
+    "humans.txt",
+    "Releases/humans.txt",
+    "favicontw.ico",
+    "css/relpage.css",
+    "fav/digg_favicon.ico",
+    "ico/glogo.jpg",
+    "record16.ico",
+    "ico/download.png",
+    "rss.png",
+    "Releases/slow-wave-sleep/elogio-della-follia/ITA Lyrics.pdf",
+    "fav/tumblr_fav.gif",
+    "20kbps.xml",
+    "rss/20kbps.xml",
+    "favicon_myspace.png",
+    "Releases/slow-wave-sleep/elogio-della-follia/ENG Lyrics.pdf",
+    "ico/discogs-icon.jpeg",
+    "fav/mcfav.png",
+]
+
+
+URL_ATTRIBUTES = {
+    "img": ("src",),
+    "a": ("href", "src",),
+    "link": ("href",),
+    "meta": ("content",),
+    "iframe": ("src",),
+}
+
+
+# Keys of `release_data` whose values are rendered into URL attributes (`a[href]`, `meta[content]`)
+# by the release page template. (`relname` also goes into `og:title`, but it is rendered as text elsewhere.)
+RELEASE_DATA_URL_KEYS = (
+    "description",
+    "keywords",
+    "yikis",
+    "last",
+    "archive",
+    "discogs",
+    "rateyourmusic",
+    "audioorgasm",
+)
+
+
+# Markup around the elements fragments are rendered into, for parsing fragments in the same context as the
+# page. By element name, as serialized by html5lib.
+FRAGMENT_CONTEXTS = {
+    # Index record columns are rendered into table cells, and some legacy records close and open cells
+    # themselves.
+    "td": ("<table><tbody><tr><td>", "</td></tr></tbody></table>"),
+}
+
+
+ENGINES = ("html5lib", "stream", "parity")
+
+
+def get_engine(settings: t.Mapping[str, t.Any]) -> str:
+    """Get the rewriter engine selected by the `link_rewriter_engine` setting.
+
+      - `html5lib` (default): parse the document into an html5lib tree, rewrite, and re-serialize it.
+      - `stream`: scan the document once and rewrite the URL attribute values only. Everything else is
+        copied through verbatim.
+      - `parity`: run both engines, log any differences, and use the output of `html5lib`. This is meant
+        for verifying `stream` against live traffic before switching over.
+    """
+    engine = settings.get("link_rewriter_engine", "html5lib")
+    if engine not in ENGINES:
+        raise ValueError(f"`link_rewriter_engine` must be one of {ENGINES} (got '{engine}')")
+    return engine
+
+
+def get_fingerprint(settings: t.Mapping[str, t.Any]) -> str:
+    """Get a fingerprint of the rewrite rules, `static_base`, and the engine whose output is used. Rewritten
+    content stored in the database is only used when its fingerprint matches the current one.
+    """
+    output_engine = "stream" if get_engine(settings) == "stream" else "html5lib"
+    s = json.dumps([RULES_VERSION, LEGACY_STATIC_FILES, URL_ATTRIBUTES, settings["static_base"], output_engine])
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+class _SuffixTrie:
+    """Matches a path against all `LEGACY_STATIC_FILES` in a single backwards walk over the path.
+
+    When more than one entry is a suffix of the path (e.g. `humans.txt` and `Releases/humans.txt`), the entry
+    that comes first in the list wins, same as with checking the entries one by one using `endswith`.
+    """
+    def __init__(self, suffixes: t.Sequence[str]):
+        self.root: dict = {}
+        for i, suffix in enumerate(suffixes):
+            node = self.root
+            for ch in reversed(suffix):
+                node = node.setdefault(ch, {})
+            node.setdefault(None, (i, suffix))
+
+    def match(self, path: str) -> t.Optional[str]:
+        node = self.root
+        best = None
+        for ch in reversed(path):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node and (best is None or node[None][0] < best[0]):
+                best = node[None]
+        return best[1] if best else None
+
+
+_legacy_static_files = _SuffixTrie(LEGACY_STATIC_FILES)
+
+
+@functools.lru_cache(maxsize=8)
+def _static_netloc(static_base: str) -> str:
+    return urlparse(static_base).netloc
+
+
+def rewrite_url(url: str, static_base: str, release_dir: t.Optional[str] = None) -> t.Tuple[str, bool]:
+    """Apply the rewrite rules to a single URL.
+
+    :param release_dir: Release directory of the release page the URL appears on, if any. Only used for
+        rewriting the cover URL.
+
+    :return: A tuple of the (possibly) rewritten URL and a flag telling whether a final rule was applied.
+        When the flag is `True`, the remaining URL attributes of the same element are left alone.
+    """
+    pr = urlparse(url)
+    path_lower = pr.path.lower()
+
+    # Release pages with `custom_body` (from <release_dir>/index.html)
+    # need their cover URL rewritten to point to static asset storage.
+    if (
+        release_dir
+        and pr.path.endswith(("cover.jpg", "cover.png"))
+        and pr.netloc != _static_netloc(static_base)
+    ):
+        return f"{static_base}/Releases/{release_dir}/{pr.path.split('/')[-1]}", True
+
+    # Any release archive file URL needs to point to static asset storage.
+    if path_lower.endswith((".zip", ".rar")):
+        return f"{static_base}/Releases/{pr.path.split('/')[-1]}", True
+
+    # Some releases specify a custom player in `release_data["player"]`.
+    # The embedded URL must be forced to https.
+    if pr.netloc.endswith("archive.org") and pr.scheme == "http":
+        pr = pr._replace(scheme="https")
+        return urlunparse(pr), True
+
+    # Rewrite the obsolete domain to 20kbps.net.
+    if pr.netloc == "20kbps.sofapause.ch":
+        pr = pr._replace(netloc="20kbps.net")
+        url = urlunparse(pr)
+
+    # Any file in LEGACY_STATIC_FILES must point to static asset storage.
+    file = _legacy_static_files.match(pr.path)
+    if file:
+        return f"{static_base}/{file}", False
+
+    return url, False
+
+
+# The HTML tokenizer treats the content of these elements as text, so markup inside them isn't markup.
+RAW_TEXT_ELEMENTS = ("script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes", "plaintext")
+
+_ptn_markup = re.compile(r"<(?:(?P<comment>!--)|(?P<slash>/?)(?P<name>[a-zA-Z][^\s/>]*))")
+_ptn_attr = re.compile(
+    r"""[\s/]*(?:(?P<end>>)|(?P<name>[^\s/>][^\s/>=]*)(?:\s*=\s*(?P<value>"[^"]*"|'[^']*'|[^\s>]*))?)"""
+)
+_ptn_charref = re.compile(r"&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);")
+
+
+@functools.lru_cache(maxsize=None)
+def _ptn_raw_text_end(name: str) -> t.Pattern:
+    return re.compile(rf"</{name}[\s/>]", re.IGNORECASE)
+
+
+def _unescape(value: str) -> str:
+    return _ptn_charref.sub(lambda m: html_lib.unescape(m.group(0)), value)
+
+
+def _escape(value: str, quote: str) -> str:
+    value = value.replace("&", "&amp;")
+    return value.replace('"', "&quot;") if quote == '"' else value.replace("'", "&#39;")
+
+
+def _rewrite_stream(html: str, static_base: str, release_dir: t.Optional[str]) -> str:
+    """The `stream` engine. Scan the document once, tag by tag, and rewrite the values of the attributes in
+    `URL_ATTRIBUTES`. Everything else, including the original quoting and character references of attributes
+    that aren't changed, is copied through verbatim.
+    """
+    out = []
+    copied = 0  # `html` has been copied to `out` up to here
+    pos = 0
+    end = len(html)
+    while True:
+        m = _ptn_markup.search(html, pos)
+        if not m:
+            break
+
+        if m.group("comment"):
+            close = html.find("-->", m.end())
+            pos = end if close == -1 else close + 3
+            continue
+
+        if m.group("slash"):
+            pos = m.end()
+            continue
+
+        # Start tag. Tokenize the attributes up to the closing `>`. Like the HTML tokenizer, keep only the first
+        # occurrence of an attribute.
+        attrs: t.Dict[str, t.Match] = {}
+        pos = m.end()
+        terminated = False
+        while True:
+            am = _ptn_attr.match(html, pos)
+            if am is None:
+                break
+            pos = am.end()
+            if am.group("end"):
+                terminated = True
+                break
+            attrs.setdefault(am.group("name").lower(), am)
+        if not terminated:
+            break
+
+        name = m.group("name").lower()
+        replacements = []
+        for attr in URL_ATTRIBUTES.get(name, ()):
+            am = attrs.get(attr)
+            if am is None or am.group("value") is None:
+                continue
+            raw = am.group("value")
+            quote = raw[0] if raw[:1] in ('"', "'") else ""
+            url = _unescape(raw[1:-1] if quote else raw)
+            new_url, final = rewrite_url(url, static_base, release_dir)
+            if new_url != url:
+                quote = quote or '"'
+                replacements.append((*am.span("value"), f"{quote}{_escape(new_url, quote)}{quote}"))
+            if final:
+                break
+        for start, stop, value in sorted(replacements):
+            out.append(html[copied:start])
+            out.append(value)
+            copied = stop
+
+        if name in RAW_TEXT_ELEMENTS:
+            close = _ptn_raw_text_end(name).search(html, pos)
+            pos = end if close is None else close.start()
+
+    out.append(html[copied:])
+    return "".join(out)
+
+
+def _rewrite_soup(soup: BeautifulSoup, static_base: str, release_dir: t.Optional[str]):
+    for tag, attrs in URL_ATTRIBUTES.items():
+        for elem in soup.find_all(tag):
+            for attr in attrs:
+                try:
+                    url = elem[attr]
+                except KeyError:
+                    continue
+                elem[attr], final = rewrite_url(url, static_base, release_dir)
+                if final:
+                    break
+
+
+def _serialize(soup: BeautifulSoup, fragment: bool) -> str:
+    if not fragment:
+        return str(soup)
+    # html5lib always builds a full document, so the fragment is taken back out of it. Elements that html5lib
+    # moves into `head` (e.g. a leading `link` or `meta`) are kept in front of the body content.
+    head = soup.head.decode_contents() if soup.head else ""
+    body = soup.body.decode_contents() if soup.body else ""
+    return head + body
+
+
+def _rewrite_html5lib(
+    html: str, static_base: str, release_dir: t.Optional[str], fragment: bool, context: t.Optional[str] = None
+) -> str:
+    if context is not None:
+        start, end = FRAGMENT_CONTEXTS[context]
+        soup = BeautifulSoup(start + html + end, "html5lib")
+        _rewrite_soup(soup, static_base, release_dir)
+        body = soup.body.decode_contents() if soup.body else ""
+        if body.startswith(start) and body.endswith(end):
+            return body[len(start):len(body) - len(end)]
+        # The fragment breaks out of its context, e.g. by closing the table
+        log.warning(f"link_rewriter.fragment_leaves_context | context='{context}' | release_dir='{release_dir}'")
+    soup = BeautifulSoup(html, "html5lib")
+    _rewrite_soup(soup, static_base, release_dir)
+    return _serialize(soup, fragment)
+
+
+def _url_attribute_values(soup: BeautifulSoup) -> t.List[t.Tuple[str, str, str]]:
+    return [
+        (tag, attr, elem[attr])
+        for tag, attrs in URL_ATTRIBUTES.items()
+        for elem in soup.find_all(tag)
+        for attr in attrs
+        if elem.has_attr(attr)
+    ]
+
+
+def _check_parity(expected: str, actual: str, release_dir: t.Optional[str]):
+    """Compare the output of the `html5lib` and `stream` engines, after normalizing both with html5lib,
+    and log the differences.
+    """
+    soup_expected = BeautifulSoup(expected, "html5lib")
+    soup_actual = BeautifulSoup(actual, "html5lib")
+    if str(soup_expected) == str(soup_actual):
+        return
+    diffs = [
+        (e, a)
+        for e, a in itertools.zip_longest(_url_attribute_values(soup_expected), _url_attribute_values(soup_actual))
+        if e != a
+    ]
+    log.warning(
+        f"link_rewriter.parity_mismatch | release_dir='{release_dir}' | n_url_diffs={len(diffs)} | "
+        f"first_url_diffs={diffs[:3]}"
+    )
+
+
+def _rewrite(
+    html: str,
+    static_base: str,
+    release_dir: t.Optional[str],
+    engine: str,
+    fragment: bool,
+    context: t.Optional[str] = None,
+) -> str:
+    if engine == "stream":
+        return _rewrite_stream(html, static_base, release_dir)
+    rewritten = _rewrite_html5lib(html, static_base, release_dir, fragment, context)
+    if engine == "parity":
+        try:
+            _check_parity(rewritten, _rewrite_stream(html, static_base, release_dir), release_dir)
+        except Exception:
+            log.exception(f"link_rewriter.parity_check_failed | release_dir='{release_dir}'")
+    return rewritten
+
+
+def rewrite_document(
+    html: str, settings: t.Mapping[str, t.Any], release_dir: t.Optional[str] = None
+) -> str:
+    """Rewrite the links in a full HTML document using the engine selected in settings.
+
+    :param release_dir: Release directory of the release page, if the document is one.
+    """
+    return _rewrite(html, settings["static_base"], release_dir, get_engine(settings), fragment=False)
+
+
+def rewrite_fragment(
+    html: t.Optional[str],
+    settings: t.Mapping[str, t.Any],
+    release_dir: t.Optional[str] = None,
+    context: t.Optional[str] = None,
+) -> t.Optional[str]:
+    """Rewrite the links in an HTML fragment, i.e. content that is embedded in a template.
+
+    :param context: Name of the element the template renders the fragment into (see `FRAGMENT_CONTEXTS`), if it
+        isn't a plain block element. The fragment is parsed inside it, like it is in the page, so that e.g. the
+        cell boundaries of a fragment in a `td` are kept. The `stream` engine copies the markup verbatim anyway.
+    """
+    if html is None:
+        return None
+    return _rewrite(
+        html, settings["static_base"], release_dir, get_engine(settings), fragment=True, context=context
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _rewrite_player(player: str, static_base: str, release_dir: t.Optional[str], engine: str) -> str:
+    return _rewrite(player, static_base, release_dir, engine, fragment=True)
+
+
+def rewrite_release_data(
+    data: t.Optional[dict], settings: t.Mapping[str, t.Any], release_dir: t.Optional[str] = None
+) -> t.Optional[dict]:
+    """Rewrite the values of `release_data` that end up in URL attributes of the release page template,
+    including the custom player HTML. The template's own links are written in their rewritten form already.
+    """
+    if data is None:
+        return None
+    static_base = settings["static_base"]
+    data = dict(data)
+    for key in RELEASE_DATA_URL_KEYS:
+        if isinstance(data.get(key), str):
+            data[key], _ = rewrite_url(data[key], static_base, release_dir)
+    if isinstance(data.get("player"), str):
+        data["player"] = _rewrite_player(data["player"], static_base, release_dir, get_engine(settings))
+    return data
+
+
+def rewrite_index_record(ir: "IndexRecord", settings: t.Mapping[str, t.Any]):
+    """Compute and store the rewritten forms of an index record's HTML columns.
+    """
+    ir.body_rewritten = rewrite_fragment(ir.body, settings, context="td")  # type: ignore
+    ir.custom_date_section_rewritten = rewrite_fragment(  # type: ignore
+        ir.custom_date_section, settings, context="td"  # type: ignore
+    )
+    ir.rewrite_fingerprint = get_fingerprint(settings)  # type: ignore
+
+
+def rewrite_release_page(rp: "ReleasePage", settings: t.Mapping[str, t.Any]):
+    """Compute and store the rewritten forms of a release page's HTML columns.
+    """
+    release_dir = rp.release.release_dir if rp.release else None
+    rp.content_rewritten = rewrite_fragment(rp.content, settings, release_dir)  # type: ignore
+    rp.custom_tracklist_rewritten = rewrite_fragment(rp.custom_tracklist, settings, release_dir)  # type: ignore
+    rp.custom_body_rewritten = (  # type: ignore
+        rewrite_document(rp.custom_body, settings, release_dir) if rp.custom_body else None  # type: ignore
+    )
+    rp.rewrite_fingerprint = get_fingerprint(settings)  # type: ignore
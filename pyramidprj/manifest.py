@@ -0,0 +1,84 @@
+"""Checksum manifest of the files in a release directory.
+
+The manifest is computed from the release's files (extracted, or zip members) in
+`ReleaseService.process_local_dir`, stored in the preview's task data, and finally in `Release.manifest`. It is a
+list with an entry per file in the release directory (the player files, then `cover.jpg`):
+
+    {"file": "01-intro.opus", "size": 1234567, "md5": "<base64>", "crc32c": "<base64>"}
+
+Checksums are base64 encoded, like in cloud storage object metadata, so they can be compared directly:
+  - `UPLOAD` skips files whose object in cloud storage already has the same size and MD5 (see `is_unchanged`)
+  - `verify_release_directory` checks a published release directory against the manifest with a single
+    listing request
+"""
+import base64
+import hashlib
+import os
+import typing as t
+
+import google_crc32c
+
+
+def _open(path: str) -> t.ContextManager[t.BinaryIO]:
+    return open(path, "rb")
+
+
+def checksums(path: str, open_file: t.Callable[[str], t.ContextManager[t.BinaryIO]] = _open) -> dict:
+    """Get the size, MD5 and CRC32C of a file.
+
+    :param open_file: Opens `path`, e.g. `Artifact.open` for a zip member
+    """
+    md5, crc32c = hashlib.md5(), google_crc32c.Checksum()
+    size = 0
+    with open_file(path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+            crc32c.update(chunk)
+            size += len(chunk)
+    return {
+        "size": size,
+        "md5": base64.b64encode(md5.digest()).decode(),
+        "crc32c": base64.b64encode(crc32c.digest()).decode(),
+    }
+
+
+def compute_manifest(
+    files: t.Iterable[t.Tuple[str, str]],
+    open_file: t.Callable[[str], t.ContextManager[t.BinaryIO]] = _open,
+) -> t.List[dict]:
+    """Compute the manifest of (local path, file name in release directory) pairs.
+    """
+    return [{"file": name, **checksums(local, open_file)} for local, name in files]
+
+
+def is_unchanged(entry: t.Mapping[str, t.Any], metadata: t.Optional[t.Mapping[str, t.Any]]) -> bool:
+    """Compare a manifest entry with the metadata of a cloud storage object (see `StorageClient.metadata`).
+    """
+    if metadata is None:
+        return False
+    if metadata.get("size") != entry["size"]:
+        return False
+    if metadata.get("md5"):
+        return metadata["md5"] == entry["md5"]
+    return metadata.get("crc32c") == entry["crc32c"]
+
+
+def verify_release_directory(storage, release_dir: str, manifest: t.List[dict]) -> dict:
+    """Check the objects in a release directory against its manifest.
+
+    :return: `{"ok": bool, "missing": [...], "changed": [...], "unexpected": [...]}` with file names
+    """
+    prefix = os.path.join("Releases", release_dir) + "/"
+    objects = {name[len(prefix):]: metadata for name, metadata in storage.list_metadata(prefix).items()}
+    expected = {entry["file"]: entry for entry in manifest}
+    missing = sorted(set(expected) - set(objects))
+    changed = sorted(
+        name for name, entry in expected.items() if name in objects and not is_unchanged(entry, objects[name])
+    )
+    unexpected = sorted(set(objects) - set(expected))
+    return {
+        "ok": not (missing or changed),
+        "missing": missing,
+        "changed": changed,
+        "unexpected": unexpected,
+    }
@@ -8,8 +8,10 @@ import zope.sqlalchemy
 from .models import (
     IndexRecord,
     PlayerFile,
+    PublicReleasePage,
     Release,
     ReleasePage,
+    Task,
 )
 
 
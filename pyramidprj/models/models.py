@@ -1,12 +1,17 @@
 import typing as t
+from datetime import datetime
 
 from sqlalchemy import (
+    Boolean,
     Column,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     JSON,
     Table,
     Text,
+    UniqueConstraint,
 )
 
 from sqlalchemy.orm import (
@@ -36,6 +41,9 @@ class IndexRecord(Base):
     :param body: HTML content to be displayed for this record
     :param explicit_height: When set, the element's height is set explicitly using a `height` attribute.
     :param custom_date_section: To allow for arbitrary HTML in the date field. Overrides `date` when present.
+    :param body_rewritten, custom_date_section_rewritten: `body` and `custom_date_section` with links rewritten
+        (see [link_rewriter](../link_rewriter.py)). Only valid when `rewrite_fingerprint` is current.
+    :param updated_at: Time of the last change (UTC). Used for the `Last-Modified` header of index2.htm.
     """
     __tablename__ = 'index_record'
     id = Column(Integer, primary_key=True)
@@ -43,6 +51,10 @@ class IndexRecord(Base):
     body = Column(Text)
     explicit_height = Column(Integer)
     custom_date_section = Column(Text)
+    body_rewritten = Column(Text)
+    custom_date_section_rewritten = Column(Text)
+    rewrite_fingerprint = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     releases = relationship("Release", secondary=index_record_releases, back_populates="index_records")
 
@@ -86,17 +98,29 @@ class Release(Base):
         cover, description, and HTML player elements. Many legacy releases do not have a release page (so the
         only place where they can be seen is index2.htm). The admin interface enforces that a release page is
         created, so any new release will have a release page.
+
+    :param updated_at: Time of the last change (UTC) to the release or its release page. Used for the
+        `Last-Modified` header of the release page. Changes to the release page only don't update the `release`
+        row, so views that change the release page must set it explicitly (see `touch`).
+
+    :param manifest: Name, size, MD5 and CRC32C of each file in the release directory, as uploaded by the admin
+        interface (see [manifest](../manifest.py)). `None` for legacy releases.
     """
     __tablename__ = 'release'
     id = Column(Integer, primary_key=True)
-    catalog_no = Column(Text)
-    release_dir = Column(Text)
-    file = Column(Text)
+    catalog_no = Column(Text, index=True)
+    release_dir = Column(Text, index=True)
+    file = Column(Text, index=True)
     release_data = Column(JSON)
+    manifest = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     index_records = relationship("IndexRecord", secondary=index_record_releases, back_populates="releases")
     release_page = relationship("ReleasePage", back_populates="release", uselist=False)
 
+    def touch(self):
+        self.updated_at = datetime.utcnow()
+
 
 class ReleasePage(Base):
     """A detail page that displays a release's cover, description, and HTML player elements.
@@ -104,6 +128,9 @@ class ReleasePage(Base):
     :param custom_tracklist: Under normal circumstances, the tracklist is rendered from the associated
         `player_files`. Some legacy releases have a `list.inc.php` file that is displayed instead of the
         dynamic tracklist. This concerns legacy releases only and is not used with new releases.
+
+    :param content_rewritten, custom_body_rewritten, custom_tracklist_rewritten: The respective columns with links
+        rewritten (see [link_rewriter](../link_rewriter.py)). Only valid when `rewrite_fingerprint` is current.
     """
     __tablename__ = "release_page"
     id = Column(Integer, primary_key=True)
@@ -125,6 +152,11 @@ class ReleasePage(Base):
         comment="Some releases have a list.inc.php file."
     )
 
+    content_rewritten = Column(Text)
+    custom_body_rewritten = Column(Text)
+    custom_tracklist_rewritten = Column(Text)
+    rewrite_fingerprint = Column(Text)
+
     @property
     def content_text(self):
         """Get the page content as plain text. This is used in the description field when uploading the release
@@ -191,3 +223,69 @@ class PlayerFile(Base):
         if self.duration_secs is None:
             return ""
         return PlayerFile.show_duration(t.cast(int, self.duration_secs))
+
+
+class PublicReleasePage(Base):
+    """Denormalized read model of a public release page. Holds everything `release_page.jinja2` needs, so the
+    `Releases` view renders a release page from a single row, looked up by primary key.
+
+    Rows are derived from `Release`, `ReleasePage` and `PlayerFile` (see [read_model](../read_model.py)) and
+    kept in sync by the code paths that change these. Releases without a release page don't have a row.
+
+    :param release_data_rewritten: `release_data` with links rewritten. Like the other `*_rewritten` columns,
+        only valid when `rewrite_fingerprint` is current.
+    :param tracklist: The player files ordered by `number`, each as a dict with the keys `file`, `title`,
+        `duration` and `duration_iso8601`.
+    :param updated_at: Time of the last change to the row (UTC). Syncing a row without changes doesn't update
+        it. Used for the `ETag` and `Last-Modified` headers of the release page.
+    """
+    __tablename__ = "public_release_page"
+    release_dir = Column(Text, primary_key=True)
+    release_id = Column(Integer, ForeignKey("release.id"), index=True)
+    file = Column(Text)
+    release_data = Column(JSON)
+    release_data_rewritten = Column(JSON)
+    content = Column(Text)
+    content_rewritten = Column(Text)
+    custom_body = Column(Text)
+    custom_body_rewritten = Column(Text)
+    custom_tracklist = Column(Text)
+    custom_tracklist_rewritten = Column(Text)
+    tracklist = Column(JSON)
+    rewrite_fingerprint = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class Task(Base):
+    """A `ReleaseService` task (see [task_store](../task_store.py)). There is at most one task per request type
+    and release zip file, which holds the state of the latest request.
+
+    :param request_type: `RequestType` value
+    :param state: One of `queued`, `running`, `succeeded`, `failed`, `cancelled`
+    :param priority: `Priority` value of the request type. Queued tasks are claimed by priority, then by id.
+    :param payload: Input of the request. For `UPLOAD` requests, this is the data of the preview.
+    :param data: Data produced while processing the request (`TaskState.data`)
+    :param exception: Error message, when failed
+    :param claim_token: Token of the latest claim by a worker. Only the worker holding it updates the task.
+    :param cancel_requested: Set to make the worker of a running task stop (see `TaskStore.cancel`)
+    :param updated_at: Time of the last state or data update. Serves as heartbeat of running tasks.
+    """
+    __tablename__ = "task"
+    __table_args__ = (
+        UniqueConstraint("request_type", "file"),
+        Index("ix_task_state_priority", "state", "priority", "id"),
+    )
+    id = Column(Integer, primary_key=True)
+    request_type = Column(Integer, nullable=False)
+    file = Column(Text, nullable=False)
+    state = Column(Text, nullable=False, index=True)
+    priority = Column(Integer, nullable=False, default=0)
+    payload = Column(JSON)
+    data = Column(JSON)
+    exception = Column(Text)
+    claim_token = Column(Text)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,255 @@
+"""In-process cache for the rendered public pages (index2.htm and release pages).
+
+The cache stores the final response bytes, i.e. after the `rewrite_links` middleware, keyed by route and
+release directory:
+  - `INDEX_KEY` for index2.htm
+  - `release_key(release_dir)` for a release page (both the `Releases` and the `Releases_with_subdir` routes)
+
+The content of these pages only changes when an admin edits something, so entries never expire. Instead, the
+admin write paths invalidate exactly the keys they affect (see `invalidate_on_commit`), and
+`ReleaseService.upload_to_ia` does the same when it adds the archive.org URL to a release.
+
+Pages contain absolute URLs generated from the request's host URL, so entries are stored per host URL. The
+`page_cache` tween stores them per ETag instead, which covers the host URL and the content version (see
+[http_cache](http_cache.py)). That way, a page changed by another process (e.g. a release worker, see
+[release_worker](scripts/release_worker.py)) is re-rendered on the next request, even though the invalidation
+didn't reach this process. Entries of outdated versions are left to the LRU eviction.
+
+The cache is bounded by the total size of the stored bodies (`page_cache_max_bytes` setting, default 32 MiB,
+`0` disables the cache). Least recently used entries are evicted first.
+
+A burst of requests for a page that isn't cached renders the page only once ("single-flight"). The other
+requests wait for the first one and are served from the cache.
+
+Invalidation bumps a per-key generation. A render that was started before an invalidation is not stored, so a
+page that was rendered from data that has just been changed can't end up in the cache.
+"""
+import threading
+import typing as t
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import quote
+
+from cachetools import cached
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_registry
+
+from . import models
+from .http_cache import purge
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# How long a request waits for another request that is rendering the same page before rendering it itself
+SINGLE_FLIGHT_TIMEOUT_SECS = 30
+
+INDEX_KEY = ("index2",)
+
+# Registry key of the app, for rendering pages outside of requests
+APP_KEY = "page_cache_app"
+
+
+def release_key(release_dir: str) -> t.Tuple[str, str]:
+    return ("Releases", release_dir)
+
+
+@dataclass
+class CachedPage:
+    body: bytes
+    content_type: t.Optional[str]
+    charset: t.Optional[str]
+
+    def to_response(self) -> Response:
+        return Response(body=self.body, content_type=self.content_type, charset=self.charset)
+
+
+class PageCache:
+    """Byte-bounded LRU cache of rendered pages.
+
+    Entries are stored per key and variant. The variant is the request's host URL (or the page's ETag, which
+    covers it), because pages contain absolute URLs generated from it (`request.static_url`). Invalidating a key
+    drops all of its variants.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[t.Tuple[tuple, str], CachedPage] = OrderedDict()
+        self.size = 0
+        self.generations: t.Dict[tuple, int] = {}
+        self.flights: t.Dict[t.Tuple[tuple, str], threading.Event] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: tuple, variant: str = "") -> t.Optional[CachedPage]:
+        with self.lock:
+            page = self.entries.get((key, variant))
+            if page is not None:
+                self.entries.move_to_end((key, variant))
+            return page
+
+    def _put(self, key: tuple, variant: str, page: CachedPage, generation: int):
+        size = len(page.body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if self.generations.get(key, 0) != generation:
+                # Invalidated while rendering
+                return
+            old = self.entries.pop((key, variant), None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key, variant] = page
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def invalidate(self, *keys: tuple):
+        with self.lock:
+            for key in keys:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            for slot in [slot for slot in self.entries if slot[0] in keys]:
+                self.size -= len(self.entries.pop(slot).body)
+        log.debug(f"PageCache.invalidate | keys={keys}")
+
+    def clear(self):
+        with self.lock:
+            for key, _ in self.entries:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.entries.clear()
+            self.size = 0
+
+    def get_or_render(self, key: tuple, render: t.Callable[[], Response], variant: str = "") -> Response:
+        """Serve the page from the cache, or render it and store the result.
+
+        `render` returns the final response. Only `200` responses are stored.
+        """
+        if not self.enabled:
+            return render()
+
+        slot = (key, variant)
+        while True:
+            page = self.get(key, variant)
+            if page is not None:
+                return page.to_response()
+
+            with self.lock:
+                flight = self.flights.get(slot)
+                if flight is None:
+                    flight = self.flights[slot] = threading.Event()
+                    generation = self.generations.get(key, 0)
+                    leader = True
+                else:
+                    leader = False
+
+            if not leader:
+                if flight.wait(SINGLE_FLIGHT_TIMEOUT_SECS) and self.get(key, variant) is not None:
+                    continue
+                # The leader didn't store anything (e.g. non-200 response) or took too long.
+                return render()
+
+            try:
+                response = render()
+                if response.status_code == 200:
+                    page = CachedPage(response.body, response.content_type, response.charset)
+                    self._put(key, variant, page, generation)
+                return response
+            finally:
+                with self.lock:
+                    del self.flights[slot]
+                flight.set()
+
+
+def invalidate_on_commit(request, *keys: tuple):
+    """Invalidate cache entries once the request's transaction has been committed successfully.
+
+    Invalidating only after the commit makes sure that no request can re-render and cache the page from the
+    data as it was before the change. The pages are also purged from caching proxies (see
+    [http_cache](http_cache.py)).
+    """
+    cache = get_page_cache()
+
+    def hook(success):
+        if success:
+            cache.invalidate(*keys)
+            purge(*keys)
+
+    request.tm.get().addAfterCommitHook(hook)
+
+
+def warm_up(app, registry):
+    """Render index2.htm and every release page once, so they are cached before the first visitor asks for them.
+    """
+    dbsession = registry["dbsession_factory"]()
+    try:
+        release_dirs = [
+            release_dir
+            for (release_dir,) in (
+                dbsession.query(models.Release.release_dir)
+                .join(models.Release.release_page)
+                .filter(models.Release.release_dir.isnot(None))
+            )
+        ]
+    finally:
+        dbsession.close()
+
+    paths = ["/index2.htm"] + [f"/Releases/{quote(release_dir)}/" for release_dir in release_dirs]
+    _render(app, registry, paths)
+    log.info(f"PageCache.warmed_up | n_pages={len(paths)} | size={get_page_cache().size}")
+
+
+def _render(app, registry, paths: t.Sequence[str]):
+    base_url = registry.settings.get("page_cache_warmup_base_url")
+    for path in paths:
+        try:
+            Request.blank(path, base_url=base_url).get_response(app)
+        except Exception:
+            log.exception(f"PageCache.warm_up_failed | path='{path}'")
+
+
+def warm_up_release(registry, release_dir: str) -> int:
+    """Render index2.htm and a release's page once, after the release has been committed or changed (the
+    `WARM_UP` stage of `ReleaseService`). This warms the cache of the process that runs the stage.
+
+    :return: Number of pages rendered
+    """
+    app = registry.get(APP_KEY)
+    if app is None or not get_page_cache().enabled:
+        return 0
+    paths = ["/index2.htm", f"/Releases/{quote(release_dir)}/"]
+    _render(app, registry, paths)
+    return len(paths)
+
+
+def start_warm_up(app, registry):
+    """Run `warm_up` in a background thread when enabled by the `page_cache_warmup` setting. The app is kept in
+    the registry for `warm_up_release`.
+
+    Cache entries are per host URL, so `page_cache_warmup_base_url` should be set to the URL the public pages
+    are requested with (as seen by the app, i.e. behind the proxy).
+    """
+    registry[APP_KEY] = app
+    if not asbool(registry.settings.get("page_cache_warmup", False)) or not get_page_cache().enabled:
+        return
+    threading.Thread(target=warm_up, args=(app, registry), name="PageCacheWarmUp", daemon=True).start()
+
+
+@cached(cache={}, key=lambda: "🕉")
+def get_page_cache():
+    settings = get_current_registry().settings
+    return PageCache(int(settings.get("page_cache_max_bytes", DEFAULT_MAX_BYTES)))
+
+
+def includeme(config):
+    # Create the page cache while the app's registry is current, so it is configured from the app's settings
+    # no matter which thread uses it first.
+    get_page_cache()
@@ -0,0 +1,152 @@
+"""Denormalized read model for the public release pages (see `models.PublicReleasePage`).
+
+A `PublicReleasePage` row is derived from a `Release`, its `ReleasePage` and the `PlayerFile`s. It is rebuilt
+in the same transaction by every code path that changes these:
+  - `ReleaseService.create_database_objects` (new release)
+  - `ReleaseService.upload_to_ia` (archive.org URL added to `release_data`)
+  - `ReleaseService.delete_database_objects` (row deleted)
+  - the `update_release` view
+  - `rewrite_pyramidprj_links`, which rebuilds all rows, because the rows contain rewritten content
+
+Public requests only read the row (see `get_public_release_page`). A release that has no row yet, e.g. because
+`rewrite_pyramidprj_links` hasn't been run since the migration, gets it built and written on its first request.
+"""
+import typing as t
+
+from sqlalchemy.exc import IntegrityError
+
+from . import models
+from .link_rewriter import get_fingerprint, rewrite_release_data
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def _get_tracklist(player_files: t.Iterable[models.PlayerFile]) -> t.List[dict]:
+    ordered = sorted(
+        player_files,
+        key=lambda pf: (pf.number is None, pf.number or 0, pf.id or 0),
+    )
+    return [
+        {
+            "file": pf.file,
+            "title": pf.title,
+            "duration": pf.duration,
+            "duration_iso8601": pf.duration_iso8601,
+        }
+        for pf in ordered
+    ]
+
+
+def build_public_release_page(
+    release: models.Release, settings: t.Mapping[str, t.Any]
+) -> t.Optional[models.PublicReleasePage]:
+    """Build the (transient) read model row of a release. `None` for releases without release page.
+    """
+    rp = release.release_page
+    if rp is None or not release.release_dir:
+        return None
+
+    rewritten = rp.rewrite_fingerprint == get_fingerprint(settings)
+    return models.PublicReleasePage(
+        release_dir=release.release_dir,
+        release_id=release.id,
+        file=release.file,
+        release_data=release.release_data,
+        release_data_rewritten=(
+            rewrite_release_data(release.release_data, settings, release.release_dir)  # type: ignore
+            if rewritten else None
+        ),
+        content=rp.content,
+        content_rewritten=rp.content_rewritten,
+        custom_body=rp.custom_body,
+        custom_body_rewritten=rp.custom_body_rewritten,
+        custom_tracklist=rp.custom_tracklist,
+        custom_tracklist_rewritten=rp.custom_tracklist_rewritten,
+        tracklist=_get_tracklist(rp.player_files),
+        rewrite_fingerprint=rp.rewrite_fingerprint,
+    )
+
+
+def sync_public_release_page(
+    dbsession, release: models.Release, settings: t.Mapping[str, t.Any]
+) -> t.Optional[models.PublicReleasePage]:
+    """Insert or update the read model row of a release.
+
+    :return: The persistent row. `None` for releases without release page.
+    """
+    page = build_public_release_page(release, settings)
+    if page is None:
+        delete_public_release_page(dbsession, release.release_dir)  # type: ignore
+        return None
+    page = dbsession.merge(page)
+    log.debug(f"read_model.synced | release_dir='{release.release_dir}'")
+    return page
+
+
+def get_public_release_page(
+    dbsession, release_dir: str, settings: t.Mapping[str, t.Any]
+) -> t.Optional[models.PublicReleasePage]:
+    """Get the read model row of a release by primary key. When the row is missing, build it from the release
+    and write it, so the next request finds it.
+
+    :return: `None` when there's no release with a release page for `release_dir`.
+    """
+    page = dbsession.get(models.PublicReleasePage, release_dir)
+    if page is not None:
+        return page
+
+    release = (
+        dbsession.query(models.Release)
+        .filter(
+            models.Release.release_dir == release_dir
+        )
+        .first()
+    )
+    if release is None or release.release_page is None:
+        return None
+
+    log.info(f"read_model.miss | release_dir='{release_dir}' | release_id={release.id}")
+    try:
+        with dbsession.begin_nested():
+            return sync_public_release_page(dbsession, release, settings)
+    except IntegrityError:
+        # Written by a concurrent request
+        return dbsession.get(models.PublicReleasePage, release_dir)
+
+
+def delete_public_release_page(dbsession, release_dir: t.Optional[str]):
+    if release_dir is None:
+        return
+    (
+        dbsession.query(models.PublicReleasePage)
+        .filter(models.PublicReleasePage.release_dir == release_dir)
+        .delete(synchronize_session="fetch")
+    )
+
+
+def sync_all_public_release_pages(dbsession, settings: t.Mapping[str, t.Any]) -> int:
+    """Rebuild the read model from scratch.
+
+    :return: Number of rows
+    """
+    dbsession.query(models.PublicReleasePage).delete(synchronize_session="fetch")
+    release_dirs = set()
+    releases = (
+        dbsession.query(models.Release)
+        .filter(models.Release.release_dir.isnot(None))
+        .order_by(models.Release.id)
+    )
+    for release in releases:
+        page = build_public_release_page(release, settings)
+        if page is None:
+            continue
+        if page.release_dir in release_dirs:
+            log.warning(f"read_model.duplicate_release_dir | release_dir='{page.release_dir}' | release_id={release.id}")
+            continue
+        dbsession.add(page)
+        release_dirs.add(page.release_dir)
+    dbsession.flush()
+    return len(release_dirs)
@@ -0,0 +1,94 @@
+"""In-process resolution of release directories to public release pages, used by the `resolve_release`
+middleware.
+
+Every request for a path under `/Releases/` needs the `PublicReleasePage` (see [read_model](read_model.py)) with
+that `release_dir`. It is read by primary key, which is the only query for a release page request. A lot of
+these requests are bot probes for legacy paths that don't exist, though. The resolver keeps a bounded negative
+cache of release_dirs without a public release page (`release_resolver_negative_cache_size` setting, default
+10000 entries, least recently used first out), so repeated probes don't touch the database.
+
+The negative cache is invalidated by the admin views that create or delete releases (see `forget_on_commit`).
+Entries also expire after `release_resolver_negative_cache_ttl` seconds (default 300), in case a release is
+created by another process.
+"""
+import threading
+import typing as t
+
+from cachetools import TTLCache, cached
+from pyramid.threadlocal import get_current_registry
+
+from . import models
+from .read_model import get_public_release_page
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_NEGATIVE_CACHE_SIZE = 10000
+DEFAULT_NEGATIVE_CACHE_TTL = 300
+
+
+class ReleaseResolver:
+
+    def __init__(self, negative_cache_size: int, negative_cache_ttl: int):
+        self.lock = threading.Lock()
+        self.negative: TTLCache = TTLCache(maxsize=negative_cache_size, ttl=negative_cache_ttl)
+        # Bumped by `forget`. A lookup that was started before is not stored.
+        self.generation = 0
+
+    def resolve(
+        self, dbsession, release_dir: str, settings: t.Mapping[str, t.Any]
+    ) -> t.Optional[models.PublicReleasePage]:
+        with self.lock:
+            if release_dir in self.negative:
+                return None
+            generation = self.generation
+
+        page = get_public_release_page(dbsession, release_dir, settings)
+        if page is None:
+            with self.lock:
+                if self.generation == generation:
+                    self.negative[release_dir] = True
+        return page
+
+    def forget(self, release_dir: str):
+        with self.lock:
+            self.negative.pop(release_dir, None)
+            self.generation += 1
+        log.debug(f"ReleaseResolver.forget | release_dir='{release_dir}'")
+
+    def clear(self):
+        with self.lock:
+            self.negative.clear()
+            self.generation += 1
+
+
+def forget_on_commit(request, release_dir: str):
+    """Forget what is known about a release directory once the request's transaction has been committed.
+
+    Called by the views that create or delete releases. Forgetting only after the commit makes sure that no
+    request can cache the state from before the change.
+    """
+    resolver = get_release_resolver()
+
+    def hook(success):
+        if success:
+            resolver.forget(release_dir)
+
+    request.tm.get().addAfterCommitHook(hook)
+
+
+@cached(cache={}, key=lambda: "🕉")
+def get_release_resolver():
+    settings = get_current_registry().settings
+    return ReleaseResolver(
+        int(settings.get("release_resolver_negative_cache_size", DEFAULT_NEGATIVE_CACHE_SIZE)),
+        int(settings.get("release_resolver_negative_cache_ttl", DEFAULT_NEGATIVE_CACHE_TTL)),
+    )
+
+
+def includeme(config):
+    # Create the resolver while the app's registry is current (see `page_cache.includeme`).
+    get_release_resolver()
@@ -1,33 +1,62 @@
+import atexit
 import dateutil.parser as dateparser
-import glob
-import itertools
 import os.path
 import re
 import threading
 import time
 import typing as t
 import unicodedata
-from collections import deque
-from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
 from datetime import datetime
-from enum import IntEnum
 
 import transaction
+from pyramid.settings import asbool, aslist
 from pyramid.threadlocal import get_current_registry
-from sqlalchemy import engine_from_config
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.sql.expression import func
 
-import mutagen
-import requests
-import zipfile
 from cachetools import cached
 from pathvalidate import validate_filename
 
 from . import models
-from .archive_org_client import ArchiveOrgClient
-from .storage_client import get_storage_client
+from .archive_org_client import get_archive_org_client
+from .audio_probe import (  # noqa: F401 (re-exported)
+    ALBUM_TAG,
+    ARTIST_TAG,
+    DEFAULT_WORKERS as DEFAULT_AUDIO_PROBE_WORKERS,
+    TITLE_TAG,
+    AudioProbe,
+)
+from .artifact_cache import DEFAULT_MAX_MEMBERS, DEFAULT_MAX_UNCOMPRESSED_BYTES, Artifact, ArtifactCache
+from .http_cache import purge
+from .link_rewriter import rewrite_index_record, rewrite_release_page
+from .manifest import compute_manifest, is_unchanged
+from .page_cache import get_page_cache, release_key, warm_up_release
+from .read_model import delete_public_release_page, sync_public_release_page
+from .retry import DEFAULT_MAX_ATTEMPTS as DEFAULT_UPLOAD_MAX_ATTEMPTS, retry_call
+from .storage_client import DEFAULT_CHUNK_SIZE as DEFAULT_UPLOAD_CHUNK_SIZE, get_storage_client, is_transient
+from .task_store import (  # noqa: F401 (re-exported)
+    CANCELLED,
+    DEFAULT_MAX_QUEUED,
+    DEFAULT_MAX_TASKS,
+    DEFAULT_STALE_TASK_SECS,
+    DEFAULT_TASK_TTL_SECS,
+    FAILED,
+    QUEUED,
+    RUNNING,
+    SUCCEEDED,
+    Priority,
+    QueuedRequest,
+    QueueFull,
+    RequestType,
+    TaskCancelled,
+    TaskState,
+    TaskStore,
+)
+from .tmp_janitor import DEFAULT_MAX_BYTES as DEFAULT_TMP_DIRECTORY_MAX_BYTES, JANITOR_INTERVAL_SECS, TmpJanitor
 
 import logging
 
@@ -38,16 +67,67 @@ settings = get_current_registry().settings
 
 MUSIC_EXTENSIONS = ("mp3", "ogg", "opus",)
 IMAGE_EXTENSIONS = ("jpg", "png",)
-ARTIST_TAG = {".mp3": "TPE1", ".ogg": "ARTIST", ".opus": "ARTIST"}
-ALBUM_TAG = {".mp3": "TALB", ".ogg": "ALBUM", ".opus": "ALBUM"}
-TITLE_TAG = {".mp3": "TIT2", ".ogg": "TITLE", ".opus": "TITLE"}
 VARIOUS_ARTISTS_NAME = "VA"
 
+DEFAULT_WORKERS = 2
+# Number of files uploaded concurrently, by all UPLOAD requests together
+DEFAULT_UPLOAD_CONCURRENCY = 4
+# Files staged to the bucket by the pipeline whose upload hasn't completed, per PREVIEW
+DEFAULT_PIPELINE_QUEUE_SIZE = 4
+# Provisional location of the files staged by the pipeline, until the admin confirms the preview
+STAGING_PREFIX = "Staging"
+# How often idle workers check for requests enqueued by other processes
+POLL_INTERVAL_SECS = 2
+# How often running tasks check whether they have been cancelled from another process
+CANCEL_POLL_INTERVAL_SECS = 2
+# How often workers mark their running tasks as alive, at most (see `TaskStore.heartbeat`)
+HEARTBEAT_INTERVAL_SECS = 60
+# How long `ReleaseService.shutdown` waits for the requests being processed
+SHUTDOWN_TIMEOUT_SECS = 10
+
 SANITIZE_ALPHABET = ".-_0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
 SANITIZE_MAXLEN = 255
 
 ptn_catno = re.compile(r"\((.*?)\)-\d{4}$")
 
+# The admin's confirmation of a release (`create_database_objects`). It isn't a request, but stages follow it.
+COMMIT = "commit"
+# The stages that are queued automatically when a stage has succeeded, in this order, if enabled by the
+# `release_auto_stages` setting. PREVIEW and UPLOAD are requested by the admin, who checks the preview first.
+NEXT_STAGES: t.Dict[t.Union[str, RequestType], t.Tuple[RequestType, ...]] = {
+    # Warm-up first: stages for the same file run one after the other, and the archive.org upload takes long.
+    COMMIT: (RequestType.WARM_UP, RequestType.IA_UPLOAD),
+    # The archive.org URL has been added to the release page.
+    RequestType.IA_UPLOAD: (RequestType.WARM_UP,),
+}
+DEFAULT_AUTO_STAGES = (RequestType.IA_UPLOAD, RequestType.WARM_UP)
+
+
+@dataclass(slots=True)
+class StageArtifacts:
+    """What a stage hands to the stages queued after it, as their request data: the version of the release zip
+    (whose extracted tree is still in the artifact cache), the probed metadata and the manifest of the release.
+    """
+    release_dir: str
+    release_id: t.Optional[int] = None
+    zip_version: t.Optional[str] = None
+    local_dir: t.Optional[str] = None
+    player_files: t.Optional[t.List[dict]] = None
+    manifest: t.Optional[t.List[dict]] = None
+
+    @classmethod
+    def from_data(cls, data: t.Mapping[str, t.Any]) -> "StageArtifacts":
+        return cls(**{f.name: data.get(f.name) for f in fields(cls)})
+
+    def to_data(self) -> dict:
+        return asdict(self)
+
+
+class TaskLost(Exception):
+    """The task is no longer running under this worker's claim, so its state can't be written back (see
+    `TaskStore.save`).
+    """
+
 
 def sanitize(s):
     t = unicodedata.normalize("NFD", s).encode("ascii", "ignore").decode()
@@ -61,87 +141,369 @@ def sanitize(s):
     return t
 
 
-class RequestType(IntEnum):
-    PREVIEW = 0
-    UPLOAD = 1
-    IA_UPLOAD = 2  # Internet Archive upload
-
-
-@dataclass
-class QueuedRequest:
-    request_type: RequestType
-    file: t.Optional[str] = None
-    data: t.Optional[dict] = None
-
-
-@dataclass
-class TaskState:
-    success: t.Optional[bool] = None  # None = pending
-    data: dict = field(default_factory=dict)
-    exception: t.Optional[Exception] = None
-
-    def serialize(self) -> dict:
-        return {
-            "success": self.success,
-            "data": self.data,
-            "exception":self.exception,
-        }
-
-
 class ReleaseService:
-    """The ReleaseService internally runs a task queue in a worker thread.
+    """The ReleaseService internally runs a task queue in a pool of worker threads.
     The task queue processes a release along the pipeline, from downloading the release zip file from
     cloud storage to submitting a release to archive.org.
     Admin views enqueue tasks using ReleaseService's `request_*` methods.
     Additional synchronous methods are provided and are invoked by views to finalize a processed release by
     inserting rows for it into the database (`create_database_objects`), and to delete a release
     (`delete_database_objects`).
+
+    Queued requests are taken by priority class, interactive ones first, and the queue is bounded (see
+    [task_store](task_store.py)). The `request_*` methods return `False` when the same request is queued or
+    running already, and raise `QueueFull` when the queue is full.
+
+    Queued and running tasks can be cancelled (see `cancel`). Running tasks stop at the next check, between
+    download progress reports, files and upload chunks, and end `cancelled`.
+
+    Workers block on a condition variable while the queue is empty. Requests for the same release zip file are
+    never processed concurrently: a worker skips queued requests for a file that another worker is busy with.
+    The number of workers is set by the `release_service_workers` setting (default 2). With `0`, this process
+    only enqueues requests, and they are processed by a separate worker process (see
+    [release_worker](scripts/release_worker.py)).
+
+    Requests and their task state are stored in the database (see [task_store](task_store.py)), so every app
+    process sees the same tasks and the workers of all processes share the queue. `task_state` is the
+    `TaskStore`. The `TaskState` objects of the tasks being processed by this process are kept in `active`
+    and written back to the store whenever they change. If a write-back finds that the task is no longer
+    running under the worker's claim (e.g. it has been taken for stale and queued again), the worker stops
+    processing it.
+
+    All steps get the release zip and its extracted tree from the [artifact cache](artifact_cache.py), so an
+    unchanged zip is downloaded and extracted only once. The steps share the application's database session
+    factory and long-lived storage and archive.org clients, which are created on first use.
+
+    In zero-extraction mode (`release_zip_streaming = true`), `PREVIEW` and `UPLOAD` don't extract the zip: tags
+    and durations are read from the zip's members, and the members are streamed to cloud storage. `IA_UPLOAD`
+    still works on the extracted tree.
+
+    A release's stages form a DAG: PREVIEW → UPLOAD → commit → WARM_UP and IA_UPLOAD → WARM_UP. The stages
+    after the commit are queued automatically (see `NEXT_STAGES`), with the `StageArtifacts` of the committed
+    release, so `IA_UPLOAD` gets the same version of the zip from the artifact cache without downloading it again.
+
+    With the pipeline (`release_pipeline = true`), `PREVIEW` also stages the release's files to the bucket while
+    it probes them, and `UPLOAD` only copies the staged objects into the release directory (see
+    `_probe_and_stage`).
+
+    Processes with workers also run a janitor thread, which prunes the task history and deletes the cached
+    artifacts of releases that are done (see [tmp_janitor](tmp_janitor.py)), and a heartbeat thread, which keeps
+    the tasks they are running from being taken for stale.
     """
-    def __init__(self):
-        self.queue: deque[QueuedRequest] = deque()
-        self.task_state: t.Dict[t.Tuple[RequestType, str], TaskState] = {}
-        self.thread = threading.Thread(target=self.thread_fn)
-        self.thread.start()
+    def __init__(
+        self,
+        task_store: TaskStore,
+        janitor: TmpJanitor,
+        artifact_cache: ArtifactCache,
+        audio_probe: AudioProbe,
+        session_factory,
+        get_storage_client: t.Callable[[], t.Any],
+        get_archive_org_client: t.Callable[[], t.Any],
+        n_workers: int = DEFAULT_WORKERS,
+        upload_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        upload_max_attempts: int = DEFAULT_UPLOAD_MAX_ATTEMPTS,
+        upload_chunk_size: int = DEFAULT_UPLOAD_CHUNK_SIZE,
+        zip_streaming: bool = False,
+        pipeline: bool = False,
+        pipeline_queue_size: int = DEFAULT_PIPELINE_QUEUE_SIZE,
+        auto_stages: t.Collection[RequestType] = DEFAULT_AUTO_STAGES,
+        warm_up_release: t.Optional[t.Callable[[str], int]] = None,
+    ):
+        self.task_state = task_store
+        self.janitor = janitor
+        self.artifact_cache = artifact_cache
+        self.audio_probe = audio_probe
+        self.session_factory = session_factory
+        self.get_storage_client = get_storage_client
+        self.get_archive_org_client = get_archive_org_client
+        # Set when an IA upload first uses the client, so `shutdown` doesn't create one to shut it down
+        self.archive_org_client: t.Optional[t.Any] = None
+        self.upload_executor = ThreadPoolExecutor(max_workers=upload_concurrency, thread_name_prefix="ReleaseService-upload")
+        self.upload_max_attempts = upload_max_attempts
+        self.upload_chunk_size = upload_chunk_size
+        self.zip_streaming = zip_streaming
+        self.pipeline = pipeline
+        self.pipeline_queue_size = pipeline_queue_size
+        self.auto_stages = auto_stages
+        self.warm_up_release = warm_up_release
+        self.janitor_wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.active: t.Dict[t.Tuple[RequestType, str], TaskState] = {}
+        # Claim tokens of the tasks being processed by this process
+        self.claims: t.Dict[t.Tuple[RequestType, str], str] = {}
+        # Active tasks known to be cancelled, and when the others have last checked the store (see
+        # `_check_cancelled`). Guarded by `lock`.
+        self.cancelled: t.Set[t.Tuple[RequestType, str]] = set()
+        self.cancel_checked: t.Dict[t.Tuple[RequestType, str], float] = {}
+        # Guards `busy_files`, `wakeups`, `sweeping` and `stopping`. Workers wait on it for requests.
+        self.cond = threading.Condition()
+        # Guards `claims`, and updates of the `TaskState` objects in `active`.
+        self.lock = threading.RLock()
+        self.busy_files: t.Set[str] = set()
+        self.wakeups = 0
+        # Workers don't take requests while the janitor sweeps, so it can't delete the files of a new request.
+        self.sweeping = False
+        self.stopping = False
+        self.threads = [
+            threading.Thread(target=self.thread_fn, name=f"ReleaseService-{i}", daemon=True)
+            for i in range(n_workers)
+        ]
+        if n_workers:
+            self.threads += [
+                threading.Thread(target=self.janitor_thread_fn, name="ReleaseService-janitor", daemon=True),
+                threading.Thread(target=self.heartbeat_thread_fn, name="ReleaseService-heartbeat", daemon=True),
+            ]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT_SECS):
+        """Stop the workers. Requests that are being processed are given `timeout` seconds to finish. Queued
+        requests stay in the queue.
+        """
+        with self.cond:
+            if self.stopping:
+                return
+            self.stopping = True
+            self.cond.notify_all()
+        self.stopped.set()
+        self.janitor_wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.audio_probe.shutdown()
+        self.upload_executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            archive_org_client = self.archive_org_client
+        if archive_org_client is not None:
+            archive_org_client.shutdown()
+        log.info("ReleaseService.shut_down")
+
+    def _enqueue(self, req: QueuedRequest, bounded: bool = True) -> bool:
+        if not self.task_state.enqueue(req, bounded):
+            return False
+        with self.cond:
+            self.wakeups += 1
+            self.cond.notify()
+        return True
+
+    def _next_request(self) -> t.Optional[QueuedRequest]:
+        """Block until there is a queued request for a file that no worker is busy with, and take it.
+        `None` when shutting down.
+
+        Requests enqueued by this process wake the workers up immediately. Requests enqueued by other
+        processes are picked up within `POLL_INTERVAL_SECS`.
+        """
+        while True:
+            with self.cond:
+                while self.sweeping and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return None
+                busy_files = set(self.busy_files)
+                wakeups = self.wakeups
+
+            try:
+                req = self.task_state.claim(exclude_files=busy_files)
+                if req is None:
+                    self.task_state.requeue_stale()
+            except Exception:
+                log.exception("ReleaseService.claim_failed")
+                req = None
+
+            with self.cond:
+                if req is not None:
+                    self.busy_files.add(t.cast(str, req.file))
+                    with self.lock:
+                        self.claims[req.request_type, t.cast(str, req.file)] = t.cast(str, req.claim_token)
+                    return req
+                if self.wakeups == wakeups and not self.stopping:
+                    self.cond.wait(POLL_INTERVAL_SECS)
+
+    def _task(self, request_type: RequestType, file: str) -> TaskState:
+        return self.active[request_type, file]
+
+    def _store(self, request_type: RequestType, file: str, task_state: TaskState):
+        """Write a task state back under the worker's claim. Raise `TaskLost` if the claim is gone."""
+        with self.lock:
+            if not self.task_state.save((request_type, file), task_state, self.claims[request_type, file]):
+                raise TaskLost()
+
+    def _set_task_state(self, request_type: RequestType, file: str, task_state: TaskState):
+        with self.lock:
+            self.active[request_type, file] = task_state
+            self._store(request_type, file, task_state)
+
+    def _save(self, request_type: RequestType, file: str):
+        """Write the task state back to the store after changing its data."""
+        with self.lock:
+            self._store(request_type, file, self.active[request_type, file])
+
+    def _finish(self, request_type: RequestType, file: str, exception: t.Optional[Exception] = None):
+        with self.lock:
+            task_state = self.active.pop((request_type, file))
+            task_state.success = exception is None
+            task_state.exception = exception
+            task_state.cancelled = isinstance(exception, TaskCancelled)
+            self.cancelled.discard((request_type, file))
+            self.cancel_checked.pop((request_type, file), None)
+            self._store(request_type, file, task_state)
+        if task_state.cancelled:
+            log.info(f"ReleaseService.cancelled | request_type={request_type!r} | file='{file}'")
+
+    def _fail(self, request_type: RequestType, file: str, exception: Exception):
+        """Mark a task failed after `process_request` has raised, unless it has finished already. Otherwise it
+        would stay `running`, and be queued again once it is stale.
+        """
+        try:
+            with self.lock:
+                active = (request_type, file) in self.active
+            if active:
+                self._finish(request_type, file, exception)
+                return
+            # Raised before the task state was set
+            task_state = self.task_state.get((request_type, file))
+            if task_state is not None and task_state.success is None:
+                task_state.success = False
+                task_state.exception = exception
+                self._store(request_type, file, task_state)
+        except TaskLost:
+            pass
+        except Exception:
+            log.exception(f"ReleaseService.fail_failed | request_type={request_type!r} | file='{file}'")
+
+    def _check_cancelled(self, request_type: RequestType, file: str):
+        """Raise `TaskCancelled` if the task has been cancelled. Cancellation by another process is noticed
+        within `CANCEL_POLL_INTERVAL_SECS`.
+        """
+        key = (request_type, file)
+        with self.lock:
+            if key in self.cancelled:
+                raise TaskCancelled()
+            now = time.monotonic()
+            if now - self.cancel_checked.get(key, 0) < CANCEL_POLL_INTERVAL_SECS:
+                return
+            self.cancel_checked[key] = now
+        if self.task_state.is_cancel_requested(key):
+            with self.lock:
+                self.cancelled.add(key)
+            raise TaskCancelled()
 
     def thread_fn(self):
-        """Worker thread function. Pop requests from the queue and process them.
+        """Worker thread function. Take requests from the queue and process them.
+        """
+        while True:
+            req = self._next_request()
+            if req is None:
+                return
+            try:
+                self.process_request(req)
+            except TaskLost:
+                log.warning(f"ReleaseService.task_lost | request_type={req.request_type!r} | file='{req.file}'")
+            except Exception as ex:
+                log.exception(f"ReleaseService.request_failed | request_type={req.request_type!r} | file='{req.file}'")
+                self._fail(req.request_type, t.cast(str, req.file), ex)
+            finally:
+                with self.lock:
+                    self.active.pop((req.request_type, t.cast(str, req.file)), None)
+                    self.claims.pop((req.request_type, t.cast(str, req.file)), None)
+                with self.cond:
+                    self.busy_files.discard(t.cast(str, req.file))
+                    # Requests for this file may be waiting.
+                    self.wakeups += 1
+                    self.cond.notify_all()
+                self.janitor_wakeup.set()
+
+    def janitor_thread_fn(self):
+        """Janitor thread function. Clean up after every request, and every `JANITOR_INTERVAL_SECS`.
         """
-        if not getattr(self, "last", None):
-            self.last = time.time()
-        while True:            
-            time.sleep(0)
-            if len(self.queue):
-                req = self.queue.popleft()
+        while True:
+            self.janitor_wakeup.wait(JANITOR_INTERVAL_SECS)
+            self.janitor_wakeup.clear()
+            with self.cond:
+                if self.stopping:
+                    return
+                self.sweeping = True
+                busy_files = set(self.busy_files)
+            try:
+                self.janitor.sweep(busy_files)
+            except Exception:
+                log.exception("ReleaseService.janitor_failed")
+            finally:
+                with self.cond:
+                    self.sweeping = False
+                    self.cond.notify_all()
+
+    def heartbeat_thread_fn(self):
+        """Heartbeat thread function. Mark the tasks this process is running as alive, so they aren't queued again
+        while a step reports no progress for longer than `release_service_stale_task_secs` (e.g. the upload of a
+        large file to archive.org).
+        """
+        interval = min(HEARTBEAT_INTERVAL_SECS, self.task_state.stale_task_secs / 3)
+        while not self.stopped.wait(interval):
+            with self.lock:
+                keys = list(self.active)
+            if not keys:
+                continue
+            try:
+                self.task_state.heartbeat(keys)
+            except Exception:
+                log.exception("ReleaseService.heartbeat_failed")
+
+    def process_request(self, req: QueuedRequest):
+        file = t.cast(str, req.file)
+        match req.request_type:
+            case RequestType.PREVIEW:
+                self._set_task_state(RequestType.PREVIEW, file, TaskState())
+                artifact = self.process_zip_file(file, extract=not self.zip_streaming)
+                if artifact:
+                    self.process_local_dir(file, artifact)
+            case RequestType.UPLOAD:
                 data = t.cast(dict, req.data)
-                match req.request_type:
-                    case RequestType.PREVIEW:
-                        file = t.cast(str, req.file)
-                        self.task_state[RequestType.PREVIEW, file] = TaskState()
-                        local_dir = self.process_zip_file(file)
-                        if local_dir:
-                            self.process_local_dir(file, local_dir)
-                    case RequestType.UPLOAD:
-                        file: str = data["file"]
-                        self.task_state[RequestType.UPLOAD, file] = TaskState(data=data)
-                        self.upload_player_files(file)
-                    case RequestType.IA_UPLOAD:
-                        file = t.cast(str, req.file)
-                        self.task_state[RequestType.IA_UPLOAD, file] = TaskState()
-                        local_dir = self.process_zip_file(file, reuse_existing=True)
-                        if local_dir:
-                            self.upload_to_ia(file, local_dir)
+                saved = self.task_state.get((RequestType.UPLOAD, file))
+                if saved and saved.data.get("completed_uploads"):
+                    # Requeued after the worker died. Don't upload the files again that have been uploaded.
+                    data["completed_uploads"] = saved.data["completed_uploads"]
+                self._set_task_state(RequestType.UPLOAD, file, TaskState(data=data))
+                staged = data.get("staged")
+                if staged and all(s["state"] == SUCCEEDED for s in staged):
+                    # Staged by the pipeline, the zip isn't needed
+                    self.upload_player_files(file, None)
+                    return
+                # The files that were previewed
+                artifact = self.process_zip_file(
+                    file,
+                    request_type=RequestType.UPLOAD,
+                    version=data.get("zip_version"),
+                    extract=not self.zip_streaming,
+                )
+                if artifact:
+                    self.upload_player_files(file, artifact)
+            case RequestType.IA_UPLOAD:
+                # Handed over by the commit (see `NEXT_STAGES`), or empty when requested by the admin
+                data = dict(req.data or {})
+                self._set_task_state(RequestType.IA_UPLOAD, file, TaskState(data=data))
+                artifact = self.process_zip_file(
+                    file, request_type=RequestType.IA_UPLOAD, version=data.get("zip_version")
+                )
+                if artifact:
+                    self.upload_to_ia(file, artifact.local_dir)
+            case RequestType.WARM_UP:
+                self._set_task_state(RequestType.WARM_UP, file, TaskState(data=dict(req.data or {})))
+                self.warm_up(file)
 
     def request_preview(self, file: str):
         """Request release preview. The admin interface invokes this when a release zip file name is submitted
         as the first step in creating the release.
 
-        The zip file is then downloaded from cloud storage and extracted into a temp directory. The files inside
-        the temp directory are processed to generate a preview.
+        The zip file is then downloaded from cloud storage and extracted into a temp directory, unless this
+        version of it is cached. The files inside the temp directory are processed to generate a preview.
 
         :param file: Release zip file name. This file is expected to exist inside the `Releases` directory
             in cloud storage.
+        :return: `False` if a preview of this file is queued or running already
         """
-        self.queue.append(QueuedRequest(RequestType.PREVIEW, file))
+        return self._enqueue(QueuedRequest(RequestType.PREVIEW, file))
 
     def request_upload(self, file: str):
         """Request upload of the release's individual files to the release directory. The admin interface
@@ -152,59 +514,95 @@ class ReleaseService:
         if not present.) The release directory is publicly accessible and is the location from where the
         release page is served.
 
+        When an earlier upload of the same preview has failed, only the files that haven't been uploaded
+        successfully are uploaded, and interrupted uploads of large files are resumed.
+
         :param file: Release zip file name
+        :return: `False` if an upload of this file is queued or running already
         """
         preview_state = self.task_state[RequestType.PREVIEW, file]
-        self.queue.append(QueuedRequest(RequestType.UPLOAD, data=preview_state.data))
+        data = dict(preview_state.data)
+        previous = self.task_state.get((RequestType.UPLOAD, file))
+        if previous and previous.data.get("zip_version") == data.get("zip_version"):
+            data["completed_uploads"] = [
+                u for u in previous.data.get("completed_uploads", []) if u.get("state") == SUCCEEDED or u.get("session")
+            ]
+        return self._enqueue(QueuedRequest(RequestType.UPLOAD, file, data=data))
 
     def request_ia_upload(self, file: str):
         """Request submission of a release to archive.org. The admin interface invokes this when the
         `Upload to archive.org` button is clicked on the release edit page.
 
         :param file: Release zip file name
+        :return: `False` if an archive.org upload of this file is queued or running already
         """
-        self.queue.append(QueuedRequest(RequestType.IA_UPLOAD, file))
+        return self._enqueue(QueuedRequest(RequestType.IA_UPLOAD, file))
 
-    def process_zip_file(self, file, reuse_existing=False):
-        """Download release zip file from cloud storage and extract it into temp directory.
+    def cancel(self, request_type: RequestType, file: str) -> bool:
+        """Cancel a queued or running task. The admin interface invokes this from the pages showing the progress
+        of a task.
 
-        INTERNAL. Invoked by `ReleaseService` itself when processing a `PREVIEW` request.
+        A queued task is cancelled right away. A running task stops at its next check for cancellation, releasing
+        its resources: a partial download is deleted, files that haven't been uploaded are skipped, and resumable
+        upload sessions are kept, so uploading again resumes them. Its worker then takes the next request.
+
+        :return: `False` if there is no queued or running task of this type for the file
+        """
+        state = self.task_state.cancel((request_type, file))
+        if state == RUNNING:
+            with self.lock:
+                if (request_type, file) in self.active:
+                    # Processed by this process, don't wait for the next check of the store
+                    self.cancelled.add((request_type, file))
+        log.info(f"ReleaseService.cancel | request_type={request_type!r} | file='{file}' | state={state}")
+        return state in (QUEUED, RUNNING)
+
+    def queue_next_stages(self, stage: t.Union[str, RequestType], file: str, artifacts: StageArtifacts):
+        """Queue the stages that follow `stage` (see `NEXT_STAGES`) and are enabled by `release_auto_stages`.
+        They are queued even when the queue is full, so they aren't lost.
+
+        :param stage: A `RequestType`, or `COMMIT`
+        """
+        for request_type in NEXT_STAGES.get(stage, ()):
+            if request_type in self.auto_stages:
+                log.info(f"ReleaseService.queue_next_stage | stage={stage!r} | next={request_type!r} | file='{file}'")
+                self._enqueue(QueuedRequest(request_type, file, data=artifacts.to_data()), bounded=False)
+
+    def process_zip_file(self, file, request_type=RequestType.PREVIEW, version=None, extract=True) -> t.Optional[Artifact]:
+        """Get the release zip file and its extracted tree from the artifact cache, downloading it from cloud
+        storage and extracting it if this version of it isn't cached.
+
+        INTERNAL. Invoked by `ReleaseService` itself when processing any request.
 
         :param file: Release zip file name. This file is expected to exist inside the `Releases` directory
             in cloud storage.
 
-        :param reuse_existing: When `True`, and a matching temp directory is found, the existing temp directory
-            is reused instead of downloading and extracting the zip file again. This is only set to `True`
-            in the archive.org upload step. In the preview phase, the zip file is expected to be re-downloaded
-            in order to reflect any changes that are made to it.
-        """
-        tmpdir = settings["tmp_directory"]
-        local_dir = os.path.join(tmpdir, file.replace(".zip", ""))
+        :param request_type: Type of the request being processed. Its task state receives the error, if any.
+
+        :param version: Version of the zip file that is expected, e.g. the one that was previewed. When the zip
+            file in cloud storage has changed since, this fails.
 
-        if (
-            reuse_existing
-            and os.path.exists(os.path.join(local_dir, "cover.jpg"))
-        ):
-            return local_dir
+        :param extract: When `False`, the zip isn't extracted, and the artifact's files are read from its members.
+
+        The download progress is reported in the task's `data["download"]`. Cancellation is checked along with
+        it, and the partial download is deleted.
+        """
+        def progress(size, total, bytes_per_sec):
+            with self.lock:
+                self._task(request_type, file).data["download"] = {
+                    "bytes": size,
+                    "total": total,
+                    "bytes_per_sec": round(bytes_per_sec),
+                }
+            self._save(request_type, file)
+            self._check_cancelled(request_type, file)
 
         try:
-            res = requests.get(
-                f"{settings['static_base']}/Releases/{file}"
-            )
-            assert res.status_code == 200, f"File download failed (res.status_code={res.status_code})"            
-            log.info(f"ReleaseCreator.zip_downloaded | file='{file}'")
-            local_file = os.path.join(tmpdir, file)
-            with open(local_file, "wb") as f:
-                f.write(res.content)
-            with zipfile.ZipFile(local_file, "r") as f:
-                f.extractall(local_dir)
-            log.info(f"ReleaseCreator.zip_extracted | file='{file}' | local_dir='{local_dir}'")
+            self._check_cancelled(request_type, file)
+            return self.artifact_cache.get(file, version, progress, extract)
         except Exception as ex:
-            self.task_state[RequestType.PREVIEW, file].success = False
-            self.task_state[RequestType.PREVIEW, file].exception = ex
+            self._finish(request_type, file, ex)
             return None
-        
-        return local_dir
 
     def _get_tag_value(self, tags: t.Mapping[str, t.Any], key: str) -> str:
         v = tags[key]
@@ -221,7 +619,7 @@ class ReleaseService:
     def _get_album_tag(self, dotext: str, tags: t.Mapping[str, t.Any]) -> str:
         return self._get_tag_value(tags, ALBUM_TAG[dotext])
 
-    def process_local_dir(self, file, local_dir):
+    def process_local_dir(self, file, artifact: Artifact):
         """Extract release data from the release's individual files.
 
         INTERNAL. Invoked by `ReleaseService` itself when processing a `PREVIEW` request.
@@ -238,6 +636,14 @@ class ReleaseService:
 
         Duration of each track is also extracted from the file itself.
 
+        The files are probed in parallel, and the results are cached by zip member (see
+        [audio_probe](audio_probe.py)).
+
+        The checksum manifest of the release directory is computed as well (see [manifest](manifest.py)).
+
+        In zero-extraction mode (`release_zip_streaming` setting), the files are read from the zip's members
+        instead of the extracted tree.
+
         The lexicographic order of audio file names inside the temp directory is assumed to reflect the desired
         track numbering, so audio files should be given as:
             01-<remainder_of_name>.opus
@@ -245,27 +651,46 @@ class ReleaseService:
             ...and so on.
 
         :param file: Release zip file name
-        :param local_dir: Temp directory into which release zip was extracted
+        :param artifact: The release zip in the artifact cache
         """
-        data = self.task_state[RequestType.PREVIEW, file].data = {
+        local_dir = artifact.local_dir
+        data = {
             "local_dir": local_dir,
-            "catalog_no": ptn_catno.search(local_dir).groups()[0],  # type: ignore
             "file": file,
+            "zip_version": artifact.version,
         }
+        with self.lock:
+            self._task(RequestType.PREVIEW, file).data = data
 
         try:
-            music_files = sorted(list(itertools.chain.from_iterable(
-                glob.glob(f"{local_dir}/*.{ext}")
-                for ext in MUSIC_EXTENSIONS
-            )))
+            m = ptn_catno.search(os.path.basename(local_dir))
+            assert m, f"No catalog number in '{file}', expected artist_name_-_album_name-(catalog_no)-year.zip"
+            with self.lock:
+                data["catalog_no"] = m[1]
+            names = artifact.names()
+            music_files = sorted(
+                os.path.join(local_dir, name)
+                for name in names
+                if os.path.splitext(name)[1][1:] in MUSIC_EXTENSIONS
+            )
 
-            assert glob.glob(f"{local_dir}/cover.jpg"), "Missing cover.jpg"
+            assert "cover.jpg" in names, "Missing cover.jpg"
+
+            def open_file(path):
+                return artifact.open(os.path.basename(path))
 
             player_files = []
             albums = set()
-            for i, f in enumerate(music_files, 1):
-                mf = mutagen.File(f)  # type: ignore
-                tags = mf.tags  # type: ignore
+            if self.pipeline:
+                probes = self._probe_and_stage(file, artifact, music_files)
+            else:
+                probes = self.audio_probe.probe_all(
+                    music_files, open_file, [artifact.key(os.path.basename(f)) for f in music_files]
+                )
+            self._check_cancelled(RequestType.PREVIEW, file)
+            for i, (f, probe) in enumerate(zip(music_files, probes), 1):
+                tags = probe["tags"]
+                length = probe["length"]
                 music_file = sanitize(os.path.basename(f))
                 _, dotext = os.path.splitext(music_file)
                 try:
@@ -278,8 +703,8 @@ class ReleaseService:
                     "file": music_file,
                     "number": i,
                     "title": self._get_title_tag(dotext, tags),
-                    "duration_secs": round(mf.info.length),  # type: ignore
-                    "duration_hms": models.PlayerFile.show_duration(round(mf.info.length)),  # type: ignore
+                    "duration_secs": round(length),
+                    "duration_hms": models.PlayerFile.show_duration(round(length)),
                 })
                 albums.add(self._get_album_tag(dotext, tags))
 
@@ -296,57 +721,316 @@ class ReleaseService:
             for pf in player_files:
                 del pf["_artist"]
 
-            data.update({
-                "local_files": music_files,
-                "release_dir": os.path.join(sanitize(artist.lower()), sanitize(album.lower())),
-                "release_data": {
-                    "relname": album,
-                    "artist": artist,
-                    "cat-no": data["catalog_no"],
-                    "description": f"{artist} - {album} ({data['catalog_no']})",
-                    "list": "ol",
-                    "date": datetime.now().isoformat()[:10],
-                },
-                "player_files": player_files,
-            })
+            manifest = compute_manifest(
+                [(f, pf["file"]) for f, pf in zip(music_files, player_files)]
+                + [(os.path.join(local_dir, "cover.jpg"), "cover.jpg")],
+                open_file,
+            )
+
+            with self.lock:
+                data.update({
+                    "local_files": music_files,
+                    "release_dir": os.path.join(sanitize(artist.lower()), sanitize(album.lower())),
+                    "release_data": {
+                        "relname": album,
+                        "artist": artist,
+                        "cat-no": data["catalog_no"],
+                        "description": f"{artist} - {album} ({data['catalog_no']})",
+                        "list": "ol",
+                        "date": datetime.now().isoformat()[:10],
+                    },
+                    "player_files": player_files,
+                    "manifest": manifest,
+                })
+            self._save(RequestType.PREVIEW, file)
         except Exception as ex:
-            self.task_state[RequestType.PREVIEW, file].success = False
-            self.task_state[RequestType.PREVIEW, file].exception = ex
+            self._finish(RequestType.PREVIEW, file, ex)
             return None
 
-        self.task_state[RequestType.PREVIEW, file].success = True
+        self._finish(RequestType.PREVIEW, file)
         return data
 
-    def upload_player_files(self, file):
+    def _probe_and_stage(self, file: str, artifact: Artifact, music_files: t.List[str]) -> t.List[dict]:
+        """Probe the audio files, and stage the release's files to the bucket as soon as each one is ready, so
+        `UPLOAD` doesn't have to upload them after the admin has confirmed the preview.
+
+        The files are staged under `Staging/<zip stem>/<zip version>/` by the shared upload pool. At most
+        `release_pipeline_queue_size` files (default 4) are waiting for or being staged; probing waits for room.
+        `data["staged"]` has an entry per file, like `completed_uploads` of `UPLOAD`. Failing to stage a file
+        doesn't fail the preview, `UPLOAD` uploads it instead. Objects staged for other versions of the zip are
+        deleted.
+
+        :return: Probe results, in the order of `music_files`
+        """
+        data = self._task(RequestType.PREVIEW, file).data
+        stem = os.path.splitext(file)[0]
+        prefix = f"{STAGING_PREFIX}/{stem}/{artifact.version}/"
+        storage = self.get_storage_client()
+        for remote in storage.list_metadata(f"{STAGING_PREFIX}/{stem}/"):
+            if not remote.startswith(prefix):
+                storage.delete(remote)
+
+        names = ["cover.jpg"] + [os.path.basename(f) for f in music_files]
+        staged = {
+            name: {
+                "from": os.path.join(artifact.local_dir, name),
+                "to": prefix + name,
+                "state": QUEUED,
+                "size": artifact.size(name),
+                "bytes": 0,
+                "attempts": 0,
+            }
+            for name in names
+        }
+        with self.lock:
+            data["staged"] = list(staged.values())
+        self._save(RequestType.PREVIEW, file)
+
+        room = threading.Semaphore(self.pipeline_queue_size)
+        futures = []
+
+        def stage(name):
+            room.acquire()
+            future = self.upload_executor.submit(
+                self._upload_file, file, artifact, storage, staged[name], None, RequestType.PREVIEW
+            )
+            future.add_done_callback(lambda _: room.release())
+            futures.append(future)
+
+        def open_file(path):
+            return artifact.open(os.path.basename(path))
+
+        stage("cover.jpg")
+        probes = []
+        results = self.audio_probe.executor.map(
+            lambda path: self.audio_probe.probe(path, open_file, artifact.key(os.path.basename(path))), music_files
+        )
+        try:
+            for f, probe in zip(music_files, results):
+                self._check_cancelled(RequestType.PREVIEW, file)
+                probes.append(probe)
+                stage(os.path.basename(f))
+        except BaseException:
+            # Cancelled or a probe failed: drop the probes and stagings that haven't started
+            results.close()
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # Don't return while staging uploads still use the artifact
+            wait(futures)
+        for future in futures:
+            if future.exception():
+                log.warning(f"ReleaseCreator.staging_failed | file='{file}' | ex='{future.exception()!r}'")
+        return probes
+
+    def upload_player_files(self, file, artifact: t.Optional[Artifact]):
         """Upload a release's individual files (audio and cover) to the publicly accessible release directory.
 
         INTERNAL. Invoked by `ReleaseService` itself when processing an `UPLOAD` request.        
 
+        Files are uploaded concurrently (`upload_concurrency` setting, default 4, shared by all uploads).
+        Transient errors are retried with exponential backoff and jitter, up to `upload_max_attempts` attempts
+        per file (default 5). `data["completed_uploads"]` has an entry per file with its `state` (`queued`,
+        `running`, `succeeded` or `failed`), `size`, uploaded `bytes` and number of `attempts`. Files that
+        have already succeeded (in an earlier upload of the same preview) are skipped. So are files whose object
+        in cloud storage matches the preview's manifest (`unchanged` is set for them).
+
+        Files larger than `upload_chunk_size` (default 8 MiB) are uploaded in chunks through a resumable upload
+        session. The session is kept in the file's entry and saved after every chunk, so an upload that is
+        retried or requeued after a worker restart continues from the last committed chunk.
+
+        In zero-extraction mode (`release_zip_streaming` setting), the zip's members are streamed to cloud
+        storage under their sanitized names, without extracting them.
+
+        Files that the pipeline has staged (see `_probe_and_stage`) are copied within the bucket instead, and
+        the staged objects are deleted when all files have been uploaded.
+
         :param file: Release zip file name
+        :param artifact: The release zip in the artifact cache. Its `local_dir` can differ from the preview's
+            `local_dir`, when the artifacts have been evicted from the cache in the meantime. `None` when all
+            files have been staged.
         """
-        data = self.task_state[RequestType.UPLOAD, file].data
-        data["completed_uploads"] = []
+        data = self._task(RequestType.UPLOAD, file).data
+        local_dir = artifact.local_dir if artifact else data["local_dir"]
+        staged = {
+            os.path.basename(s["from"]): s for s in data.get("staged") or [] if s["state"] == SUCCEEDED
+        }
+        remote_rlsdir = os.path.join("Releases", data["release_dir"])
+        previous = {u["to"]: u for u in data.get("completed_uploads", [])}
+        manifest = {entry["file"]: entry for entry in data.get("manifest") or []}
 
         try:
-            storage = get_storage_client()
-            remote_rlsdir = os.path.join("Releases", data["release_dir"])
-            completed_uploads = []
-            for local, pf in zip(data["local_files"], data["player_files"]):
-                remote = os.path.join(remote_rlsdir, pf["file"])
-                log.info(f"ReleaseCreator.upload_player_file | local='{local}' | remote='{remote}'")
-                storage.upload(local, remote)
-                data["completed_uploads"].append({"from": local, "to": remote})
-                time.sleep(0)
-            storage.upload(
-                os.path.join(data["local_dir"], "cover.jpg"),
-                os.path.join(remote_rlsdir, "cover.jpg")
-            )
+            pairs = [
+                (os.path.join(local_dir, os.path.basename(local)), os.path.join(remote_rlsdir, pf["file"]))
+                for local, pf in zip(data["local_files"], data["player_files"])
+            ] + [
+                (os.path.join(local_dir, "cover.jpg"), os.path.join(remote_rlsdir, "cover.jpg")),
+            ]
+            uploads = []
+            for local, remote in pairs:
+                s = staged.get(os.path.basename(local))
+                u = {
+                    "from": s["to"] if s else local,
+                    "to": remote,
+                    "state": QUEUED,
+                    "size": s["size"] if s else t.cast(Artifact, artifact).size(os.path.basename(local)),
+                    "bytes": 0,
+                    "attempts": 0,
+                }
+                if s:
+                    u["staged"] = True
+                p = previous.get(remote)
+                if p and p.get("state") == SUCCEEDED:
+                    u = p
+                elif p and p.get("session") and p["size"] == u["size"]:
+                    u.update({"session": p["session"], "bytes": p["session"]["offset"]})
+                uploads.append(u)
+            with self.lock:
+                data["completed_uploads"] = uploads
+            self._save(RequestType.UPLOAD, file)
+
+            storage = self.get_storage_client()
+            futures = [
+                self.upload_executor.submit(
+                    self._upload_file, file, artifact, storage, u, manifest.get(os.path.basename(u["to"]))
+                )
+                for u in uploads
+                if u["state"] != SUCCEEDED
+            ]
+            wait(futures)
+            self._check_cancelled(RequestType.UPLOAD, file)
+            for future in futures:
+                # Raise the first error
+                future.result()
         except Exception as ex:
-            self.task_state[RequestType.UPLOAD, file].success = False
-            self.task_state[RequestType.UPLOAD, file].exception = ex
+            self._finish(RequestType.UPLOAD, file, ex)
             return
-        
-        self.task_state[RequestType.UPLOAD, file].success = True
+
+        for s in staged.values():
+            try:
+                storage.delete(s["to"])
+            except Exception as ex:
+                log.warning(f"ReleaseCreator.staged_delete_failed | remote='{s['to']}' | ex='{ex!r}'")
+        self._finish(RequestType.UPLOAD, file)
+
+    def _upload_file(
+        self,
+        file: str,
+        artifact: t.Optional[Artifact],
+        storage,
+        upload: dict,
+        manifest_entry: t.Optional[dict],
+        request_type: RequestType = RequestType.UPLOAD,
+    ):
+        """Upload one file of an `UPLOAD` request (or stage it for a `PREVIEW`) with retries, and track its state
+        in `upload`. Skip it if the object in cloud storage matches its manifest entry. When the task has been
+        cancelled, the file isn't uploaded, and its state is `cancelled`.
+        """
+        def on_attempt(attempt):
+            with self.lock:
+                upload.update({"state": RUNNING, "attempts": attempt})
+            self._save(request_type, file)
+
+        try:
+            self._check_cancelled(request_type, file)
+            if manifest_entry is not None:
+                metadata = retry_call(
+                    lambda: storage.metadata(upload["to"]),
+                    is_transient,
+                    self.upload_max_attempts,
+                    description=upload["to"],
+                )
+                if is_unchanged(manifest_entry, metadata):
+                    log.info(f"ReleaseCreator.player_file_unchanged | remote='{upload['to']}'")
+                    with self.lock:
+                        upload.update({"state": SUCCEEDED, "unchanged": True})
+                    self._save(request_type, file)
+                    return
+
+            log.info(f"ReleaseCreator.upload_player_file | local='{upload['from']}' | remote='{upload['to']}'")
+            metadata = retry_call(
+                lambda: self._upload(storage, file, artifact, upload, request_type),
+                is_transient,
+                self.upload_max_attempts,
+                on_attempt,
+                description=upload["to"],
+            )
+            if metadata is not None and manifest_entry is not None and not is_unchanged(manifest_entry, metadata):
+                raise AssertionError(f"Uploaded {upload['to']} doesn't match the manifest")
+        except TaskCancelled:
+            with self.lock:
+                upload["state"] = CANCELLED
+            self._save(request_type, file)
+            raise
+        except Exception as ex:
+            with self.lock:
+                upload.update({"state": FAILED, "error": str(ex)})
+            self._save(request_type, file)
+            raise
+        with self.lock:
+            upload.update({"state": SUCCEEDED, "bytes": upload["size"]})
+            upload.pop("session", None)
+        self._save(request_type, file)
+
+    def _upload(
+        self,
+        storage,
+        file: str,
+        artifact: t.Optional[Artifact],
+        upload: dict,
+        request_type: RequestType = RequestType.UPLOAD,
+    ) -> t.Optional[dict]:
+        """Upload a file in one request, or through a resumable upload session when it's large. Staged files are
+        copied within the bucket.
+
+        :return: Metadata of the uploaded object, if known
+        """
+        if upload.get("staged"):
+            return storage.copy(upload["from"], upload["to"])
+        artifact = t.cast(Artifact, artifact)
+
+        def open_file(path):
+            return artifact.open(os.path.basename(path))
+
+        if upload["size"] <= self.upload_chunk_size:
+            if artifact.extracted:
+                storage.upload(upload["from"], upload["to"])
+            else:
+                with open_file(upload["from"]) as f:
+                    storage.upload_file(f, upload["to"], upload["size"])
+            return None
+
+        def on_progress(session):
+            with self.lock:
+                upload.update({"session": session, "bytes": session["offset"]})
+            self._save(request_type, file)
+
+        with self.lock:
+            session = upload.get("session")
+        return storage.upload_resumable(
+            upload["from"],
+            upload["to"],
+            self.upload_chunk_size,
+            session,
+            on_progress,
+            open_file,
+            upload["size"],
+            lambda: self._check_cancelled(request_type, file),
+        )
+
+    @contextmanager
+    def session(self):
+        """Database session for the background steps, committed on success and always closed."""
+        session = self.session_factory()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     def upload_to_ia(self, file, local_dir):
         """Submit a release to archive.org.
@@ -354,33 +1038,80 @@ class ReleaseService:
         INTERNAL. Invoked by `ReleaseService` itself when processing an `IA_UPLOAD` request.        
         
         Archive.org submission is handled by [ArchiveOrgClient](archive_org_client.py) and involves generating
-        archive.org-specific metadata from the release data, and uploading the individual files.
+        archive.org-specific metadata from the release data, and uploading the individual files. No database
+        connection is held during the upload: the release is loaded in one session and updated in another.
+        `data["ia_uploads"]` has an entry per file with its state, like `completed_uploads` of `UPLOAD`.
+        Cancellation is checked between files.
 
         :param file: Release zip file name
         :param local_dir: Temp directory into which release zip was extracted
         """
-        data = self.task_state[RequestType.IA_UPLOAD, file].data
+        data = self._task(RequestType.IA_UPLOAD, file).data
 
         try:
-            engine = engine_from_config(settings, prefix='sqlalchemy.')
-            session = sessionmaker(bind=engine)()
-            release = session.query(models.Release).filter(models.Release.file == file).one()
-            identifier = ArchiveOrgClient().upload_release(release, local_dir)
+            with self.session() as session:
+                release = (
+                    session.query(models.Release)
+                    .options(joinedload(models.Release.release_page))
+                    .filter(models.Release.file == file)
+                    .one()
+                )
+                # Detach the release and its page, with everything `upload_release` needs loaded
+                session.expunge_all()
+            def on_progress(uploads):
+                with self.lock:
+                    data["ia_uploads"] = uploads
+                self._save(RequestType.IA_UPLOAD, file)
+
+            with self.lock:
+                if self.archive_org_client is None:
+                    self.archive_org_client = self.get_archive_org_client()
+                archive_org_client = self.archive_org_client
+            identifier = archive_org_client.upload_release(
+                release,
+                local_dir,
+                on_progress=on_progress,
+                check_cancelled=lambda: self._check_cancelled(RequestType.IA_UPLOAD, file),
+            )
+
+            with self.session() as session:
+                release = session.query(models.Release).filter(models.Release.file == file).one()
+                release.release_data["archive"] = f"https://archive.org/details/{identifier}"
+                flag_modified(release, "release_data")
+                release_id, release_dir = int(release.id), release.release_dir  # type: ignore
+                sync_public_release_page(session, release, settings)
         except Exception as ex:
-            self.task_state[RequestType.IA_UPLOAD, file].success = False
-            self.task_state[RequestType.IA_UPLOAD, file].exception = ex
+            self._finish(RequestType.IA_UPLOAD, file, ex)
             return
-        
-        release.release_data["archive"] = f"https://archive.org/details/{identifier}"
-        flag_modified(release, "release_data")
-        session.add(release)
-        session.commit()
+        get_page_cache().invalidate(release_key(release_dir))
+        purge(release_key(release_dir))
+
+        with self.lock:
+            data.update({
+                "identifier": identifier,
+                "release_id": release_id,
+                "release_dir": release_dir,
+            })
+        self._finish(RequestType.IA_UPLOAD, file)
+        self.queue_next_stages(RequestType.IA_UPLOAD, file, StageArtifacts.from_data(data))
+
+    def warm_up(self, file):
+        """Render the index and the release page into the page cache (see `page_cache.warm_up_release`).
 
-        data.update({
-            "identifier": identifier,
-            "release_id": int(release.id),  # type: ignore
-        })
-        self.task_state[RequestType.IA_UPLOAD, file].success = True
+        INTERNAL. Invoked by `ReleaseService` itself when processing a `WARM_UP` request, which is queued after
+        the release has been committed, and after its archive.org submission has changed the release page.
+
+        :param file: Release zip file name
+        """
+        data = self._task(RequestType.WARM_UP, file).data
+        try:
+            n_pages = self.warm_up_release(data["release_dir"]) if self.warm_up_release else 0
+        except Exception as ex:
+            self._finish(RequestType.WARM_UP, file, ex)
+            return
+        with self.lock:
+            data["n_pages"] = n_pages
+        self._finish(RequestType.WARM_UP, file)
 
     def create_database_objects(self, dbsession, file, page_content, index_record_body):
         """Synchronously insert the rows representing a release into the database.
@@ -392,23 +1123,29 @@ class ReleaseService:
         :param file: Release zip file name
         :param page_content: The view passes the release page content as entered by the user.
         :param index_record_body: The view passes the content of the index page entry as entered by the user.
+        :return: What the stages after the commit are handed (see `queue_stages_on_commit`), including the id
+            of the new release
         """
-        data = self.task_state[RequestType.UPLOAD, file].data
+        task_state = self.task_state[RequestType.UPLOAD, file]
+        data = task_state.data
 
         release = models.Release(
             catalog_no=data["catalog_no"],
             release_dir=data["release_dir"],
             file=data["file"],
             release_data=data["release_data"],
+            manifest=data.get("manifest"),
         )
         dbsession.add(release)
         dbsession.flush()
+        # Not saved to the task store, whose session isn't part of the request's transaction
         data["release_id"] = int(release.id)  # type: ignore
 
         rp = models.ReleasePage(
             release=release,
             content=page_content,
         )
+        rewrite_release_page(rp, settings)
         dbsession.add(rp)
         dbsession.flush()
 
@@ -422,6 +1159,7 @@ class ReleaseService:
             )
             dbsession.add(pf)
         dbsession.flush()
+        sync_public_release_page(dbsession, release, settings)
 
         ymd = data["release_data"]["date"]
         date = dateparser.parse(ymd)
@@ -431,7 +1169,9 @@ class ReleaseService:
             body=index_record_body,
             releases=[release],
         )
+        rewrite_index_record(ir, settings)
         dbsession.add(ir)
+        return StageArtifacts.from_data(data)
 
     def delete_database_objects(self, dbsession, release_id):
         """Synchronously delete the rows representing a release from the database.
@@ -457,6 +1197,8 @@ class ReleaseService:
         )
         index_record_ids = [ir.id for ir in q]
 
+        delete_public_release_page(dbsession, release.release_dir)
+
         release.index_records = []
         dbsession.flush()
         dbsession.query(models.IndexRecord).filter(models.IndexRecord.id.in_(index_record_ids)).delete()
@@ -467,6 +1209,64 @@ class ReleaseService:
 
         dbsession.delete(release)
 
+def queue_stages_on_commit(request, file: str, artifacts: StageArtifacts):
+    """Queue the stages that follow the commit of a release (see `NEXT_STAGES`) once the request's transaction
+    has been committed successfully, so they find the release's rows.
+    """
+    release_service = get_release_service()
+
+    def hook(success):
+        if success:
+            release_service.queue_next_stages(COMMIT, file, artifacts)
+
+    request.tm.get().addAfterCommitHook(hook)
+
+
 @cached(cache={}, key=lambda: "🕉")
 def get_release_service():
-    return ReleaseService()
+    registry = get_current_registry()
+    settings = registry.settings
+    task_store = TaskStore(
+        registry["dbsession_factory"],
+        int(settings.get("release_service_stale_task_secs", DEFAULT_STALE_TASK_SECS)),
+        int(settings.get("release_service_task_ttl_secs", DEFAULT_TASK_TTL_SECS)),
+        int(settings.get("release_service_max_tasks", DEFAULT_MAX_TASKS)),
+        int(settings.get("release_service_max_queued", DEFAULT_MAX_QUEUED)),
+    )
+    janitor = TmpJanitor(
+        task_store,
+        settings["tmp_directory"],
+        int(settings.get("tmp_directory_max_bytes", DEFAULT_TMP_DIRECTORY_MAX_BYTES)),
+    )
+    artifact_cache = ArtifactCache(
+        settings["tmp_directory"],
+        settings["static_base"],
+        get_storage_client,
+        int(settings.get("zip_max_uncompressed_bytes", DEFAULT_MAX_UNCOMPRESSED_BYTES)),
+        int(settings.get("zip_max_members", DEFAULT_MAX_MEMBERS)),
+    )
+    audio_probe = AudioProbe(
+        settings["tmp_directory"],
+        int(settings.get("audio_probe_workers", DEFAULT_AUDIO_PROBE_WORKERS)),
+    )
+    return ReleaseService(
+        task_store,
+        janitor,
+        artifact_cache,
+        audio_probe,
+        registry["dbsession_factory"],
+        get_storage_client,
+        get_archive_org_client,
+        int(settings.get("release_service_workers", DEFAULT_WORKERS)),
+        int(settings.get("upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY)),
+        int(settings.get("upload_max_attempts", DEFAULT_UPLOAD_MAX_ATTEMPTS)),
+        int(settings.get("upload_chunk_size", DEFAULT_UPLOAD_CHUNK_SIZE)),
+        asbool(settings.get("release_zip_streaming", False)),
+        asbool(settings.get("release_pipeline", False)),
+        int(settings.get("release_pipeline_queue_size", DEFAULT_PIPELINE_QUEUE_SIZE)),
+        [
+            RequestType[name.upper()]
+            for name in aslist(settings.get("release_auto_stages", " ".join(s.name.lower() for s in DEFAULT_AUTO_STAGES)))
+        ],
+        lambda release_dir: warm_up_release(registry, release_dir),
+    )
@@ -0,0 +1,53 @@
+"""Retrying calls that fail with transient errors, with exponential backoff and full jitter.
+"""
+import random
+import time
+import typing as t
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY_SECS = 1
+DEFAULT_MAX_DELAY_SECS = 30
+
+T = t.TypeVar("T")
+
+
+def backoff_delay(
+    attempt: int,
+    base: float = DEFAULT_BASE_DELAY_SECS,
+    cap: float = DEFAULT_MAX_DELAY_SECS,
+) -> float:
+    """Get the delay before the next attempt after attempt number `attempt` (starting at 1) has failed.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def retry_call(
+    fn: t.Callable[[], T],
+    is_transient: t.Callable[[Exception], bool],
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    on_attempt: t.Optional[t.Callable[[int], None]] = None,
+    description: str = "",
+) -> T:
+    """Call `fn` until it succeeds, for at most `max_attempts` attempts. Only errors for which `is_transient`
+    is true are retried; other errors, and the error of the last attempt, are raised.
+
+    :param on_attempt: Called with the attempt number before each attempt.
+    """
+    for attempt in range(1, max_attempts + 1):
+        if on_attempt:
+            on_attempt(attempt)
+        try:
+            return fn()
+        except Exception as ex:
+            if attempt == max_attempts or not is_transient(ex):
+                raise
+            delay = backoff_delay(attempt)
+            log.warning(f"retry.retrying | description='{description}' | attempt={attempt} | delay={delay:.1f} | ex='{ex!r}'")
+            time.sleep(delay)
+    raise AssertionError("unreachable")
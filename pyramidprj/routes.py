@@ -13,11 +13,14 @@ def includeme(config):
     config.add_route("commit_release", "/commit_release/")
     config.add_route("request_iaupload", "/request_iaupload/")
     config.add_route("check_iaupload", "/check_iaupload/{file}/")
+    config.add_route("cancel_task", "/cancel_task/{request_type}/{file}/")
+    config.add_route("release_service_status", "/release_service_status/")
 
     config.add_route("release_list", "/releases/")
     config.add_route("Release_list", "/Releases/")
     config.add_route("release_edit", "/edit/{release_id}/")
     config.add_route("update_release", "/update_release/")
+    config.add_route("verify_release", "/verify_release/{release_id}/")
 
     config.add_route("index_record_list", "/index_records/")
     config.add_route("delete_index_record", "/index_records/{index_record_id}/")
@@ -0,0 +1,283 @@
+"""Export the public pages as a static site.
+
+index2.htm and every release page are rendered through the app itself, i.e. through the same views and
+middlewares (link rewriting included) that serve them. The results are written to a local directory tree or to
+the storage bucket, so a plain static file server or the CDN can take the public traffic:
+
+    <output>/index2.htm
+    <output>/Releases/<release_dir>/index.html
+
+(`/static` isn't exported. It is served from */var/www/static* by nginx already, see [DEPLOY.md](../../DEPLOY.md).)
+
+Usage:
+
+    export_pyramidprj_static production.ini --output-dir /var/www/20kbps --base-url http://20kbps.net
+    export_pyramidprj_static production.ini --bucket --prefix site/ --base-url https://20kbps.net
+
+The export is incremental. A hash of each page's source data (database rows, template, rewrite fingerprint and
+base URL) is kept in `export_manifest.json` in the output, and only pages whose hash changed are re-rendered.
+Pages of releases that no longer exist are removed. Use `--full` to re-render everything.
+"""
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import typing as t
+from urllib.parse import quote
+
+from pyramid.paster import bootstrap, setup_logging
+from pyramid.request import Request
+
+from .. import models
+from ..link_rewriter import get_fingerprint
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+MANIFEST_FILE = "export_manifest.json"
+INDEX_PATH = "index2.htm"
+TEMPLATES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(__file__)), "templates")
+
+
+def _hash(*parts) -> str:
+    s = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def _template_hash(name: str) -> str:
+    with open(os.path.join(TEMPLATES_DIRECTORY, name), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def release_page_path(release_dir: str) -> str:
+    return f"Releases/{release_dir}/index.html"
+
+
+class LocalWriter:
+    """Writes pages into a local directory tree. Files are replaced atomically.
+    """
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def _local(self, path: str) -> str:
+        return os.path.join(self.output_dir, *path.split("/"))
+
+    def read(self, path: str) -> t.Optional[bytes]:
+        try:
+            with open(self._local(path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, path: str, data: bytes, content_type: str):
+        local = self._local(path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(local))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, local)
+
+    def delete(self, path: str):
+        try:
+            os.remove(self._local(path))
+        except FileNotFoundError:
+            pass
+
+
+class BucketWriter:
+    """Writes pages into the storage bucket through `StorageClient`.
+    """
+    def __init__(self, prefix: str):
+        # Imported here, because `storage_client` reads the app's settings on import.
+        from ..storage_client import get_storage_client
+        self.storage = get_storage_client()
+        self.prefix = prefix
+
+    def read(self, path: str) -> t.Optional[bytes]:
+        remote = self.prefix + path
+        if not self.storage.exists(remote):
+            return None
+        return self.storage.download_bytes(remote)
+
+    def write(self, path: str, data: bytes, content_type: str):
+        self.storage.upload_bytes(data, self.prefix + path, content_type)
+
+    def delete(self, path: str):
+        remote = self.prefix + path
+        if self.storage.exists(remote):
+            self.storage.delete(remote)
+
+
+def render(app, url_path: str, base_url: t.Optional[str]) -> bytes:
+    res = Request.blank(url_path, base_url=base_url).get_response(app)
+    if res.status_code != 200:
+        raise Exception(f"Rendering '{url_path}' failed (res.status_code={res.status_code})")
+    return res.body
+
+
+def get_pages(dbsession, settings, base_url) -> t.Dict[str, t.Tuple[str, str]]:
+    """Get all public pages with the URL path to render them from and the hash of their source data.
+
+    :return: Dict of output path -> (URL path, source hash)
+    """
+    fingerprint = get_fingerprint(settings)
+
+    index_records = dbsession.query(models.IndexRecord).order_by(models.IndexRecord.id.desc()).all()
+    pages = {
+        INDEX_PATH: (
+            "/index2.htm",
+            _hash(
+                _template_hash("index2.jinja2"), _template_hash("index2_record.jinja2"), fingerprint, base_url,
+                [
+                    (ir.id, ir.date, ir.body, ir.explicit_height, ir.custom_date_section, ir.rewrite_fingerprint)
+                    for ir in index_records
+                ],
+            ),
+        ),
+    }
+
+    release_template_hash = _template_hash("release_page.jinja2")
+    releases = (
+        dbsession.query(models.Release)
+        .join(models.Release.release_page)
+        .filter(models.Release.release_dir.isnot(None))
+    )
+    for r in releases:
+        rp = r.release_page
+        pages[release_page_path(r.release_dir)] = (
+            f"/Releases/{quote(r.release_dir)}/",
+            _hash(
+                release_template_hash, fingerprint, base_url,
+                r.release_dir, r.file, r.catalog_no, r.release_data,
+                rp.content, rp.custom_body, rp.custom_tracklist, rp.rewrite_fingerprint,
+                sorted((pf.number, pf.file, pf.title, pf.duration_secs) for pf in rp.player_files),
+            ),
+        )
+
+    return pages
+
+
+def export(app, pages, writer, base_url=None, full=False, jobs=4, gzip_variants=False) -> t.Tuple[int, int]:
+    """Render and write all pages whose source hash changed since the last export.
+
+    :return: Tuple of the numbers of pages written and deleted
+    """
+    manifest = json.loads(writer.read(MANIFEST_FILE) or b"{}")
+    old_manifest = manifest.get("pages", {})
+    if full or gzip_variants != manifest.get("gzip", False):
+        old_manifest = {path: None for path in old_manifest}
+    new_manifest = {}
+    todo = []
+    for path, (url_path, source_hash) in pages.items():
+        if old_manifest.get(path) == source_hash:
+            new_manifest[path] = source_hash
+        else:
+            todo.append((path, url_path, source_hash))
+
+    def export_page(path, url_path):
+        body = render(app, url_path, base_url)
+        writer.write(path, body, "text/html; charset=utf-8")
+        if gzip_variants:
+            # mtime=0 keeps the output identical for identical pages
+            writer.write(f"{path}.gz", gzip.compress(body, mtime=0), "application/gzip")  # type: ignore
+
+    n_written = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(export_page, path, url_path): (path, source_hash)
+            for path, url_path, source_hash in todo
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path, source_hash = futures[future]
+            try:
+                future.result()
+            except Exception:
+                log.exception(f"export_static.page_failed | path='{path}'")
+                continue
+            new_manifest[path] = source_hash
+            n_written += 1
+            log.info(f"export_static.page_written | path='{path}'")
+
+    deleted = [path for path in old_manifest if path not in pages]
+    for path in deleted:
+        writer.delete(path)
+        writer.delete(f"{path}.gz")
+        log.info(f"export_static.page_deleted | path='{path}'")
+
+    manifest = {"gzip": gzip_variants, "pages": new_manifest}
+    writer.write(MANIFEST_FILE, json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"), "application/json")
+    return n_written, len(deleted)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        '--output-dir',
+        help='Write the pages into this local directory',
+    )
+    target.add_argument(
+        '--bucket',
+        action='store_true',
+        help='Write the pages into the storage bucket (`gcloud_bucket` setting)',
+    )
+    parser.add_argument(
+        '--prefix',
+        default='',
+        help='Object name prefix when writing to the bucket, e.g. "site/"',
+    )
+    parser.add_argument(
+        '--base-url',
+        help='URL the public pages are served under, e.g. "https://20kbps.net". Used for absolute URLs.',
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Re-render all pages, regardless of whether their source data changed',
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=4,
+        help='Number of pages rendered in parallel',
+    )
+    parser.add_argument(
+        '--gzip',
+        action='store_true',
+        help='Also write a precompressed .gz variant of each page',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    with env['request'].tm:
+        pages = get_pages(env['request'].dbsession, env['registry'].settings, args.base_url)
+
+    writer = LocalWriter(args.output_dir) if args.output_dir else BucketWriter(args.prefix)
+    n_written, n_deleted = export(
+        env['app'],
+        pages,
+        writer,
+        base_url=args.base_url,
+        full=args.full,
+        jobs=args.jobs,
+        gzip_variants=args.gzip,
+    )
+    print(f"Exported {len(pages)} pages ({n_written} written, {n_deleted} deleted).")
+    env['closer']()
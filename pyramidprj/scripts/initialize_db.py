@@ -24,6 +24,8 @@ from bs4 import BeautifulSoup
 from php_whisperer import read_raw
 
 from .. import models
+from ..read_model import sync_all_public_release_pages
+from .rewrite_links import rewrite_all
 
 
 LEGACY_HTTPDOCS_DIRECTORY = ""  # set from settings in main
@@ -426,6 +428,8 @@ def main(argv=sys.argv):
         with env['request'].tm:
             dbsession = env['request'].dbsession
             setup_models(dbsession)
+            rewrite_all(dbsession, env["registry"].settings, force=True)
+            sync_all_public_release_pages(dbsession, env["registry"].settings)
     except OperationalError:
         print('''
 Pyramid is having a problem using your SQL database.  The problem
@@ -0,0 +1,69 @@
+"""Run `ReleaseService` workers in a separate process.
+
+Zip extraction, tag parsing and the transfers to cloud storage and archive.org are CPU and GIL heavy. To keep
+them from competing with serving pages, run them in this process instead of the app's:
+
+    # production.ini (app)
+    release_service_workers = 0
+
+    run_pyramidprj_release_worker production.ini
+
+The app and the worker share the task table (see [task_store](../task_store.py)), which is the channel between
+them: the views enqueue requests and read task state from it, the worker claims requests and writes their
+state back. Any number of worker processes can be run, but the app must not run workers of its own against the
+same `tmp_directory` then.
+
+The worker stops gracefully on SIGTERM / SIGINT: requests being processed are given `SHUTDOWN_TIMEOUT_SECS`
+to finish. Requests that are interrupted are queued again once they are stale (`release_service_stale_task_secs`).
+"""
+import argparse
+import signal
+import sys
+import threading
+
+from pyramid.paster import bootstrap, setup_logging
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of worker threads. Overrides the `release_service_workers` setting.',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    settings = env['registry'].settings
+    if args.workers is not None:
+        settings['release_service_workers'] = args.workers
+    if int(settings.get('release_service_workers', 1)) < 1:
+        settings['release_service_workers'] = 1
+
+    # Imported after bootstrapping, because `release_service` reads the app's settings on import.
+    from ..release_service import SHUTDOWN_TIMEOUT_SECS, get_release_service
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    release_service = get_release_service()
+    log.info(f"release_worker.started | workers={len(release_service.threads)}")
+    stop.wait()
+
+    release_service.shutdown(SHUTDOWN_TIMEOUT_SECS)
+    log.info("release_worker.stopped")
+    env['closer']()
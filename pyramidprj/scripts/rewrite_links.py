@@ -0,0 +1,84 @@
+"""Re-rewrite the links in all HTML content stored in the database.
+
+The rewritten form of index records and release pages is computed when they are saved, and is stored with a
+fingerprint of the rewrite rules, `static_base` and the rewriter engine (see [link_rewriter](../link_rewriter.py)).
+Whenever the rules, `static_base` or `link_rewriter_engine` change, run this script to bring the stored rewritten
+content up to date:
+
+    rewrite_pyramidprj_links production.ini
+
+Until it has been run, the `rewrite_links` middleware rewrites the affected pages on-the-fly, as before.
+
+The script also rebuilds the read model of the public release pages (see [read_model](../read_model.py)),
+which holds rewritten content, too.
+"""
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+from .. import models
+from ..link_rewriter import get_fingerprint, rewrite_index_record, rewrite_release_page
+from ..read_model import sync_all_public_release_pages
+
+
+def rewrite_all(dbsession, settings, force=False):
+    """Rewrite all index records and release pages whose fingerprint isn't current.
+
+    :param force: When `True`, rewrite everything regardless of fingerprint.
+
+    :return: Tuple of the numbers of index records and release pages rewritten
+    """
+    fingerprint = get_fingerprint(settings)
+
+    n_index_records = 0
+    for ir in dbsession.query(models.IndexRecord):
+        if force or ir.rewrite_fingerprint != fingerprint:
+            rewrite_index_record(ir, settings)
+            n_index_records += 1
+
+    n_release_pages = 0
+    for rp in dbsession.query(models.ReleasePage):
+        if force or rp.rewrite_fingerprint != fingerprint:
+            rewrite_release_page(rp, settings)
+            n_release_pages += 1
+
+    dbsession.flush()
+    return n_index_records, n_release_pages
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Rewrite all content, even when its fingerprint is current',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        with env['request'].tm:
+            dbsession = env['request'].dbsession
+            n_index_records, n_release_pages = rewrite_all(dbsession, env["registry"].settings, force=args.force)
+            n_public_release_pages = sync_all_public_release_pages(dbsession, env["registry"].settings)
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database. Make sure the database server referred to by the
+"sqlalchemy.url" setting is running, and that the database has been migrated to the latest revision
+with `alembic`.
+            ''')
+        return
+
+    print(f"Rewrote {n_index_records} index records and {n_release_pages} release pages.")
+    print(f"Rebuilt {n_public_release_pages} public release pages.")
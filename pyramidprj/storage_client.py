@@ -1,30 +1,249 @@
+"""Client for the cloud storage bucket that holds release zips and release directories.
+
+Resumable uploads:
+    `upload_resumable` uploads a file in chunks of `upload_chunk_size` bytes (a multiple of 256 KiB) through a
+    GCS resumable upload session. After every chunk, it reports the session (URI and committed offset) to the
+    caller, which persists it in the task state. An upload that is interrupted, even by a restart of the worker,
+    continues from the offset the server has committed when it is called again with the persisted session.
+    Sessions that have expired (after a week) are replaced by new ones.
+
+    Files don't have to be on disk: `upload_file` and `upload_resumable` (with `open_file`) read from file
+    objects, e.g. over the members of a release zip.
+
+    The protocol is implemented by `ResumableUploadMixin` on top of two primitives, `create_upload_session`
+    and `put_chunk`, which the [fake storage backend](fake_storage.py) implements as well.
+
+The backend is selected by the `storage_backend` setting: `gcs` (default) or `fake`. A single client is shared
+by all threads (see `get_storage_client`); its HTTP connections are pooled.
+"""
+import abc
+import mimetypes
+import os
+import threading
+import typing as t
+
+import requests
 from cachetools import cached
+from google.api_core import exceptions as api_exceptions
+from google.auth.exceptions import TransportError
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
 from google.oauth2 import service_account
 from pyramid.threadlocal import get_current_registry
+from requests.adapters import HTTPAdapter
+
+import logging
 
 
+log = logging.getLogger(__name__)
+
 settings = get_current_registry().settings
 
 
-class StorageClient:
+# Errors worth retrying: rate limiting, server errors and network failures
+TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    requests.ConnectionError,
+    requests.Timeout,
+    TransportError,
+    ConnectionError,
+)
+
+
+def is_transient(ex: Exception) -> bool:
+    return isinstance(ex, TRANSIENT_ERRORS)
+
+
+# Chunks of resumable uploads must be multiples of this, except for the last one
+CHUNK_GRANULARITY = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_GRANULARITY  # 8 MiB
+CHUNK_TIMEOUT = (10, 120)
+
+# Connections kept per host, enough for `upload_concurrency` uploads plus downloads
+HTTP_POOL_SIZE = 16
+
+
+def _pooled(session: requests.Session) -> requests.Session:
+    session.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+    return session
+
+
+class UploadSessionExpired(Exception):
+    pass
+
+
+def _get_metadata(blob) -> dict:
+    return {
+        "size": blob.size,
+        "generation": blob.generation,
+        "md5": blob.md5_hash,
+        "crc32c": blob.crc32c,
+    }
+
+
+def _get_metadata_from_resource(resource: t.Mapping[str, t.Any]) -> dict:
+    return {
+        "size": int(resource["size"]),
+        "generation": int(resource["generation"]),
+        "md5": resource.get("md5Hash"),
+        "crc32c": resource.get("crc32c"),
+    }
+
+
+def _open(path: str) -> t.ContextManager[t.BinaryIO]:
+    return open(path, "rb")
+
+
+def get_chunk_size(chunk_size: int) -> int:
+    """Round a chunk size down to a multiple of `CHUNK_GRANULARITY` (at least one)."""
+    return max(CHUNK_GRANULARITY, chunk_size - chunk_size % CHUNK_GRANULARITY)
+
+
+class ResumableUploadMixin(abc.ABC):
+    """Client side of the resumable upload protocol.
+
+    Implementations provide:
+      - `create_upload_session(remote, size, content_type) -> str`: start a session, return its URI
+      - `put_chunk(uri, data, start, size) -> (offset, metadata)`: send `data` as the bytes starting at `start`,
+        or only query the session when `start` is `None`. Return the committed offset and, when the upload is
+        complete, the object's metadata (else `None`). Raise `UploadSessionExpired` for unknown sessions.
+    """
+    @abc.abstractmethod
+    def create_upload_session(self, remote: str, size: int, content_type: t.Optional[str]) -> str:
+        ...
+
+    @abc.abstractmethod
+    def put_chunk(self, uri: str, data: bytes, start: t.Optional[int], size: int) -> t.Tuple[int, t.Optional[dict]]:
+        ...
+
+    def upload_resumable(
+        self,
+        local: str,
+        remote: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        session: t.Optional[dict] = None,
+        on_progress: t.Optional[t.Callable[[dict], None]] = None,
+        open_file: t.Callable[[str], t.ContextManager[t.BinaryIO]] = _open,
+        size: t.Optional[int] = None,
+        check_cancelled: t.Optional[t.Callable[[], None]] = None,
+    ) -> dict:
+        """Upload a file in chunks, resuming the given session if possible.
+
+        :param session: `{"uri": ..., "size": ..., "offset": ...}` as last reported to `on_progress`
+        :param on_progress: Called with the session when it is created, and after every chunk
+        :param open_file: Opens `local`, e.g. `Artifact.open` for a zip member. The file is read sequentially.
+        :param size: Size of `local`, when it isn't a file on disk
+        :param check_cancelled: Called before every chunk. Raises to stop the upload; the session can be resumed.
+        :return: Metadata of the uploaded object
+        """
+        chunk_size = get_chunk_size(chunk_size)
+        if size is None:
+            size = os.path.getsize(local)
+        offset, metadata = 0, None
+
+        if session is not None and session.get("size") == size:
+            try:
+                offset, metadata = self.put_chunk(session["uri"], b"", None, size)
+                log.info(f"StorageClient.upload_resumed | remote='{remote}' | offset={offset}")
+            except UploadSessionExpired:
+                session = None
+        else:
+            session = None
+
+        if session is None:
+            content_type, _ = mimetypes.guess_type(remote)
+            session = {"uri": self.create_upload_session(remote, size, content_type), "size": size, "offset": 0}
+            offset = 0
+            if on_progress:
+                on_progress(dict(session))
+
+        with open_file(local) as f:
+            while metadata is None:
+                if check_cancelled:
+                    check_cancelled()
+                f.seek(offset)
+                data = f.read(chunk_size)
+                offset, metadata = self.put_chunk(session["uri"], data, offset, size)
+                session["offset"] = offset
+                if on_progress:
+                    on_progress(dict(session))
+        return metadata
+
+
+class StorageClient(ResumableUploadMixin):
     def __init__(self):
         credentials = service_account.Credentials.from_service_account_file(
-            settings["gcloud_service_account_key"]
+            settings["gcloud_service_account_key"], scopes=storage.Client.SCOPE
         )
-        self.client = storage.Client(credentials=credentials)
+        self.client = storage.Client(credentials=credentials, _http=_pooled(AuthorizedSession(credentials)))
         self.bucket = self.client.get_bucket(settings["gcloud_bucket"])
+        # For the chunks of resumable uploads. Session URIs are authorized by themselves.
+        self.http = _pooled(requests.Session())
 
     def upload(self, local: str, remote: str):
         self.bucket.blob(remote).upload_from_filename(local)
+
+    def upload_bytes(self, data: bytes, remote: str, content_type: str):
+        self.bucket.blob(remote).upload_from_string(data, content_type=content_type)
+
+    def upload_file(self, f: t.BinaryIO, remote: str, size: int):
+        content_type, _ = mimetypes.guess_type(remote)
+        self.bucket.blob(remote).upload_from_file(f, size=size, content_type=content_type)
+
+    def download_bytes(self, remote: str) -> bytes:
+        return self.bucket.blob(remote).download_as_bytes()
     
     def delete(self, remote: str):
         self.bucket.delete_blob(remote)
 
+    def copy(self, src: str, dst: str) -> dict:
+        """Copy an object within the bucket, without downloading it. Return the copy's metadata."""
+        blob = self.bucket.copy_blob(self.bucket.blob(src), self.bucket, dst)
+        return _get_metadata(blob)
+
     def exists(self, remote: str):
         return self.bucket.blob(remote).exists()
 
+    def metadata(self, remote: str) -> t.Optional[dict]:
+        """Get the size, generation and checksums (base64) of an object. `None` if it doesn't exist.
+        """
+        blob = self.bucket.get_blob(remote)
+        if blob is None:
+            return None
+        return _get_metadata(blob)
+
+    def list_metadata(self, prefix: str) -> t.Dict[str, dict]:
+        """Get the metadata (see `metadata`) of all objects whose names start with `prefix`, by name.
+        """
+        return {blob.name: _get_metadata(blob) for blob in self.client.list_blobs(self.bucket, prefix=prefix)}
+
+    def create_upload_session(self, remote: str, size: int, content_type: t.Optional[str]) -> str:
+        return self.bucket.blob(remote).create_resumable_upload_session(content_type=content_type, size=size)
+
+    def put_chunk(self, uri: str, data: bytes, start: t.Optional[int], size: int) -> t.Tuple[int, t.Optional[dict]]:
+        if start is None:
+            content_range = f"bytes */{size}"
+        else:
+            content_range = f"bytes {start}-{start + len(data) - 1}/{size}"
+        res = self.http.put(uri, data=data, headers={"Content-Range": content_range}, timeout=CHUNK_TIMEOUT)
+        if res.status_code in (200, 201):
+            return size, _get_metadata_from_resource(res.json())
+        if res.status_code == 308:
+            # "Range: bytes=0-<last committed byte>", absent when nothing has been committed
+            committed = res.headers.get("Range")
+            return (int(committed.split("-")[1]) + 1 if committed else 0), None
+        if res.status_code in (404, 410):
+            raise UploadSessionExpired(uri)
+        raise api_exceptions.from_http_response(res)
+
 
-@cached(cache={}, key=lambda: "🕉")
+@cached(cache={}, key=lambda: "🕉", lock=threading.Lock())
 def get_storage_client():
+    if settings.get("storage_backend", "gcs") == "fake":
+        from .fake_storage import FakeStorageClient
+        return FakeStorageClient(settings["fake_storage_directory"])
     return StorageClient()
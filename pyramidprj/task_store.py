@@ -0,0 +1,446 @@
+"""Database-backed state of `ReleaseService` tasks, shared by all app processes.
+
+Each request enqueued with `ReleaseService.request_*` is a row in the `task` table (see `models.Task`), keyed
+by request type and release zip file. Workers claim queued tasks with `SELECT ... FOR UPDATE SKIP LOCKED`, and
+claims for the same file are serialized (with an advisory lock on PostgreSQL), so any number of processes can
+run workers against the same table, and views read the task state from the table no matter which process is
+processing the request. Queued tasks survive restarts. Each claim of a task gets a token, and the worker's
+updates only apply while the task is still `running` under that claim (see `TaskStore.save`). Workers send
+heartbeats for their running tasks (see `TaskStore.heartbeat`), independently of their progress. Tasks that are
+`running` but haven't been updated for `release_service_stale_task_secs` (default 1800) are assumed to belong to
+a worker that died, and are queued again.
+
+Queued tasks are claimed by priority class, then in the order they were queued (see `Priority`): interactive
+previews and uploads go ahead of page cache warm-ups, which go ahead of archive.org submissions. A request is
+not queued again while the same request (type and file) is queued or running, and no more than
+`release_service_max_queued` (default 100) tasks are queued at a time; `enqueue` raises `QueueFull` beyond
+that, and views answer `503 Service Unavailable`. Queue depth and wait times per class are reported by
+`queue_stats`.
+
+Tasks can be cancelled (see `TaskStore.cancel`). A queued task is `cancelled` right away. For a running task,
+`cancel_requested` is set, which its worker checks between chunks and files (see `ReleaseService.cancel`); the
+worker then stops and marks the task `cancelled`.
+
+The task history is bounded (see `TaskStore.prune`): finished tasks are deleted once they are older than
+`release_service_task_ttl_secs` (default 7 days), and only the latest `release_service_max_tasks` (default 1000)
+finished tasks are kept.
+
+`TaskStore` is a mapping of (`RequestType`, file) -> `TaskState`, so views use it just like the dict it
+replaced.
+"""
+import traceback
+import typing as t
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from enum import IntEnum
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import models
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_STALE_TASK_SECS = 1800
+DEFAULT_TASK_TTL_SECS = 7 * 24 * 3600
+DEFAULT_MAX_TASKS = 1000
+DEFAULT_MAX_QUEUED = 100
+# Window of the mean wait times reported by `TaskStore.queue_stats`
+WAIT_STATS_WINDOW_SECS = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class RequestType(IntEnum):
+    PREVIEW = 0
+    UPLOAD = 1
+    IA_UPLOAD = 2  # Internet Archive upload
+    WARM_UP = 3  # Page cache warm-up
+
+
+class Priority(IntEnum):
+    """Priority classes of requests. Lower values are claimed first."""
+    INTERACTIVE = 0  # The admin is waiting for it
+    BULK = 1
+    ARCHIVE = 2  # Archive.org submissions, which take long
+
+
+PRIORITY = {
+    RequestType.PREVIEW: Priority.INTERACTIVE,
+    RequestType.UPLOAD: Priority.INTERACTIVE,
+    RequestType.WARM_UP: Priority.BULK,
+    RequestType.IA_UPLOAD: Priority.ARCHIVE,
+}
+
+
+@dataclass(slots=True)
+class QueuedRequest:
+    request_type: RequestType
+    file: t.Optional[str] = None
+    data: t.Optional[dict] = None
+    claim_token: t.Optional[str] = None  # Set by `TaskStore.claim`
+
+
+class TaskError(Exception):
+    """The error of a failed task, as read back from the database."""
+
+
+class QueueFull(Exception):
+    """Too many tasks are queued (`release_service_max_queued`)."""
+
+
+class TaskCancelled(Exception):
+    """Raised in a worker when its task has been cancelled."""
+
+    def __init__(self, message: str = "The task has been cancelled"):
+        super().__init__(message)
+
+
+@dataclass(slots=True)
+class TaskState:
+    success: t.Optional[bool] = None  # None = pending
+    data: dict = field(default_factory=dict)
+    exception: t.Optional[Exception] = None
+    cancelled: bool = False  # Implies `success == False`
+
+    def serialize(self) -> dict:
+        return {
+            "success": self.success,
+            "data": self.data,
+            "exception":self.exception,
+            "cancelled": self.cancelled,
+        }
+
+
+def _format_exception(ex: Exception) -> str:
+    return "".join(traceback.format_exception_only(type(ex), ex)).strip()
+
+
+def _to_task_state(task: models.Task) -> TaskState:
+    return TaskState(
+        success={SUCCEEDED: True, FAILED: False, CANCELLED: False}.get(task.state),  # type: ignore
+        data=dict(task.data or {}),  # type: ignore
+        exception=TaskError(task.exception) if task.exception else None,
+        cancelled=task.state == CANCELLED,
+    )
+
+
+class TaskStore:
+    def __init__(
+        self,
+        session_factory,
+        stale_task_secs: int = DEFAULT_STALE_TASK_SECS,
+        task_ttl_secs: int = DEFAULT_TASK_TTL_SECS,
+        max_tasks: int = DEFAULT_MAX_TASKS,
+        max_queued: int = DEFAULT_MAX_QUEUED,
+    ):
+        self.session_factory = session_factory
+        self.stale_task_secs = stale_task_secs
+        self.task_ttl_secs = task_ttl_secs
+        self.max_tasks = max_tasks
+        self.max_queued = max_queued
+
+    @contextmanager
+    def session(self):
+        session = self.session_factory()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _filter(self, query, key: t.Tuple[RequestType, str]):
+        request_type, file = key
+        return query.filter(models.Task.request_type == int(request_type), models.Task.file == file)
+
+    def get(self, key: t.Tuple[RequestType, str], default=None) -> t.Optional[TaskState]:
+        with self.session() as session:
+            task = self._filter(session.query(models.Task), key).one_or_none()
+            return _to_task_state(task) if task is not None else default
+
+    def __getitem__(self, key: t.Tuple[RequestType, str]) -> TaskState:
+        task_state = self.get(key)
+        if task_state is None:
+            raise KeyError(key)
+        return task_state
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __delitem__(self, key: t.Tuple[RequestType, str]):
+        self.delete(key)
+
+    def delete(self, key: t.Tuple[RequestType, str], session=None):
+        """Delete a task.
+
+        :param session: Delete it in this session's transaction, e.g. the request's, so it is only deleted if
+            that transaction commits. By default, it is deleted right away.
+        """
+        if session is not None:
+            self._filter(session.query(models.Task), key).delete(synchronize_session=False)
+            return
+        with self.session() as session:
+            self._filter(session.query(models.Task), key).delete()
+
+    def enqueue(self, req: QueuedRequest, bounded: bool = True) -> bool:
+        """Queue a request. Replaces the finished task of an earlier request of the same type for the same file.
+
+        :param bounded: Raise `QueueFull` when `max_queued` tasks are queued already. The bound is checked
+            before inserting, so concurrent requests may exceed it slightly.
+        :return: `False` when the same request is queued or running already, and nothing has been queued
+        """
+        key = (req.request_type, t.cast(str, req.file))
+        try:
+            with self.session() as session:
+                task = self._filter(session.query(models.Task), key).with_for_update().one_or_none()
+                if task is not None and task.state not in FINISHED_STATES:
+                    log.info(f"TaskStore.duplicate_request | request_type={req.request_type!r} | file='{req.file}' | state={task.state}")
+                    return False
+                if bounded:
+                    n_queued = session.query(func.count(models.Task.id)).filter(models.Task.state == QUEUED).scalar()
+                    if n_queued >= self.max_queued:
+                        log.warning(f"TaskStore.queue_full | request_type={req.request_type!r} | file='{req.file}' | n_queued={n_queued}")
+                        raise QueueFull(f"{n_queued} tasks are queued")
+                if task is not None:
+                    session.delete(task)
+                    session.flush()
+                session.add(models.Task(
+                    request_type=int(req.request_type),
+                    file=req.file,
+                    state=QUEUED,
+                    priority=int(PRIORITY[req.request_type]),
+                    payload=req.data,
+                    data={},
+                ))
+        except IntegrityError:
+            # The same request has been queued concurrently (unique request type and file).
+            log.info(f"TaskStore.duplicate_request | request_type={req.request_type!r} | file='{req.file}' | state=queued")
+            return False
+        return True
+
+    def claim(self, exclude_files: t.Iterable[str] = ()) -> t.Optional[QueuedRequest]:
+        """Take the oldest queued task of the highest priority class for a file that has no running task, and mark
+        it `running`.
+        """
+        with self.session() as session:
+            running_files = select(models.Task.file).where(models.Task.state == RUNNING)
+            task = (
+                session.query(models.Task)
+                .filter(
+                    models.Task.state == QUEUED,
+                    models.Task.file.not_in(running_files),
+                    models.Task.file.not_in(list(exclude_files)),
+                )
+                .order_by(models.Task.priority, models.Task.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .one_or_none()
+            )
+            if task is None:
+                return None
+            if session.get_bind().dialect.name == "postgresql":
+                # FOR UPDATE only locks the candidate row, so claims of other tasks for the same file aren't
+                # excluded by the subquery above. Serialize claims per file until the transaction ends.
+                session.execute(select(func.pg_advisory_xact_lock(func.hashtext(task.file))))
+            # Conditional, because databases without row locks (SQLite) ignore FOR UPDATE.
+            now = datetime.utcnow()
+            claim_token = uuid.uuid4().hex
+            claimed = session.execute(
+                update(models.Task)
+                .where(models.Task.id == task.id, models.Task.state == QUEUED)
+                .values(state=RUNNING, claim_token=claim_token, started_at=now, updated_at=now)
+            ).rowcount
+            if not claimed:
+                return None
+            # Another task for the file may have been claimed since the candidate was selected
+            if (
+                session.query(models.Task.id)
+                .filter(models.Task.file == task.file, models.Task.state == RUNNING, models.Task.id != task.id)
+                .first()
+            ):
+                session.rollback()
+                return None
+            wait = (now - task.created_at).total_seconds() if task.created_at else 0
+            log.info(f"TaskStore.claimed | request_type={RequestType(task.request_type)!r} | file='{task.file}' | priority={task.priority} | wait_secs={wait:.1f}")
+            return QueuedRequest(RequestType(task.request_type), task.file, task.payload, claim_token)  # type: ignore
+
+    def save(self, key: t.Tuple[RequestType, str], task_state: TaskState, claim_token: str) -> bool:
+        """Write a task's state back while it is running or when it has finished.
+
+        :param claim_token: Token of the worker's claim (`QueuedRequest.claim_token`)
+        :return: `False` if nothing was written, because the task is no longer running under that claim. It has
+            been taken for stale and queued again, or deleted. The worker should stop processing it.
+        """
+        values: t.Dict[str, t.Any] = {"data": task_state.data, "updated_at": datetime.utcnow()}
+        if task_state.success is not None:
+            values.update({
+                "state": CANCELLED if task_state.cancelled else SUCCEEDED if task_state.success else FAILED,
+                "exception": _format_exception(task_state.exception) if task_state.exception else None,
+                "finished_at": datetime.utcnow(),
+            })
+        with self.session() as session:
+            request_type, file = key
+            return session.execute(
+                update(models.Task)
+                .where(
+                    models.Task.request_type == int(request_type),
+                    models.Task.file == file,
+                    models.Task.state == RUNNING,
+                    models.Task.claim_token == claim_token,
+                )
+                .values(**values)
+            ).rowcount > 0
+
+    def heartbeat(self, keys: t.Iterable[t.Tuple[RequestType, str]]):
+        """Mark running tasks as alive, so they aren't taken for stale while their worker is busy with a long step
+        that reports no progress.
+        """
+        now = datetime.utcnow()
+        with self.session() as session:
+            for key in keys:
+                self._filter(session.query(models.Task), key).filter(models.Task.state == RUNNING).update(
+                    {"updated_at": now}, synchronize_session=False
+                )
+
+    def cancel(self, key: t.Tuple[RequestType, str]) -> t.Optional[str]:
+        """Cancel a task: a queued one right away, a running one by requesting its worker to stop.
+
+        :return: The state the task was in: `queued` (it is `cancelled` now), `running` (its worker has been
+            requested to stop), or a finished state (it is left as is). `None` when there is no such task.
+        """
+        now = datetime.utcnow()
+        with self.session() as session:
+            query = self._filter(session.query(models.Task), key)
+            if query.filter(models.Task.state == QUEUED).update(
+                {"state": CANCELLED, "finished_at": now}, synchronize_session=False
+            ):
+                return QUEUED
+            if query.filter(models.Task.state == RUNNING).update(
+                {"cancel_requested": True}, synchronize_session=False
+            ):
+                return RUNNING
+            task = query.one_or_none()
+            return task.state if task is not None else None  # type: ignore
+
+    def is_cancel_requested(self, key: t.Tuple[RequestType, str]) -> bool:
+        with self.session() as session:
+            return bool(self._filter(session.query(models.Task.cancel_requested), key).scalar())
+
+    def requeue_stale(self) -> int:
+        """Queue the running tasks of dead workers again, or mark them `cancelled` if they were being cancelled.
+        """
+        deadline = datetime.utcnow() - timedelta(seconds=self.stale_task_secs)
+        stale = (models.Task.state == RUNNING, models.Task.updated_at < deadline)
+        with self.session() as session:
+            session.query(models.Task).filter(*stale, models.Task.cancel_requested).update(
+                {"state": CANCELLED, "finished_at": datetime.utcnow()}, synchronize_session=False
+            )
+            n = (
+                session.query(models.Task)
+                .filter(*stale)
+                .update({"state": QUEUED, "started_at": None}, synchronize_session=False)
+            )
+        if n:
+            log.warning(f"TaskStore.requeued_stale_tasks | n={n}")
+        return n
+
+    def prune(self) -> int:
+        """Delete finished tasks that have expired, and the oldest finished tasks beyond `max_tasks`.
+
+        Queued and running tasks are never deleted.
+        """
+        deadline = datetime.utcnow() - timedelta(seconds=self.task_ttl_secs)
+        finished = models.Task.state.in_(FINISHED_STATES)
+        with self.session() as session:
+            n = (
+                session.query(models.Task)
+                .filter(finished, models.Task.finished_at < deadline)
+                .delete(synchronize_session=False)
+            )
+            excess_ids = [
+                task_id
+                for (task_id,) in (
+                    session.query(models.Task.id)
+                    .filter(finished)
+                    .order_by(models.Task.finished_at.desc(), models.Task.id.desc())
+                    .offset(self.max_tasks)
+                )
+            ]
+            if excess_ids:
+                n += (
+                    session.query(models.Task)
+                    .filter(models.Task.id.in_(excess_ids))
+                    .delete(synchronize_session=False)
+                )
+        if n:
+            log.info(f"TaskStore.pruned | n={n}")
+        return n
+
+    def states_by_file(self) -> t.Dict[str, t.Dict[RequestType, str]]:
+        """Get the states of all tasks, as file -> request type -> state.
+        """
+        states: t.Dict[str, t.Dict[RequestType, str]] = {}
+        with self.session() as session:
+            for request_type, file, state in session.query(
+                models.Task.request_type, models.Task.file, models.Task.state
+            ):
+                states.setdefault(file, {})[RequestType(request_type)] = state
+        return states
+
+    def count_by_state(self) -> t.Dict[str, int]:
+        with self.session() as session:
+            return dict(
+                session.query(models.Task.state, func.count(models.Task.id))
+                .group_by(models.Task.state)
+                .all()
+            )
+
+    def queue_stats(self) -> t.Dict[str, dict]:
+        """Get the queue depth and wait times per priority class, as class name ->
+        `{"queued": int, "running": int, "oldest_wait_secs": float, "mean_wait_secs": float}`.
+
+        `oldest_wait_secs` is how long the oldest queued task has been waiting, `mean_wait_secs` the mean time
+        tasks started in the last `WAIT_STATS_WINDOW_SECS` have waited for a worker.
+        """
+        now = datetime.utcnow()
+        stats = {
+            priority.name.lower(): {"queued": 0, "running": 0, "oldest_wait_secs": 0.0, "mean_wait_secs": 0.0}
+            for priority in Priority
+        }
+        waits: t.Dict[str, t.List[float]] = {name: [] for name in stats}
+        with self.session() as session:
+            for priority, state, n, oldest in (
+                session.query(
+                    models.Task.priority, models.Task.state, func.count(models.Task.id), func.min(models.Task.created_at)
+                )
+                .filter(models.Task.state.in_((QUEUED, RUNNING)))
+                .group_by(models.Task.priority, models.Task.state)
+            ):
+                class_stats = stats[Priority(priority).name.lower()]
+                class_stats[state] = n
+                if state == QUEUED and oldest is not None:
+                    class_stats["oldest_wait_secs"] = round((now - oldest).total_seconds(), 1)
+            for priority, created_at, started_at in (
+                session.query(models.Task.priority, models.Task.created_at, models.Task.started_at)
+                .filter(models.Task.started_at >= now - timedelta(seconds=WAIT_STATS_WINDOW_SECS))
+            ):
+                if created_at is not None:
+                    waits[Priority(priority).name.lower()].append((started_at - created_at).total_seconds())
+        for name, w in waits.items():
+            if w:
+                stats[name]["mean_wait_secs"] = round(sum(w) / len(w), 1)
+        return stats
@@ -0,0 +1,178 @@
+"""Cleanup of the release zips and extraction directories in `tmp_directory`.
+
+Processing a release leaves its zip and the directory it was extracted into in the
+[artifact cache](artifact_cache.py). The janitor deletes them once they aren't needed anymore, judging by the
+release's tasks (see [task_store](task_store.py)):
+  - never while a task for the release zip is queued or running
+  - when there are no tasks for it anymore, i.e. they have expired or the release was committed and the task
+    history was pruned
+  - when its preview has failed or has been cancelled (a new preview downloads the zip again)
+  - when its archive.org upload has finished, which is the last step of the pipeline
+
+Other artifacts are kept, because the upload step needs them, and the archive.org upload reuses them.
+
+On top of this, the total size of `tmp_directory` is kept under `tmp_directory_max_bytes` (default 5 GiB) by
+deleting the artifacts of idle releases, least recently used first. Artifacts of releases that are being
+processed are never deleted, so the budget can be exceeded while they are.
+
+The janitor runs in the processes that run `ReleaseService` workers, after every request and every
+`JANITOR_INTERVAL_SECS`. Its own process doesn't start requests while it sweeps. Other worker processes
+sharing the `tmp_directory` might, so preferably run a single worker process per `tmp_directory`. `usage`
+reports the current size, also to processes without workers (e.g. for the `release_service_status` view), as
+long as they see the same `tmp_directory`.
+
+Other entries in `tmp_directory` (e.g. left over from before the artifact cache) are treated like the artifacts
+of the release zip with the same stem, except for hidden ones (e.g. the [audio probe](audio_probe.py) cache).
+"""
+import os
+import shutil
+import typing as t
+from dataclasses import dataclass, field
+
+from .artifact_cache import ARTIFACTS_DIRECTORY
+from .task_store import CANCELLED, FAILED, FINISHED_STATES, RequestType, TaskStore
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024 * 1024
+
+# How often the janitor runs when no requests are being processed
+JANITOR_INTERVAL_SECS = 300
+
+
+@dataclass(slots=True)
+class Artifacts:
+    """The temp files of one release zip file."""
+    file: str
+    paths: t.List[str] = field(default_factory=list)
+    size: int = 0
+    mtime: float = 0
+
+
+def _get_size(path: str) -> t.Tuple[int, float]:
+    """Get the total size and the latest modification time of a file or directory tree (including the
+    directories, which the artifact cache touches when it uses them).
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+    size, mtime = 0, os.stat(path).st_mtime
+    for root, _, files in os.walk(path):
+        try:
+            mtime = max(mtime, os.stat(root).st_mtime)
+        except FileNotFoundError:
+            continue
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+
+def is_done(states: t.Optional[t.Mapping[RequestType, str]]) -> bool:
+    """Decide from the states of a release zip's tasks whether its artifacts are no longer needed.
+    """
+    if not states:
+        return True
+    if any(state not in FINISHED_STATES for state in states.values()):
+        return False
+    if states.get(RequestType.PREVIEW) in (FAILED, CANCELLED):
+        return True
+    return RequestType.IA_UPLOAD in states
+
+
+class TmpJanitor:
+
+    def __init__(self, task_store: TaskStore, tmp_directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.task_store = task_store
+        self.tmp_directory = tmp_directory
+        self.max_bytes = max_bytes
+
+    def artifacts(self) -> t.Dict[str, Artifacts]:
+        """Get the artifacts in `tmp_directory`, by release zip file name.
+        """
+        artifacts: t.Dict[str, Artifacts] = {}
+        artifacts_directory = os.path.join(self.tmp_directory, ARTIFACTS_DIRECTORY)
+        paths = []
+        for directory in (self.tmp_directory, artifacts_directory):
+            try:
+                paths += [os.path.join(directory, name) for name in os.listdir(directory)]
+            except FileNotFoundError:
+                pass
+        for path in paths:
+            name = os.path.basename(path)
+            if path == artifacts_directory or name.startswith("."):
+                continue
+            file = name if name.endswith(".zip") else f"{name}.zip"
+            try:
+                size, mtime = _get_size(path)
+            except FileNotFoundError:
+                continue
+            a = artifacts.setdefault(file, Artifacts(file))
+            a.paths.append(path)
+            a.size += size
+            a.mtime = max(a.mtime, mtime)
+        return artifacts
+
+    def usage(self) -> dict:
+        artifacts = self.artifacts()
+        return {
+            "tmp_directory": self.tmp_directory,
+            "bytes": sum(a.size for a in artifacts.values()),
+            "max_bytes": self.max_bytes,
+            "releases": len(artifacts),
+        }
+
+    def delete(self, a: Artifacts):
+        for path in a.paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        log.info(f"TmpJanitor.deleted | file='{a.file}' | size={a.size}")
+
+    def sweep(self, busy_files: t.Collection[str] = ()) -> t.List[str]:
+        """Delete the artifacts that are no longer needed, then enforce the disk budget.
+
+        :param busy_files: Release zip files that must not be touched, because they are being processed.
+        :return: Release zip files whose artifacts have been deleted
+        """
+        self.task_store.prune()
+        states = self.task_store.states_by_file()
+        artifacts = self.artifacts()
+
+        def is_idle(file):
+            return file not in busy_files and all(
+                state in FINISHED_STATES for state in states.get(file, {}).values()
+            )
+
+        deleted = []
+        for file, a in list(artifacts.items()):
+            if file not in busy_files and is_done(states.get(file)):
+                self.delete(a)
+                deleted.append(file)
+                del artifacts[file]
+
+        size = sum(a.size for a in artifacts.values())
+        if size > self.max_bytes:
+            for a in sorted(artifacts.values(), key=lambda a: a.mtime):
+                if size <= self.max_bytes:
+                    break
+                if not is_idle(a.file):
+                    continue
+                self.delete(a)
+                deleted.append(a.file)
+                size -= a.size
+            if size > self.max_bytes:
+                log.warning(f"TmpJanitor.over_budget | size={size} | max_bytes={self.max_bytes}")
+        return deleted
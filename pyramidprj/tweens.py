@@ -2,7 +2,9 @@
 
 resolve_release (request middleware):
     Check each request for a URL that points to a release page. When it is a release page URL,
-    look up the `Release` object in the database by `release_dir` and attach it to the request.
+    look up the `PublicReleasePage` read model row by `release_dir` and attach it to the request as
+    `public_release_page`. Lookups go through the [release resolver](release_resolver.py), which caches misses
+    in-process.
 
     
 rewrite_links (response middleware):
@@ -10,12 +12,38 @@ rewrite_links (response middleware):
     20kbps_pyramid. These links are rewritten to point to the correct resources. Doing this on-the-fly was a
     design choice that was made in order to preserve legacy documents in their original state, while still
     allowing for them to be patched as needed.
+    Content is also rewritten at write time (see [link_rewriter](link_rewriter.py)). When a view renders only
+    content that has already been rewritten with the current rules, it sets `request.links_rewritten`, and
+    this middleware leaves the response alone.
+
+
+page_cache (tween):
+    Serve index2.htm and release pages from the in-process [page cache](page_cache.py). Sits between the
+    request and the response middlewares, so it sees the resolved release page and caches the rewritten
+    response. Entries are stored per ETag set by the conditional_response tween, i.e. per content version.
+
+
+conditional_response (tween):
+    Add validators, Cache-Control and surrogate key headers to index2.htm and release pages, and answer
+    conditional requests for them with `304 Not Modified` without rendering (see [http_cache](http_cache.py)).
+    Sits over the page cache tween.
 """
-from urllib.parse import unquote, urlparse, urlunparse
+from urllib.parse import unquote
 
-from bs4 import BeautifulSoup
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.interfaces import IRoutesMapper
+from sqlalchemy.sql.expression import func
 
 from pyramidprj import models
+from pyramidprj.http_cache import is_not_modified, make_etag, set_cache_headers
+from pyramidprj.page_cache import INDEX_KEY, get_page_cache, release_key
+from pyramidprj.release_resolver import get_release_resolver
+from pyramidprj.link_rewriter import (  # noqa: F401 (re-exported)
+    LEGACY_STATIC_FILES,
+    URL_ATTRIBUTES,
+    get_fingerprint,
+    rewrite_document,
+)
 
 import logging
 
@@ -30,101 +58,21 @@ REWRITE_FOR_ROUTES = [
 ]
 
 
-LEGACY_STATIC_FILES = [
-    "ico/yikis.jpg",
-    "fav/rate_fav.ico",
-    "ico/humanstxt-isolated-blank.gif",
-    "ico/rate.ico",
-    "ico/last-icon.jpg",
-    "fav/orgasm.ico",
-    "humans.txt",
-    "Releases/humans.txt",
-    "favicontw.ico",
-    "css/relpage.css",
-    "fav/digg_favicon.ico",
-    "ico/glogo.jpg",
-    "record16.ico",
-    "ico/download.png",
-    "rss.png",
-    "Releases/slow-wave-sleep/elogio-della-follia/ITA Lyrics.pdf",
-    "fav/tumblr_fav.gif",
-    "20kbps.xml",
-    "rss/20kbps.xml",
-    "favicon_myspace.png",
-    "Releases/slow-wave-sleep/elogio-della-follia/ENG Lyrics.pdf",
-    "ico/discogs-icon.jpeg",
-    "fav/mcfav.png",
-]
-
-
-URL_ATTRIBUTES = {
-    "img": ("src",),
-    "a": ("href", "src",),
-    "link": ("href",),
-    "meta": ("content",),
-    "iframe": ("src",),
-}
-
-
 def _get_doc_with_links_rewritten(request, response, registry):
-    # The `resolve_release` middleware has added release to request, if found.
-    release = getattr(request, "release", None)
+    # The `resolve_release` middleware has added the release page to request, if found.
+    page = getattr(request, "public_release_page", None)
 
     try:
         body, encoding = response.body.decode("utf-8"), "utf-8"
     except UnicodeDecodeError:
         body, encoding = response.body.decode("iso-8859-1"), "iso-8859-1"
 
-    static_base = registry.settings['static_base']
-    pr_static_base = urlparse(static_base)
-
-    soup = BeautifulSoup(body, "html5lib")
-    for tag, attrs in URL_ATTRIBUTES.items():
-        elems = soup.find_all(tag)
-        for elem in elems:
-            for attr in attrs:
-                try:
-                    url = elem[attr]
-                except KeyError:
-                    continue
-                pr = urlparse(url)
-
-                # Release pages with `custom_body` (from <release_dir>/index.html)
-                # need their cover URL rewritten to point to static asset storage.
-                if (
-                    release
-                    and (pr.path.endswith("cover.jpg") or pr.path.endswith("cover.png"))
-                    and pr.netloc != pr_static_base.netloc
-                ):
-                    elem[attr] = f"{static_base}/Releases/{release.release_dir}/{pr.path.split('/')[-1]}"
-                    break
-
-                # Any release archive file URL needs to point to static asset storage.
-                if (
-                    pr.path.lower().endswith(".zip") or pr.path.lower().endswith(".rar")
-                ):
-                    elem[attr] = f"{static_base}/Releases/{pr.path.split('/')[-1]}"
-                    break
-
-                # Some releases specify a custom player in `release_data["player"]`.
-                # The embedded URL must be forced to https.
-                if pr.netloc.endswith("archive.org") and pr.scheme == "http":
-                    pr = pr._replace(scheme="https")
-                    elem[attr] = urlunparse(pr)
-                    break
-
-                # Rewrite the obsolete domain to 20kbps.net.
-                if pr.netloc == "20kbps.sofapause.ch":
-                    pr = pr._replace(netloc="20kbps.net")
-                    elem[attr] = urlunparse(pr)
-
-                # Any file in LEGACY_STATIC_FILES must point to static asset storage.
-                for file in LEGACY_STATIC_FILES:
-                    if pr.path.endswith(file):
-                        elem[attr] = f"{static_base}/{file}"
-                        break
-
-    return str(soup).encode(encoding)  # type: ignore
+    doc = rewrite_document(
+        body,
+        registry.settings,
+        page.release_dir if page else None,
+    )
+    return doc.encode(encoding)  # type: ignore
 
 
 def rewrite_links(request, response, registry):
@@ -141,13 +89,17 @@ def rewrite_links(request, response, registry):
     ):
         return response
 
+    # Views set this when the response was rendered from content that was already rewritten at write time.
+    if getattr(request, "links_rewritten", False):
+        return response
+
     response.body = _get_doc_with_links_rewritten(request, response, registry)
     return response
 
 
 def resolve_release(request, registry):
     """
-    When the URL is for a release page, resolve the `Release` object and add it to the request.
+    When the URL is for a release page, resolve the `PublicReleasePage` row and add it to the request.
     """
     if request.path[-1] != "/":
         return
@@ -161,14 +113,8 @@ def resolve_release(request, registry):
 
     rlsdir = unquote(path.replace("/Releases/", ""))
 
-    rls = (
-        request.dbsession.query(models.Release)
-        .filter(
-            models.Release.release_dir == rlsdir
-        )
-        .first()
-    )
-    setattr(request, "release", rls)
+    page = get_release_resolver().resolve(request.dbsession, rlsdir, registry.settings)
+    setattr(request, "public_release_page", page)
 
 
 REQUEST_MIDDLEWARE = [
@@ -201,3 +147,74 @@ def response_middleware_tween_factory(handler, registry):
         return response
 
     return response_middleware_tween
+
+
+def _get_page_cache_key(request):
+    if request.method not in ("GET", "HEAD"):
+        return None
+    if request.path == "/index2.htm":
+        return INDEX_KEY
+    # The `resolve_release` middleware has added the release page to request, if found.
+    page = getattr(request, "public_release_page", None)
+    if page is not None:
+        return release_key(page.release_dir)
+    return None
+
+
+def page_cache_tween_factory(handler, registry):
+
+    def page_cache_tween(request):
+        key = _get_page_cache_key(request)
+        if key is None:
+            return handler(request)
+        # The `conditional_response` tween has set the page's ETag, which covers the content version and the
+        # host URL. Keying entries by it keeps the cache correct when the content is changed by another process.
+        variant = getattr(request, "page_etag", None) or request.host_url
+        return get_page_cache().get_or_render(key, lambda: handler(request), variant=variant)
+
+    return page_cache_tween
+
+
+def _get_content_version(request, key):
+    """Get the content version and the last modification time of a page without rendering it.
+    """
+    if key == INDEX_KEY:
+        n, max_id, last_modified = request.dbsession.query(
+            func.count(models.IndexRecord.id),
+            func.max(models.IndexRecord.id),
+            func.max(models.IndexRecord.updated_at),
+        ).one()
+        # The count and the max id change when an index record is deleted or added.
+        return (n, max_id, last_modified), last_modified
+
+    page = request.public_release_page
+    return (page.release_id, page.updated_at), page.updated_at
+
+
+def conditional_response_tween_factory(handler, registry):
+
+    def conditional_response_tween(request):
+        key = _get_page_cache_key(request)
+        if key is None:
+            return handler(request)
+
+        # Routes are matched by the router only after the tweens, so look the route up here.
+        info = registry.getUtility(IRoutesMapper)(request)
+        route_name = info["route"].name if info["route"] else None
+
+        version, last_modified = _get_content_version(request, key)
+        etag = make_etag(version, get_fingerprint(registry.settings), request.host_url)
+
+        request.page_etag = etag
+
+        if is_not_modified(request, etag, last_modified):
+            response = HTTPNotModified()
+        else:
+            response = handler(request)
+            if response.status_code != 200:
+                return response
+
+        set_cache_headers(response, registry.settings, route_name, etag, last_modified, key)
+        return response
+
+    return conditional_response_tween
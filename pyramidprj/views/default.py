@@ -6,17 +6,32 @@ from datetime import date
 import pyramid.httpexceptions as exc
 from pyramid.renderers import render_to_response
 from pyramid.response import Response
-from pyramid.view import view_config
+from pyramid.view import exception_view_config, view_config
 from sqlalchemy.exc import SQLAlchemyError
 
 from .. import models
-from ..release_service import RequestType, get_release_service
+from ..index_fragments import get_index_fragment_cache
+from ..link_rewriter import (
+    get_fingerprint,
+    rewrite_index_record,
+    rewrite_release_page,
+)
+from ..manifest import verify_release_directory
+from ..page_cache import INDEX_KEY, invalidate_on_commit, release_key
+from ..read_model import sync_public_release_page
+from ..release_resolver import forget_on_commit
+from ..release_service import QueueFull, RequestType, get_release_service, queue_stages_on_commit
+from ..storage_client import get_storage_client
 
 import logging
 
 log = logging.getLogger(__name__)
 
 
+# Suggested to clients when the release service queue is full
+QUEUE_FULL_RETRY_AFTER_SECS = 60
+
+
 @view_config(route_name="home", renderer="pyramidprj:templates/index.jinja2")
 def index(request):
     return {}
@@ -25,38 +40,42 @@ def index(request):
 @view_config(route_name='index2', renderer='pyramidprj:templates/index2.jinja2')
 def index2(request):
     try:
-        query = request.dbsession.query(models.IndexRecord).order_by(models.IndexRecord.id.desc())
-        records = query.all()
+        records_html = get_index_fragment_cache().assemble(request)
     except SQLAlchemyError:
         return Response(db_err_msg, content_type='text/plain', status=500)
 
-    return {"records": records}
+    # The rows come with their links rewritten, and the template's own links are written in rewritten form.
+    request.links_rewritten = True
+
+    return {"records_html": records_html}
 
 
 @view_config(route_name='Releases')
 @view_config(route_name="Releases_with_subdir")
 def Releases(request):
-    # The `resolve_release` middleware has added release to request, if found.
-    release = getattr(request, "release", None)
-    release_page = release.release_page if release else None
-
-    if not release_page:
+    # The `resolve_release` middleware has added the release page to request, if found.
+    page = getattr(request, "public_release_page", None)
+    if page is None:
         raise exc.HTTPNotFound()
 
-    if release_page.custom_body:
-        return Response(body=release_page.custom_body)
-    
+    settings = request.registry.settings
+    rewritten = page.rewrite_fingerprint == get_fingerprint(settings)
+    request.links_rewritten = rewritten
+
+    if page.custom_body:
+        return Response(body=page.custom_body_rewritten if rewritten else page.custom_body)
+
     return render_to_response(
         "pyramidprj:templates/release_page.jinja2",
         {
-            "release_page": release_page,
-            "release": release_page.release,
-            "data": release_page.release.release_data,
+            "release": page,
+            "data": page.release_data_rewritten if rewritten else page.release_data,
+            "content": page.content_rewritten if rewritten else page.content,
+            "custom_tracklist": page.custom_tracklist_rewritten if rewritten else page.custom_tracklist,
+            "tracklist": page.tracklist,
             "enumerate": enumerate,
-            "static_base": request.registry.settings["static_base"],
-            "static_dir": (
-                os.path.join(request.registry.settings["static_base"], "Releases", release_page.release.release_dir)
-            ),
+            "static_base": settings["static_base"],
+            "static_dir": os.path.join(settings["static_base"], "Releases", page.release_dir),
             "join": os.path.join,
         }
     )
@@ -70,7 +89,6 @@ def create_release(request):
 @view_config(route_name="request_preview", request_method="POST", renderer="pyramidprj:templates/request_preview.jinja2", permission="🕉")
 def request_preview(request):    
     file = request.POST['file']
-    key = (RequestType.PREVIEW, file)
 
     m = re.search(r"(?:(?!_-_)[^\s])*_-_.*-\(([\w-]+)\)-\d{4}\.zip", file)
     if not m:
@@ -78,14 +96,8 @@ def request_preview(request):
     file = m[0]
     
     release_service = get_release_service()
-    task_state = release_service.task_state.get(key)
-    if task_state and task_state.success is None:
-        raise exc.HTTPBadRequest(f"Preview task for '{file}' is already running")
-
-    if task_state:
-        del release_service.task_state[key]
-
-    release_service.request_preview(file)
+    if not release_service.request_preview(file):
+        raise exc.HTTPBadRequest(f"Preview task for '{file}' is already queued or running")
 
     return {"file": file}
 
@@ -106,17 +118,11 @@ def preview_release(request):
 @view_config(route_name="request_upload", request_method="POST", renderer="pyramidprj:templates/request_upload.jinja2", permission="🕉")
 def request_upload(request):    
     file = request.POST["file"]
-    key = (RequestType.UPLOAD, file)
 
     release_service = get_release_service()
-    task_state = release_service.task_state.get(key)
-    if task_state and task_state.success is None:
-        raise exc.HTTPBadRequest("Upload task for '{file}' is already running")
-
-    if task_state:
-        del release_service.task_state[key]
-
-    release_service.request_upload(file)
+    # The previous task is replaced by `request_upload`, which resumes it.
+    if not release_service.request_upload(file):
+        raise exc.HTTPBadRequest(f"Upload task for '{file}' is already queued or running")
 
     return {"file": file}
 
@@ -147,32 +153,37 @@ def commit_release(request):
     if task_state.success is None:
         raise exc.HTTPBadRequest(f"The upload is still pending.")
 
-    release_service.create_database_objects(
+    if task_state.cancelled:
+        raise exc.HTTPBadRequest(f"The upload has been cancelled.")
+
+    if task_state.success is not True:
+        raise exc.HTTPBadRequest(f"The upload has failed: {task_state.exception}")
+
+    artifacts = release_service.create_database_objects(
         request.dbsession,
         file,
         request.POST["page_content"],
         request.POST["index_record_body"]
     )
+    queue_stages_on_commit(request, file, artifacts)
+    invalidate_on_commit(request, INDEX_KEY, release_key(task_state.data["release_dir"]))
+    forget_on_commit(request, task_state.data["release_dir"])
 
     data = task_state.serialize()
-    del release_service.task_state[key]
+    data["data"]["release_id"] = artifacts.release_id
+    # In the request's transaction, so the upload can be committed again if it rolls back
+    release_service.task_state.delete(key, request.dbsession)
+    data["ia_upload_queued"] = RequestType.IA_UPLOAD in release_service.auto_stages
     return data
 
 
 @view_config(route_name="request_iaupload", request_method="POST", permission="🕉")
 def request_iaupload(request):
     file = request.POST["file"]
-    key = (RequestType.IA_UPLOAD, file)
 
     release_service = get_release_service()
-    task_state = release_service.task_state.get(key)
-    if task_state and task_state.success is None:
-        raise exc.HTTPBadRequest("Archive.org upload task for '{file}' is already running")
-
-    if task_state:
-        del release_service.task_state[key]
-
-    release_service.request_ia_upload(file)
+    if not release_service.request_ia_upload(file):
+        raise exc.HTTPBadRequest(f"Archive.org upload task for '{file}' is already queued or running")
 
     return exc.HTTPNoContent()
 
@@ -190,6 +201,49 @@ def check_iaupload(request):
     return task_state.serialize()
 
 
+# Pages showing the progress of a task, by request type
+PROGRESS_PAGES = {
+    RequestType.PREVIEW: "/preview_release/{file}/",
+    RequestType.UPLOAD: "/check_upload/{file}/",
+    RequestType.IA_UPLOAD: "/check_iaupload/{file}/",
+}
+
+
+@view_config(route_name="cancel_task", request_method="POST", permission="🕉")
+def cancel_task(request):
+    file = request.matchdict["file"]
+    try:
+        request_type = RequestType[request.matchdict["request_type"].upper()]
+    except KeyError:
+        raise exc.HTTPBadRequest(f"Unknown request type '{request.matchdict['request_type']}'")
+
+    release_service = get_release_service()
+    if not release_service.cancel(request_type, file):
+        raise exc.HTTPBadRequest(f"There is no queued or running {request_type.name.lower()} task for '{file}'")
+
+    if request_type in PROGRESS_PAGES:
+        return exc.HTTPSeeOther(PROGRESS_PAGES[request_type].format(file=file))
+    return exc.HTTPNoContent()
+
+
+@view_config(route_name="release_service_status", renderer="json", permission="🕉")
+def release_service_status(request):
+    release_service = get_release_service()
+    return {
+        "tasks": release_service.task_state.count_by_state(),
+        "queues": release_service.task_state.queue_stats(),
+        "tmp_directory": release_service.janitor.usage(),
+    }
+
+
+@exception_view_config(QueueFull)
+def queue_full(ex, request):
+    return exc.HTTPServiceUnavailable(
+        "The release service is busy, please retry later.",
+        headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER_SECS)},
+    )
+
+
 @view_config(route_name="release_list", renderer="pyramidprj:templates/release_list.jinja2", permission="🕉")
 @view_config(route_name="Release_list", renderer="pyramidprj:templates/release_list.jinja2", permission="🕉")
 def release_list(request):
@@ -203,11 +257,24 @@ def release_list(request):
 @view_config(route_name='Releases', request_method="DELETE", permission="🕉")
 @view_config(route_name="Releases_with_subdir", request_method="DELETE", permission="🕉")
 def delete_release(request):
-    release = getattr(request, "release", None)
-    if release is None:
-        raise exc.HTTPBadGateway("No such release")
-
-    get_release_service().delete_database_objects(request.dbsession, release.id)
+    page = getattr(request, "public_release_page", None)
+    if page is not None:
+        release_id, release_dir = page.release_id, page.release_dir
+    else:
+        # Legacy releases without release page don't have a public release page
+        release_dir = "/".join(request.matchdict[k] for k in ("rlsdir", "subdir") if k in request.matchdict)
+        release = (
+            request.dbsession.query(models.Release)
+            .filter(models.Release.release_dir == release_dir)
+            .first()
+        )
+        if release is None:
+            raise exc.HTTPBadGateway("No such release")
+        release_id = release.id
+
+    invalidate_on_commit(request, INDEX_KEY, release_key(release_dir))
+    forget_on_commit(request, release_dir)
+    get_release_service().delete_database_objects(request.dbsession, release_id)
     return exc.HTTPNoContent()
 
 
@@ -236,16 +303,33 @@ def update_release(request):
     if release_data:
         release = request.dbsession.query(models.Release).filter(models.Release.id == release_id).one()
         release.release_data = release_data
+        release.touch()
         release.release_page.content = page_content
         release.release_page.custom_body = custom_body
+        rewrite_release_page(release.release_page, request.registry.settings)
 
         for ir_id, body in index_record_bodies.items():
             ir = request.dbsession.query(models.IndexRecord).filter(models.IndexRecord.id == ir_id).one()
             ir.body = body
+            rewrite_index_record(ir, request.registry.settings)
+
+        sync_public_release_page(request.dbsession, release, request.registry.settings)
+        invalidate_on_commit(request, INDEX_KEY, release_key(release.release_dir))
 
     return exc.HTTPTemporaryRedirect(f"/edit/{release_id}/")
 
 
+@view_config(route_name="verify_release", renderer="json", permission="🕉")
+def verify_release(request):
+    release_id = int(request.matchdict["release_id"])
+    release = request.dbsession.get(models.Release, release_id)
+    if release is None:
+        raise exc.HTTPNotFound()
+    if release.manifest is None:
+        raise exc.HTTPBadRequest(f"Release {release_id} has no manifest")
+    return verify_release_directory(get_storage_client(), release.release_dir, release.manifest)
+
+
 @view_config(route_name="index_record_list", renderer="pyramidprj:templates/index_record_list.jinja2", permission="🕉")
 def index_record_list(request):
     index_records = request.dbsession.query(models.IndexRecord).order_by(models.IndexRecord.id.desc())
@@ -259,6 +343,7 @@ def index_record_list(request):
 def delete_index_record(request):
     ir_id = int(request.matchdict["index_record_id"])
     request.dbsession.query(models.IndexRecord).filter(models.IndexRecord.id == ir_id).delete()
+    invalidate_on_commit(request, INDEX_KEY)
     return exc.HTTPNoContent()
 
 
@@ -281,6 +366,8 @@ def upsert_index_record(request):
         ir = request.dbsession.query(models.IndexRecord).filter(models.IndexRecord.id == ir_id).one()
     ir.date = request.POST["date"]
     ir.body = request.POST["body"]
+    rewrite_index_record(ir, request.registry.settings)
+    invalidate_on_commit(request, INDEX_KEY)
     if ir_id == -1:
         request.dbsession.flush()
     return exc.HTTPTemporaryRedirect(f"/edit_index_record/{ir.id}/")
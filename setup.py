@@ -29,6 +29,7 @@ requires = [
     "google-api-core==2.11.0",
     "google-cloud-core==2.3.2",
     "google-cloud-storage==2.7.0",
+    "google-crc32c==1.5.0",
     "pyramid_nacl_session",
     "internetarchive==3.2.0",
     "shortuuid==1.0.11",
@@ -68,6 +69,9 @@ setup(
         ],
         'console_scripts': [
             'initialize_pyramidprj_db=pyramidprj.scripts.initialize_db:main',
+            'rewrite_pyramidprj_links=pyramidprj.scripts.rewrite_links:main',
+            'export_pyramidprj_static=pyramidprj.scripts.export_static:main',
+            'run_pyramidprj_release_worker=pyramidprj.scripts.release_worker:main',
         ],
     },
 )
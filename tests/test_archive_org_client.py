@@ -0,0 +1,181 @@
+import hashlib
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from pyramidprj import archive_org_client
+from pyramidprj.archive_org_client import ArchiveOrgClient, ArchiveOrgError
+from pyramidprj.task_store import FAILED, SUCCEEDED
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeItem:
+    """An archive.org item holding `files` (name -> bytes). `errors[name]` holds the status codes to fail with,
+    in order, before an upload of `name` succeeds; 5xx and 429 are raised like `ia` does, others returned.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contents = {}
+        self.exists = False
+        self.errors = {}
+        self.events = []
+        self.derived = 0
+
+    @property
+    def files(self):
+        return [{"name": name, "md5": hashlib.md5(data).hexdigest()} for name, data in self.contents.items()]
+
+    def upload_file(self, path, key, metadata, queue_derive, verify):
+        assert queue_derive is False
+        with self.lock:
+            self.events.append(("start", key))
+            errors = self.errors.get(key)
+            status_code = errors.pop(0) if errors else 200
+        try:
+            if status_code == 429 or status_code >= 500:
+                raise requests.HTTPError(response=FakeResponse(status_code))
+            if status_code != 200:
+                return FakeResponse(status_code)
+            with open(path, "rb") as f:
+                data = f.read()
+            with self.lock:
+                self.contents[key] = data
+                self.exists = True
+            return FakeResponse(200)
+        finally:
+            with self.lock:
+                self.events.append(("end", key))
+
+    def derive(self):
+        self.derived += 1
+        return FakeResponse(200)
+
+
+class FakeSession:
+    def __init__(self, item):
+        self.item = item
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get_item(self, identifier):
+        assert identifier == "20k999"
+        return self.item
+
+
+RELEASE = SimpleNamespace(
+    catalog_no="20k999",
+    release_data={"artist": "Foo", "date": "2026-10-18", "relname": "Bar"},
+    release_page=SimpleNamespace(content_text="Foo - Bar"),
+)
+
+FILES = {"01.mp3": b"one", "02.mp3": b"two", "03.mp3": b"three", "cover.jpg": b"jpg"}
+
+
+@pytest.fixture
+def local_dir(tmp_path):
+    local_dir = tmp_path / "foo"
+    local_dir.mkdir()
+    for name, data in FILES.items():
+        (local_dir / name).write_bytes(data)
+    return str(local_dir)
+
+
+@pytest.fixture
+def item():
+    return FakeItem()
+
+
+@pytest.fixture
+def client(item, monkeypatch, tmp_path):
+    credentials = tmp_path / "credentials.json"
+    credentials.write_text(json.dumps({"s3": {"access": "a", "secret": "s"}}))
+    monkeypatch.setattr(archive_org_client, "settings", {
+        "archive_org_s3_credentials": str(credentials),
+        "archive_org_collections": "a, b",
+        "archive_org_uploader": "foo@example.com",
+    })
+    monkeypatch.setattr("pyramidprj.retry.time.sleep", lambda secs: None)
+    monkeypatch.setattr(archive_org_client.ia, "get_session", lambda *args, **kw: FakeSession(item))
+    client = ArchiveOrgClient(upload_concurrency=2, upload_max_attempts=3)
+    yield client
+    client.shutdown()
+
+
+def test_first_upload_of_new_item_is_alone(client, item, local_dir):
+    assert client.upload_release(RELEASE, local_dir) == "20k999"
+
+    assert item.contents == FILES
+    # The item is created by the first upload, before the others start
+    assert item.events[:2] == [("start", "01.mp3"), ("end", "01.mp3")]
+    assert item.derived == 1
+
+
+def test_unchanged_files_are_skipped(client, item, local_dir):
+    item.contents.update({"01.mp3": b"one", "02.mp3": b"old"})
+    item.exists = True
+    progress = []
+
+    client.upload_release(RELEASE, local_dir, on_progress=progress.append)
+
+    uploaded = sorted(key for event, key in item.events if event == "start")
+    assert uploaded == ["02.mp3", "03.mp3", "cover.jpg"]
+    assert {u["file"]: u.get("unchanged") for u in progress[-1]} == {
+        "01.mp3": True, "02.mp3": None, "03.mp3": None, "cover.jpg": None,
+    }
+    assert item.derived == 1
+
+
+def test_no_derive_when_all_files_are_unchanged(client, item, local_dir):
+    item.contents.update(FILES)
+    item.exists = True
+
+    client.upload_release(RELEASE, local_dir)
+
+    assert item.events == []
+    assert item.derived == 0
+
+
+def test_throttled_upload_is_retried(client, item, local_dir):
+    item.errors["02.mp3"] = [503, 503]
+    progress = []
+
+    client.upload_release(RELEASE, local_dir, on_progress=progress.append)
+
+    uploads = {u["file"]: u for u in progress[-1]}
+    assert uploads["02.mp3"] == {"file": "02.mp3", "state": SUCCEEDED, "size": 3, "attempts": 3}
+    assert item.contents == FILES
+
+
+def test_failed_file_raises_its_error(client, item, local_dir):
+    item.errors["03.mp3"] = [403]
+    progress = []
+
+    with pytest.raises(ArchiveOrgError, match="upload of 03.mp3 failed"):
+        client.upload_release(RELEASE, local_dir, on_progress=progress.append)
+
+    uploads = {u["file"]: u for u in progress[-1]}
+    assert uploads["03.mp3"]["state"] == FAILED
+    assert uploads["03.mp3"]["attempts"] == 1
+    assert "403" in uploads["03.mp3"]["error"]
+    assert uploads["cover.jpg"]["state"] == SUCCEEDED
+    assert item.derived == 0
+
+
+def test_progress_snapshots(client, local_dir):
+    progress = []
+
+    client.upload_release(RELEASE, local_dir, on_progress=progress.append)
+
+    assert [u["state"] for u in progress[0]] == ["queued"] * 4
+    assert all(u["state"] == SUCCEEDED for u in progress[-1])
+    # Snapshots aren't changed afterwards
+    assert progress[0][0] is not progress[-1][0]
+    assert [u["file"] for u in progress[0]] == sorted(FILES)
@@ -0,0 +1,295 @@
+import base64
+import hashlib
+import io
+import os
+import zipfile
+
+import google_crc32c
+import pytest
+import requests
+
+from pyramidprj import artifact_cache
+from pyramidprj.artifact_cache import ArtifactCache, DownloadError, get_version
+
+
+STATIC_BASE = "https://static.example.com"
+
+
+def make_zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as f:
+        for name, data in members.items():
+            f.writestr(name, data)
+    return buf.getvalue()
+
+
+class FakeStorage:
+    """Cloud storage holding `objects` (remote -> bytes), with the metadata `StorageClient.metadata` reports."""
+    def __init__(self):
+        self.objects = {}
+        self.generations = {}
+        self.md5 = True
+
+    def put(self, remote, data):
+        self.objects[remote] = data
+        self.generations[remote] = self.generations.get(remote, 0) + 1
+
+    def metadata(self, remote):
+        if remote not in self.objects:
+            return None
+        data = self.objects[remote]
+        return {
+            "size": len(data),
+            "generation": self.generations[remote],
+            "md5": base64.b64encode(hashlib.md5(data).digest()).decode() if self.md5 else None,
+            "crc32c": base64.b64encode(google_crc32c.Checksum(data).digest()).decode(),
+        }
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None, drop_after=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.drop_after = drop_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 4):
+            if self.drop_after is not None and i >= self.drop_after:
+                raise requests.exceptions.ChunkedEncodingError("Connection broken")
+            yield self.body[i:i + 4]
+
+
+class FakeSession:
+    """Serves the objects of `storage` the way the static site does, honoring Range headers.
+
+    `plan` holds overrides for the next responses, in order: a dict with `drop_after` (bytes after which the
+    stream breaks), `ignore_range` (answer with 200 and the whole object), `range_start` (claim a different
+    start in Content-Range) or `corrupt`.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.requests = []
+        self.plan = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        remote = url.removeprefix(f"{STATIC_BASE}/")
+        range_header = (headers or {}).get("Range")
+        self.requests.append((remote, range_header))
+        if remote not in self.storage.objects:
+            return FakeResponse(404)
+        data = self.storage.objects[remote]
+        plan = self.plan.pop(0) if self.plan else {}
+        if plan.get("corrupt"):
+            data = data[:-1] + bytes([data[-1] ^ 0xFF])
+        if range_header and not plan.get("ignore_range"):
+            start = int(range_header.removeprefix("bytes=").removesuffix("-"))
+            content_range_start = plan.get("range_start", start)
+            return FakeResponse(
+                206,
+                data[content_range_start:],
+                {"Content-Range": f"bytes {content_range_start}-{len(data) - 1}/{len(data)}"},
+                plan.get("drop_after"),
+            )
+        return FakeResponse(200, data, drop_after=plan.get("drop_after"))
+
+
+@pytest.fixture
+def storage():
+    return FakeStorage()
+
+
+@pytest.fixture
+def session(storage):
+    return FakeSession(storage)
+
+
+@pytest.fixture
+def cache(storage, session, tmp_path):
+    cache = ArtifactCache(str(tmp_path), STATIC_BASE, lambda: storage, max_uncompressed_bytes=1000, max_members=3)
+    cache.session = session
+    return cache
+
+
+def entry_files(cache, storage, file):
+    """Files in the cache entry of the current version of `file`, including temp files."""
+    version = get_version(storage.metadata(f"Releases/{file}"))
+    return sorted(os.listdir(os.path.join(cache.release_directory(file), version)))
+
+
+def test_get_version():
+    md5 = hashlib.md5(b"x").digest()
+    assert get_version({"md5": base64.b64encode(md5).decode(), "generation": 1}) == md5.hex()
+    assert get_version({"md5": None, "generation": 7}) == "g7"
+
+
+def test_unchanged_zip_is_fetched_once(cache, storage, session):
+    storage.put("Releases/foo-(20k001)-2026.zip", make_zip({"01.mp3": b"one", "cover.jpg": b"jpg"}))
+    progress = []
+
+    artifact = cache.get("foo-(20k001)-2026.zip", progress=lambda *args: progress.append(args))
+    assert os.path.basename(artifact.local_dir) == "foo-(20k001)-2026"
+    assert sorted(os.listdir(artifact.local_dir)) == ["01.mp3", "cover.jpg"]
+    size = len(storage.objects["Releases/foo-(20k001)-2026.zip"])
+    assert progress[-1][:2] == (size, size)
+
+    assert cache.get("foo-(20k001)-2026.zip") == artifact
+    assert session.requests == [("Releases/foo-(20k001)-2026.zip", None)]
+
+
+def test_dropped_stream_is_resumed_with_range(cache, storage, session):
+    data = make_zip({"01.mp3": b"one" * 20})
+    storage.put("Releases/foo.zip", data)
+    session.plan = [{"drop_after": 40}, {"drop_after": 40}]
+
+    artifact = cache.get("foo.zip")
+    assert session.requests == [
+        ("Releases/foo.zip", None),
+        ("Releases/foo.zip", "bytes=40-"),
+        ("Releases/foo.zip", "bytes=80-"),
+    ]
+    with open(artifact.zip_file, "rb") as f:
+        assert f.read() == data
+
+
+def test_ignored_range_starts_over(cache, storage, session):
+    data = make_zip({"01.mp3": b"one" * 20})
+    storage.put("Releases/foo.zip", data)
+    session.plan = [{"drop_after": 40}, {"ignore_range": True}]
+
+    artifact = cache.get("foo.zip")
+    assert len(session.requests) == 2
+    with open(artifact.zip_file, "rb") as f:
+        assert f.read() == data
+
+
+def test_range_mismatch_starts_over_from_zero(cache, storage, session):
+    data = make_zip({"01.mp3": b"one" * 20})
+    storage.put("Releases/foo.zip", data)
+    # The partial response starts elsewhere than asked for. Appending it would corrupt the zip.
+    session.plan = [{"drop_after": 40}, {"range_start": 20}]
+
+    artifact = cache.get("foo.zip")
+    assert session.requests == [
+        ("Releases/foo.zip", None),
+        ("Releases/foo.zip", "bytes=40-"),
+        ("Releases/foo.zip", None),
+    ]
+    with open(artifact.zip_file, "rb") as f:
+        assert f.read() == data
+
+
+def test_incomplete_after_all_attempts(cache, storage, session):
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"one" * 20}))
+    session.plan = [{"drop_after": 0}] * artifact_cache.DOWNLOAD_ATTEMPTS
+
+    with pytest.raises(DownloadError, match="incomplete after"):
+        cache.get("foo.zip")
+    assert len(session.requests) == artifact_cache.DOWNLOAD_ATTEMPTS
+    assert entry_files(cache, storage, "foo.zip") == []
+
+
+def test_md5_mismatch_rejects_download(cache, storage, session):
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"one"}))
+    session.plan = [{"corrupt": True}]
+
+    with pytest.raises(DownloadError, match="MD5"):
+        cache.get("foo.zip")
+    # Neither the temp file nor a partial entry is left behind
+    assert entry_files(cache, storage, "foo.zip") == []
+
+    assert os.path.isdir(cache.get("foo.zip").local_dir)
+
+
+def test_crc32c_is_checked_without_md5(cache, storage, session):
+    # Composite objects have no MD5
+    storage.md5 = False
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"one"}))
+    session.plan = [{"corrupt": True}]
+
+    with pytest.raises(DownloadError, match="CRC32C"):
+        cache.get("foo.zip")
+    assert entry_files(cache, storage, "foo.zip") == []
+
+    artifact = cache.get("foo.zip")
+    assert artifact.version == "g1"
+    assert os.path.isdir(artifact.local_dir)
+
+
+@pytest.mark.parametrize("members, error", [
+    ({f"{i:02}.mp3": b"x" for i in range(4)}, "too many members"),
+    ({"01.mp3": b"x" * 600, "02.mp3": b"x" * 600}, "too large uncompressed"),
+])
+def test_zip_limits(cache, storage, members, error):
+    storage.put("Releases/foo.zip", make_zip(members))
+
+    with pytest.raises(AssertionError, match=error):
+        cache.get("foo.zip")
+    # The zip is kept, only the extraction is rejected
+    assert entry_files(cache, storage, "foo.zip") == ["foo.zip"]
+
+
+def test_changed_md5_forces_refetch(cache, storage, session):
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"one"}))
+    old = cache.get("foo.zip")
+
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"changed"}))
+    new = cache.get("foo.zip")
+    assert new.version != old.version
+    assert len(session.requests) == 2
+    with open(os.path.join(new.local_dir, "01.mp3"), "rb") as f:
+        assert f.read() == b"changed"
+    # The old version is dropped
+    assert os.listdir(cache.release_directory("foo.zip")) == [new.version]
+
+    # A step expecting the old version fails rather than working on the new one
+    with pytest.raises(AssertionError, match="Release zip has changed"):
+        cache.get("foo.zip", old.version)
+
+
+def test_missing_zip(cache):
+    with pytest.raises(FileNotFoundError):
+        cache.get("missing.zip")
+
+
+def test_drop_other_versions(cache, storage):
+    storage.put("Releases/foo.zip", make_zip({"01.mp3": b"one"}))
+    artifact = cache.get("foo.zip")
+    release_directory = cache.release_directory("foo.zip")
+    os.makedirs(os.path.join(release_directory, "stale", "foo"))
+
+    cache._drop_other_versions("foo.zip", artifact.version)
+    assert os.listdir(release_directory) == [artifact.version]
+    assert os.path.isdir(artifact.local_dir)
+
+
+def test_zip_is_not_extracted_when_streaming(cache, storage, session):
+    storage.put("Releases/foo.zip", make_zip({"02.mp3": b"two", "01.mp3": b"one", "sub/x.txt": b"x"}))
+
+    artifact = cache.get("foo.zip", extract=False)
+    assert not artifact.extracted
+    assert not os.path.exists(artifact.local_dir)
+    assert artifact.names() == ["01.mp3", "02.mp3"]
+    assert artifact.size("02.mp3") == 3
+    with artifact.open("01.mp3") as f:
+        assert f.read() == b"one"
+
+    # Cached, and extracted only when a step needs the tree
+    assert cache.get("foo.zip", extract=False).zip_file == artifact.zip_file
+    assert len(session.requests) == 1
+    extracted = cache.get("foo.zip")
+    assert extracted.names() == ["01.mp3", "02.mp3"]
+    assert len(session.requests) == 1
+
+
+def test_zip_limits_are_checked_when_streaming(cache, storage):
+    storage.put("Releases/foo.zip", make_zip({f"{i:02}.mp3": b"x" for i in range(4)}))
+
+    with pytest.raises(AssertionError, match="too many members"):
+        cache.get("foo.zip", extract=False)
@@ -0,0 +1,140 @@
+import io
+import os
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+
+from pyramidprj import audio_probe
+from pyramidprj.artifact_cache import Artifact
+from pyramidprj.audio_probe import AudioProbe, file_key
+
+
+class FakeMutagen:
+    """Stands in for `mutagen.File`: the album tag is the file's content."""
+    def __init__(self):
+        self.opened = []
+
+    def File(self, f):
+        self.opened.append(os.path.basename(f.name))
+        album = f.read().decode()
+        return SimpleNamespace(tags={"TALB": [album], "TPE1": "Artist"}, info=SimpleNamespace(length=61.5))
+
+
+@pytest.fixture
+def mutagen(monkeypatch):
+    mutagen = FakeMutagen()
+    monkeypatch.setattr(audio_probe, "mutagen", mutagen)
+    return mutagen
+
+
+@pytest.fixture
+def probe(tmp_path):
+    probe = AudioProbe(str(tmp_path / "tmp"), n_workers=2)
+    yield probe
+    probe.shutdown()
+
+
+def extracted(tmp_path, version, members, extract=True):
+    """Zip `members` (name -> bytes) and extract them if `extract`, like the artifact cache does."""
+    entry = tmp_path / version
+    local_dir = entry / "foo"
+    entry.mkdir()
+    if extract:
+        local_dir.mkdir()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as f:
+        for name, data in members.items():
+            f.writestr(name, data)
+            if extract:
+                (local_dir / name).write_bytes(data)
+    (entry / "foo.zip").write_bytes(buf.getvalue())
+    return Artifact(version, str(entry / "foo.zip"), str(local_dir), extract)
+
+
+def test_probe(probe, mutagen, tmp_path):
+    path = tmp_path / "01.mp3"
+    path.write_bytes(b"Album")
+
+    assert probe.probe(str(path)) == {"tags": {"TALB": "Album", "TPE1": "Artist"}, "length": 61.5}
+    assert probe.probe(str(path))["tags"]["TALB"] == "Album"
+    assert mutagen.opened == ["01.mp3"]
+
+
+def test_probe_all_keeps_order(probe, mutagen, tmp_path):
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / f"{i:02}.mp3"))
+        (tmp_path / f"{i:02}.mp3").write_bytes(f"Album {i}".encode())
+
+    assert [r["tags"]["TALB"] for r in probe.probe_all(paths)] == [f"Album {i}" for i in range(5)]
+
+
+def test_zip_member_key_doesnt_read_the_file(monkeypatch, tmp_path):
+    artifact = extracted(tmp_path, "v1", {"01.mp3": b"one", "02.mp3": b"two"})
+
+    def fail(*args, **kw):
+        raise AssertionError("Read the member")
+
+    monkeypatch.setattr(zipfile.ZipFile, "open", fail)
+    assert artifact.key("01.mp3") != artifact.key("02.mp3")
+    assert artifact.key("01.mp3") == f"zip:01.mp3:{zipfile.crc32(b'one'):08x}:3"
+
+
+def test_unchanged_member_of_changed_zip_is_not_probed_again(probe, mutagen, tmp_path):
+    old = extracted(tmp_path, "v1", {"01.mp3": b"One", "02.mp3": b"Two"})
+    paths = [os.path.join(old.local_dir, n) for n in ("01.mp3", "02.mp3")]
+    probe.probe_all(paths, keys=[old.key("01.mp3"), old.key("02.mp3")])
+    mutagen.opened.clear()
+
+    new = extracted(tmp_path, "v2", {"01.mp3": b"One", "02.mp3": b"Changed"})
+    paths = [os.path.join(new.local_dir, n) for n in ("01.mp3", "02.mp3")]
+    results = probe.probe_all(paths, keys=[new.key("01.mp3"), new.key("02.mp3")])
+    assert [r["tags"]["TALB"] for r in results] == ["One", "Changed"]
+    assert mutagen.opened == ["02.mp3"]
+
+
+def test_extracted_file_without_zip_is_keyed_by_stat(probe, mutagen, tmp_path):
+    artifact = extracted(tmp_path, "v1", {"01.mp3": b"One"})
+    os.remove(artifact.zip_file)
+    path = os.path.join(artifact.local_dir, "01.mp3")
+    assert artifact.key("01.mp3") == file_key(path)
+
+    probe.probe(path, key=artifact.key("01.mp3"))
+    with open(path, "wb") as f:
+        f.write(b"Rewritten")
+    os.utime(path, ns=(0, 0))
+    assert probe.probe(path, key=artifact.key("01.mp3"))["tags"]["TALB"] == "Rewritten"
+    assert mutagen.opened == ["01.mp3", "01.mp3"]
+
+
+def test_zip_members_are_probed_without_extracting(probe, mutagen, tmp_path):
+    artifact = extracted(tmp_path, "v1", {"01.mp3": b"One", "02.mp3": b"Two"}, extract=False)
+    paths = [os.path.join(artifact.local_dir, n) for n in ("01.mp3", "02.mp3")]
+
+    def open_file(path):
+        return artifact.open(os.path.basename(path))
+
+    results = probe.probe_all(paths, open_file, [artifact.key("01.mp3"), artifact.key("02.mp3")])
+    assert [r["tags"]["TALB"] for r in results] == ["One", "Two"]
+    assert not os.path.exists(artifact.local_dir)
+
+    # The extracted files share the cache entries
+    mutagen.opened.clear()
+    tree = extracted(tmp_path, "v2", {"01.mp3": b"One", "02.mp3": b"Two"})
+    paths = [os.path.join(tree.local_dir, n) for n in ("01.mp3", "02.mp3")]
+    probe.probe_all(paths, keys=[tree.key("01.mp3"), tree.key("02.mp3")])
+    assert mutagen.opened == []
+
+
+def test_cache_survives_restart(mutagen, tmp_path):
+    path = tmp_path / "01.mp3"
+    path.write_bytes(b"Album")
+    first = AudioProbe(str(tmp_path / "tmp"))
+    first.probe(str(path))
+    first.shutdown()
+
+    second = AudioProbe(str(tmp_path / "tmp"))
+    assert second.probe(str(path))["tags"]["TALB"] == "Album"
+    second.shutdown()
+    assert mutagen.opened == ["01.mp3"]
@@ -0,0 +1,178 @@
+import gzip
+import json
+
+import pytest
+from webob import Request, Response
+
+from pyramidprj import models, storage_client
+from pyramidprj.scripts.export_static import (
+    INDEX_PATH,
+    MANIFEST_FILE,
+    BucketWriter,
+    LocalWriter,
+    export,
+    get_pages,
+    release_page_path,
+)
+
+
+SETTINGS = {"static_base": "https://static.example.com"}
+
+
+class FakeApp:
+    """WSGI app that serves the URL path as page body and records what was rendered."""
+    def __init__(self):
+        self.rendered = []
+        self.fail = set()
+
+    def __call__(self, environ, start_response):
+        path = environ["PATH_INFO"]
+        self.rendered.append(path)
+        if path in self.fail:
+            return Response(status=500)(environ, start_response)
+        body = f"<html>{Request(environ).host_url}{path}</html>".encode("utf-8")
+        return Response(body=body)(environ, start_response)
+
+
+class FakeStorage:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_bytes(self, data, remote, content_type):
+        self.objects[remote] = data
+
+    def download_bytes(self, remote):
+        return self.objects[remote]
+
+    def exists(self, remote):
+        return remote in self.objects
+
+    def delete(self, remote):
+        del self.objects[remote]
+
+
+@pytest.fixture
+def dbsession(dbengine):
+    session = models.get_session_factory(dbengine)()
+    yield session
+    session.rollback()
+    session.close()
+
+
+def add_release(dbsession, release_dir, content):
+    release = models.Release(release_dir=release_dir, file=f"{release_dir}.zip", catalog_no=release_dir)
+    release.release_page = models.ReleasePage(content=content)
+    dbsession.add(release)
+    dbsession.flush()
+    return release
+
+
+def pages_of(*release_dirs, source="1"):
+    pages = {INDEX_PATH: ("/index2.htm", source)}
+    for release_dir in release_dirs:
+        pages[release_page_path(release_dir)] = (f"/Releases/{release_dir}/", source)
+    return pages
+
+
+def test_get_pages_hashes_source_data(dbsession):
+    a = add_release(dbsession, "export_a", "<p>a</p>")
+    add_release(dbsession, "export_b", "<p>b</p>")
+
+    before = get_pages(dbsession, SETTINGS, "https://20kbps.net")
+    assert before[release_page_path("export_a")][0] == "/Releases/export_a/"
+
+    a.release_page.content = "<p>changed</p>"
+    dbsession.flush()
+    after = get_pages(dbsession, SETTINGS, "https://20kbps.net")
+    assert after[release_page_path("export_a")] != before[release_page_path("export_a")]
+    assert after[release_page_path("export_b")] == before[release_page_path("export_b")]
+    assert after[INDEX_PATH] == before[INDEX_PATH]
+
+    # The base URL ends up in absolute URLs of every page
+    other_base = get_pages(dbsession, SETTINGS, "https://mirror.example.com")
+    assert other_base[release_page_path("export_b")] != before[release_page_path("export_b")]
+
+
+def test_local_export_rewrites_changed_release_only(dbsession, tmp_path):
+    a = add_release(dbsession, "export_a", "<p>a</p>")
+    add_release(dbsession, "export_b", "<p>b</p>")
+    writer, app = LocalWriter(str(tmp_path)), FakeApp()
+
+    pages = get_pages(dbsession, SETTINGS, "https://20kbps.net")
+    assert export(app, pages, writer, base_url="https://20kbps.net") == (len(pages), 0)
+    assert (tmp_path / "Releases" / "export_a" / "index.html").read_text() == (
+        "<html>https://20kbps.net/Releases/export_a/</html>"
+    )
+    manifest = json.loads((tmp_path / MANIFEST_FILE).read_text())
+    assert manifest == {"gzip": False, "pages": {path: source for path, (_, source) in pages.items()}}
+
+    a.release_page.content = "<p>changed</p>"
+    dbsession.flush()
+    app.rendered.clear()
+    pages = get_pages(dbsession, SETTINGS, "https://20kbps.net")
+    assert export(app, pages, writer, base_url="https://20kbps.net") == (1, 0)
+    assert app.rendered == ["/Releases/export_a/"]
+
+    # --full re-renders everything
+    app.rendered.clear()
+    assert export(app, pages, writer, base_url="https://20kbps.net", full=True) == (len(pages), 0)
+    assert len(app.rendered) == len(pages)
+
+
+def test_export_deletes_removed_pages(tmp_path):
+    writer, app = LocalWriter(str(tmp_path)), FakeApp()
+    export(app, pages_of("a", "b"), writer, gzip_variants=True)
+    assert (tmp_path / "Releases" / "b" / "index.html.gz").exists()
+
+    assert export(app, pages_of("a"), writer, gzip_variants=True) == (0, 1)
+    assert not (tmp_path / "Releases" / "b" / "index.html").exists()
+    assert not (tmp_path / "Releases" / "b" / "index.html.gz").exists()
+    assert (tmp_path / "Releases" / "a" / "index.html").exists()
+    manifest = json.loads((tmp_path / MANIFEST_FILE).read_text())
+    assert set(manifest["pages"]) == {INDEX_PATH, "Releases/a/index.html"}
+
+
+def test_export_gzip_variants(tmp_path):
+    writer, app = LocalWriter(str(tmp_path)), FakeApp()
+    export(app, pages_of("a"), writer, gzip_variants=True)
+
+    page = tmp_path / "Releases" / "a" / "index.html"
+    assert gzip.decompress((tmp_path / "Releases" / "a" / "index.html.gz").read_bytes()) == page.read_bytes()
+
+    # Switching --gzip off (or on) re-renders every page
+    app.rendered.clear()
+    assert export(app, pages_of("a"), writer) == (2, 0)
+    assert json.loads((tmp_path / MANIFEST_FILE).read_text())["gzip"] is False
+
+
+def test_export_retries_failed_pages(tmp_path):
+    writer, app = LocalWriter(str(tmp_path)), FakeApp()
+    app.fail.add("/Releases/b/")
+    assert export(app, pages_of("a", "b"), writer) == (2, 0)
+    assert "Releases/b/index.html" not in json.loads((tmp_path / MANIFEST_FILE).read_text())["pages"]
+
+    app.fail.clear()
+    app.rendered.clear()
+    assert export(app, pages_of("a", "b"), writer) == (1, 0)
+    assert app.rendered == ["/Releases/b/"]
+
+
+def test_bucket_writer(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setattr(storage_client, "get_storage_client", lambda: storage)
+    writer, app = BucketWriter("site/"), FakeApp()
+
+    export(app, pages_of("a", "b"), writer, gzip_variants=True)
+    assert set(storage.objects) == {
+        f"site/{MANIFEST_FILE}",
+        f"site/{INDEX_PATH}", f"site/{INDEX_PATH}.gz",
+        "site/Releases/a/index.html", "site/Releases/a/index.html.gz",
+        "site/Releases/b/index.html", "site/Releases/b/index.html.gz",
+    }
+
+    # The manifest is read back from the bucket
+    app.rendered.clear()
+    assert export(app, pages_of("a"), writer, gzip_variants=True) == (0, 1)
+    assert app.rendered == []
+    assert "site/Releases/b/index.html" not in storage.objects
+    assert "site/Releases/b/index.html.gz" not in storage.objects
@@ -0,0 +1,97 @@
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+import pytest
+
+from pyramidprj import models
+from pyramidprj.tweens import conditional_response_tween_factory
+
+
+SETTINGS = {
+    "static_base": "https://static.example.com",
+    "http_cache_control": "index2 = public, max-age=60",
+}
+
+
+@pytest.fixture
+def dbsession(dbengine):
+    session = models.get_session_factory(dbengine)()
+    session.query(models.IndexRecord).delete()
+    session.add(models.IndexRecord(date="01. Jan 20", body="foo"))
+    session.flush()
+    yield session
+    session.rollback()
+    session.close()
+
+
+@pytest.fixture
+def registry():
+    with testing.testConfig(settings=SETTINGS) as config:
+        config.add_route("index2", "/index2.htm")
+        config.commit()
+        yield config.registry
+
+
+@pytest.fixture
+def get(registry, dbsession):
+    rendered = []
+
+    def handler(request):
+        rendered.append(request.path)
+        return Response(body=b"index", content_type="text/html")
+
+    tween = conditional_response_tween_factory(handler, registry)
+
+    def get(path="/index2.htm", host="example.com", **headers):
+        request = Request.blank(path, headers=headers, environ={"HTTP_HOST": host})
+        request.registry = registry
+        request.dbsession = dbsession
+        return tween(request)
+
+    get.rendered = rendered
+    return get
+
+
+def test_sets_validators_and_cache_headers(get):
+    response = get()
+    assert response.status_code == 200
+    assert response.etag
+    assert response.last_modified is not None
+    assert response.headers["Cache-Control"] == "public, max-age=60"
+    assert response.headers["Surrogate-Key"] == "index2"
+
+
+def test_if_none_match_is_answered_without_rendering(get):
+    etag = get().etag
+
+    response = get(**{"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.etag == etag
+    assert response.headers["Cache-Control"] == "public, max-age=60"
+    assert get.rendered == ["/index2.htm"]
+
+    assert get(**{"If-None-Match": '"other"'}).status_code == 200
+    assert len(get.rendered) == 2
+
+
+def test_if_modified_since(get):
+    last_modified = get().headers["Last-Modified"]
+    assert get(**{"If-Modified-Since": last_modified}).status_code == 304
+    assert get(**{"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}).status_code == 200
+
+
+def test_etag_changes_with_content_and_host(get, dbsession):
+    etag = get().etag
+    assert get(host="other.example.com").etag != etag
+
+    dbsession.add(models.IndexRecord(date="02. Jan 20", body="bar"))
+    dbsession.flush()
+    response = get(**{"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.etag != etag
+
+
+def test_other_pages_are_passed_through(get):
+    response = get("/admin/")
+    assert response.status_code == 200
+    assert response.etag is None
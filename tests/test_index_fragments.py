@@ -0,0 +1,120 @@
+from datetime import datetime
+
+from pyramid import testing
+import pytest
+
+from pyramidprj import models
+from pyramidprj.index_fragments import IndexFragmentCache
+from pyramidprj.link_rewriter import rewrite_index_record
+
+
+STATIC_BASE = "https://static.example.com"
+
+SETTINGS = {"static_base": STATIC_BASE}
+
+
+@pytest.fixture
+def dbsession(dbengine):
+    session = models.get_session_factory(dbengine)()
+    session.query(models.IndexRecord).delete()
+    yield session
+    session.rollback()
+    session.close()
+
+
+@pytest.fixture
+def request_(dbsession):
+    with testing.testConfig(settings=SETTINGS) as config:
+        config.include("pyramid_jinja2")
+        yield testing.DummyRequest(dbsession=dbsession)
+
+
+@pytest.fixture
+def cache():
+    cache = IndexFragmentCache()
+    render = cache._render
+    cache.rendered = []
+
+    def _render(request, ir, fingerprint):
+        cache.rendered.append(ir.id)
+        return render(request, ir, fingerprint)
+
+    cache._render = _render
+    return cache
+
+
+def add_record(dbsession, body, settings=SETTINGS):
+    ir = models.IndexRecord(date="18. Oct 26", body=body)
+    rewrite_index_record(ir, settings)
+    dbsession.add(ir)
+    dbsession.flush()
+    return ir
+
+
+def test_rows_in_id_desc_order(dbsession, request_, cache):
+    records = [add_record(dbsession, f"<p>record {i}</p>") for i in range(3)]
+
+    html = cache.assemble(request_)
+    positions = [html.index(f"record {i}") for i in range(3)]
+    assert positions == sorted(positions, reverse=True)
+    assert html.count('<tr valign="top">') == 3
+    assert sorted(cache.rendered) == sorted(ir.id for ir in records)
+
+
+def test_only_changed_records_are_rerendered(dbsession, request_, cache):
+    a, b, c = [add_record(dbsession, f"<p>record {i}</p>") for i in range(3)]
+    cache.assemble(request_)
+    cache.rendered.clear()
+
+    assert "record 1" in cache.assemble(request_)
+    assert cache.rendered == []
+
+    # Like `upsert_index_record` does; `updated_at` is bumped on flush
+    b.body = "<p>changed</p>"
+    rewrite_index_record(b, SETTINGS)
+    dbsession.flush()
+    html = cache.assemble(request_)
+    assert cache.rendered == [b.id]
+    assert "changed" in html and "record 1" not in html
+
+
+def test_fingerprint_change_rerenders_all(dbsession, request_, cache):
+    records = [add_record(dbsession, f'<img src="/rss.png">{i}') for i in range(2)]
+    cache.assemble(request_)
+    cache.rendered.clear()
+
+    with testing.testConfig(settings={"static_base": "https://other.example.com"}) as config:
+        config.include("pyramid_jinja2")
+        html = cache.assemble(testing.DummyRequest(dbsession=dbsession))
+    assert sorted(cache.rendered) == sorted(ir.id for ir in records)
+    # Rewritten at render time, since the stored rewritten content is stale
+    assert html.count('src="https://other.example.com/rss.png"') == 2
+
+
+def test_stale_record_keeps_table_cells(dbsession, request_, cache):
+    add_record(dbsession, 'a</td><td><img src="/rss.png">b', settings={"static_base": "https://old.example.com"})
+
+    html = cache.assemble(request_)
+    assert f'a</td><td><img src="{STATIC_BASE}/rss.png"/>b' in html
+
+
+def test_deleted_records_are_dropped(dbsession, request_, cache):
+    a, b = add_record(dbsession, "<p>a</p>"), add_record(dbsession, "<p>b</p>")
+    cache.assemble(request_)
+    assert set(cache.fragments) == {a.id, b.id}
+
+    dbsession.delete(a)
+    dbsession.flush()
+    html = cache.assemble(request_)
+    assert set(cache.fragments) == {b.id}
+    assert "<p>a</p>" not in html and "<p>b</p>" in html
+
+
+def test_version_is_updated_at_and_fingerprint(dbsession, request_, cache):
+    ir = add_record(dbsession, "<p>x</p>")
+    ir.updated_at = datetime(2000, 1, 1)
+    dbsession.flush()
+    cache.assemble(request_)
+
+    version, _ = cache.fragments[ir.id]
+    assert version[0] == datetime(2000, 1, 1)
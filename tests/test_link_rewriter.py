@@ -0,0 +1,150 @@
+import logging
+
+from bs4 import BeautifulSoup
+from pyramid import testing
+from pyramid.response import Response
+import pytest
+
+from pyramidprj import link_rewriter, models
+from pyramidprj.tweens import rewrite_links
+
+
+STATIC_BASE = "https://static.example.com"
+
+SETTINGS = {"static_base": STATIC_BASE}
+
+
+FRAGMENTS = [
+    '<p>hi <a href="http://20kbps.sofapause.ch/Releases/x.zip">zip</a> <img src="/ico/download.png"></p>',
+    'foo <a href="Releases/foo/bar/">page</a> (<a href="Releases/foo_-_bar-(20k1)-2020.zip">zip</a>)',
+    '<b>x</b><img src="record16.ico"><img src=cover.jpg><a href=\'http://20kbps.sofapause.ch/humans.txt\'>h</a>',
+    '<iframe src="http://archive.org/embed/x"></iframe>',
+    '<a href="http://20kbps.sofapause.ch/?a=1&amp;b=2">q</a> <A HREF="/rss.png" href="/humans.txt">dup</A>',
+    '<a href="/Releases/x.rar" src="/humans.txt">final</a><link href="/css/relpage.css">',
+    '<script>var s = "<a href=\'/humans.txt\'>";</script><a href="/humans.txt">after script</a>',
+    '<p>x</p><!-- <img src="/rss.png"> --><img src="/rss.png" alt="a > b">',
+    '<textarea><img src="/rss.png"></textarea><meta content="/20kbps.xml">',
+]
+
+DOCUMENTS = [
+    '<html><head><link rel="stylesheet" href="/css/relpage.css"></head>'
+    '<body><img src="cover.jpg"><a href="http://20kbps.sofapause.ch/humans.txt">h</a></body></html>',
+    '<!DOCTYPE html><html><body><p><img src="https://static.example.com/Releases/baz/cover.jpg"></p></body></html>',
+]
+
+
+def normalize(html):
+    return str(BeautifulSoup(html, "html5lib"))
+
+
+@pytest.mark.parametrize("html", FRAGMENTS)
+@pytest.mark.parametrize("release_dir", [None, "foo/bar"])
+def test_fragment_parity(html, release_dir):
+    expected = link_rewriter._rewrite(html, STATIC_BASE, release_dir, "html5lib", fragment=True)
+    actual = link_rewriter._rewrite(html, STATIC_BASE, release_dir, "stream", fragment=True)
+    assert normalize(actual) == normalize(expected)
+
+
+@pytest.mark.parametrize("html", DOCUMENTS)
+def test_document_parity(html):
+    expected = link_rewriter._rewrite(html, STATIC_BASE, "baz", "html5lib", fragment=False)
+    actual = link_rewriter._rewrite(html, STATIC_BASE, "baz", "stream", fragment=False)
+    assert normalize(actual) == normalize(expected)
+
+
+def test_stream_copies_unchanged_markup():
+    html = "<p class=x>caf&eacute; <a href='/Releases/foo/bar/'>page</a></p>"
+    assert link_rewriter._rewrite_stream(html, STATIC_BASE, None) == html
+
+    html = '<a title="a &amp; b" href="/rss.png">rss</a>'
+    assert link_rewriter._rewrite_stream(html, STATIC_BASE, None) == (
+        f'<a title="a &amp; b" href="{STATIC_BASE}/rss.png">rss</a>'
+    )
+
+
+def test_parity_engine_logs_mismatch(caplog, monkeypatch):
+    html = FRAGMENTS[0]
+    with caplog.at_level(logging.WARNING, logger=link_rewriter.__name__):
+        rewritten = link_rewriter._rewrite(html, STATIC_BASE, None, "parity", fragment=True)
+    assert rewritten == link_rewriter._rewrite(html, STATIC_BASE, None, "html5lib", fragment=True)
+    assert not caplog.records
+
+    monkeypatch.setattr(link_rewriter, "_rewrite_stream", lambda html, static_base, release_dir: html)
+    with caplog.at_level(logging.WARNING, logger=link_rewriter.__name__):
+        link_rewriter._rewrite(html, STATIC_BASE, None, "parity", fragment=True)
+    assert "link_rewriter.parity_mismatch" in caplog.text
+
+
+def test_fragment_keeps_table_cells():
+    # Legacy index records close the cell they are rendered into and open new ones
+    html = 'a</td><td><img src="/rss.png">b'
+    assert link_rewriter.rewrite_fragment(html, SETTINGS, context="td") == (
+        f'a</td><td><img src="{STATIC_BASE}/rss.png"/>b'
+    )
+
+    html = '<b>x</b></td></tr><tr><td colspan="2"><a href="/Releases/x.zip">zip</a>'
+    assert link_rewriter.rewrite_fragment(html, SETTINGS, context="td") == (
+        f'<b>x</b></td></tr><tr><td colspan="2"><a href="{STATIC_BASE}/Releases/x.zip">zip</a>'
+    )
+
+
+def test_fragment_leaving_context_falls_back(caplog):
+    with caplog.at_level(logging.WARNING, logger=link_rewriter.__name__):
+        rewritten = link_rewriter.rewrite_fragment('x</table><img src="/rss.png">', SETTINGS, context="td")
+    assert rewritten == f'x<img src="{STATIC_BASE}/rss.png"/>'
+    assert "link_rewriter.fragment_leaves_context" in caplog.text
+
+
+def test_rewrite_index_record():
+    ir = models.IndexRecord(
+        body='<a href="http://20kbps.sofapause.ch/Releases/x.zip">zip</a></td><td><img src="/rss.png">',
+        custom_date_section=None,
+    )
+    link_rewriter.rewrite_index_record(ir, SETTINGS)
+
+    assert ir.body_rewritten == (
+        f'<a href="{STATIC_BASE}/Releases/x.zip">zip</a></td><td><img src="{STATIC_BASE}/rss.png"/>'
+    )
+    assert ir.custom_date_section_rewritten is None
+    assert ir.rewrite_fingerprint == link_rewriter.get_fingerprint(SETTINGS)
+    # The original is kept untouched
+    assert ir.body.startswith('<a href="http://20kbps.sofapause.ch/Releases/x.zip">')
+
+
+def test_rewrite_release_page():
+    rp = models.ReleasePage(
+        release=models.Release(release_dir="foo/bar"),
+        content='<img src="cover.jpg"><a href="/humans.txt">h</a>',
+        custom_tracklist=None,
+        custom_body='<html><body><img src="cover.png"></body></html>',
+    )
+    link_rewriter.rewrite_release_page(rp, SETTINGS)
+
+    assert rp.content_rewritten == (
+        f'<img src="{STATIC_BASE}/Releases/foo/bar/cover.jpg"/><a href="{STATIC_BASE}/humans.txt">h</a>'
+    )
+    assert rp.custom_tracklist_rewritten is None
+    assert f'<img src="{STATIC_BASE}/Releases/foo/bar/cover.png"/>' in rp.custom_body_rewritten
+    assert rp.rewrite_fingerprint == link_rewriter.get_fingerprint(SETTINGS)
+
+
+def test_fingerprint_changes_with_static_base_and_output_engine():
+    fingerprint = link_rewriter.get_fingerprint(SETTINGS)
+    assert link_rewriter.get_fingerprint({**SETTINGS, "link_rewriter_engine": "parity"}) == fingerprint
+    assert link_rewriter.get_fingerprint({**SETTINGS, "link_rewriter_engine": "stream"}) != fingerprint
+    assert link_rewriter.get_fingerprint({"static_base": "https://other.example.com"}) != fingerprint
+
+
+@pytest.mark.parametrize("links_rewritten", [False, True])
+def test_middleware_falls_back_for_stale_content(links_rewritten):
+    registry = testing.DummyResource(settings=SETTINGS)
+    request = testing.DummyRequest(matched_route=testing.DummyResource(name="index2"))
+    request.links_rewritten = links_rewritten
+    body = '<html><body><img src="/rss.png"></body></html>'
+
+    response = rewrite_links(request, Response(body), registry)
+
+    if links_rewritten:
+        assert response.text == body
+    else:
+        assert f'src="{STATIC_BASE}/rss.png"' in response.text
@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import os
+import zipfile
+
+import google_crc32c
+
+from pyramidprj.artifact_cache import Artifact
+from pyramidprj.manifest import checksums, compute_manifest, is_unchanged, verify_release_directory
+
+
+def b64(digest):
+    return base64.b64encode(digest).decode()
+
+
+ENTRY = {
+    "file": "01.mp3",
+    "size": 3,
+    "md5": b64(hashlib.md5(b"one").digest()),
+    "crc32c": b64(google_crc32c.Checksum(b"one").digest()),
+}
+
+
+class FakeStorage:
+    def __init__(self, objects):
+        self.objects = objects
+        self.prefixes = []
+
+    def list_metadata(self, prefix):
+        self.prefixes.append(prefix)
+        return {name: metadata for name, metadata in self.objects.items() if name.startswith(prefix)}
+
+
+def test_checksums_match_storage_metadata(tmp_path):
+    (tmp_path / "01.mp3").write_bytes(b"one")
+
+    assert checksums(str(tmp_path / "01.mp3")) == {"size": 3, "md5": ENTRY["md5"], "crc32c": ENTRY["crc32c"]}
+    assert compute_manifest([(str(tmp_path / "01.mp3"), "01.mp3")]) == [ENTRY]
+
+
+def test_checksums_of_zip_member(tmp_path):
+    with zipfile.ZipFile(tmp_path / "foo.zip", "w", zipfile.ZIP_DEFLATED) as f:
+        f.writestr("01.mp3", b"one")
+    artifact = Artifact("v1", str(tmp_path / "foo.zip"), str(tmp_path / "foo"), extracted=False)
+
+
+    def open_file(path):
+        return artifact.open(os.path.basename(path))
+
+    assert compute_manifest([(os.path.join(artifact.local_dir, "01.mp3"), "01.mp3")], open_file) == [ENTRY]
+    assert not os.path.exists(artifact.local_dir)
+
+
+def test_is_unchanged():
+    metadata = {"size": 3, "generation": 1, "md5": ENTRY["md5"], "crc32c": ENTRY["crc32c"]}
+    assert is_unchanged(ENTRY, metadata)
+    assert not is_unchanged(ENTRY, None)
+    assert not is_unchanged(ENTRY, {**metadata, "size": 4})
+    assert not is_unchanged(ENTRY, {**metadata, "md5": b64(hashlib.md5(b"two").digest())})
+
+
+def test_is_unchanged_falls_back_to_crc32c():
+    # Composite objects have no MD5
+    metadata = {"size": 3, "generation": 1, "md5": None, "crc32c": ENTRY["crc32c"]}
+    assert is_unchanged(ENTRY, metadata)
+    assert not is_unchanged(ENTRY, {**metadata, "crc32c": b64(google_crc32c.Checksum(b"two").digest())})
+
+
+def test_verify_release_directory():
+    metadata = {"size": 3, "generation": 1, "md5": ENTRY["md5"], "crc32c": ENTRY["crc32c"]}
+    manifest = [ENTRY, {**ENTRY, "file": "02.mp3"}, {**ENTRY, "file": "cover.jpg"}]
+    storage = FakeStorage({
+        "Releases/foo/01.mp3": metadata,
+        "Releases/foo/02.mp3": {**metadata, "size": 4},
+        "Releases/foo/notes.txt": metadata,
+        "Releases/foobar/cover.jpg": metadata,
+    })
+
+    assert verify_release_directory(storage, "foo", manifest) == {
+        "ok": False,
+        "missing": ["cover.jpg"],
+        "changed": ["02.mp3"],
+        "unexpected": ["notes.txt"],
+    }
+    # A single listing request, for the directory only
+    assert storage.prefixes == ["Releases/foo/"]
+
+
+def test_verify_release_directory_ignores_unexpected_files():
+    metadata = {"size": 3, "generation": 1, "md5": ENTRY["md5"], "crc32c": ENTRY["crc32c"]}
+    storage = FakeStorage({"Releases/foo/01.mp3": metadata, "Releases/foo/notes.txt": metadata})
+
+    result = verify_release_directory(storage, "foo", [ENTRY])
+    assert result["ok"] is True
+    assert result["unexpected"] == ["notes.txt"]
@@ -0,0 +1,124 @@
+import threading
+
+from pyramid.response import Response
+
+from pyramidprj.page_cache import INDEX_KEY, PageCache, release_key
+
+
+def renderer(body=b"page", status=200):
+    calls = []
+
+    def render():
+        calls.append(1)
+        return Response(body=body + b"%d" % len(calls), status=status, content_type="text/html", charset="utf-8")
+
+    return render, calls
+
+
+def test_get_or_render_caches_per_variant():
+    cache = PageCache(1024)
+    render, calls = renderer()
+
+    assert cache.get_or_render(INDEX_KEY, render, "http://a").body == b"page1"
+    assert cache.get_or_render(INDEX_KEY, render, "http://a").body == b"page1"
+    assert cache.get_or_render(INDEX_KEY, render, "http://b").body == b"page2"
+    assert len(calls) == 2
+    response = cache.get_or_render(INDEX_KEY, render, "http://a")
+    assert (response.content_type, response.charset) == ("text/html", "utf-8")
+
+
+def test_only_200_is_cached():
+    cache = PageCache(1024)
+    render, calls = renderer(status=404)
+
+    cache.get_or_render(INDEX_KEY, render)
+    cache.get_or_render(INDEX_KEY, render)
+    assert len(calls) == 2
+
+
+def test_invalidate_drops_all_variants_of_key():
+    cache = PageCache(1024)
+    render, calls = renderer()
+    for variant in ("http://a", "http://b"):
+        cache.get_or_render(release_key("foo/bar"), render, variant)
+    cache.get_or_render(release_key("baz"), render)
+
+    cache.invalidate(release_key("foo/bar"))
+    assert cache.get(release_key("foo/bar"), "http://a") is None
+    assert cache.get(release_key("foo/bar"), "http://b") is None
+    assert cache.get(release_key("baz")) is not None
+    assert cache.size == len(b"page3")
+
+
+def test_render_started_before_invalidation_is_not_stored():
+    cache = PageCache(1024)
+
+    def render():
+        # The data changes while the page is rendered
+        cache.invalidate(INDEX_KEY)
+        return Response(body=b"stale")
+
+    assert cache.get_or_render(INDEX_KEY, render).body == b"stale"
+    assert cache.get(INDEX_KEY) is None
+
+    render, calls = renderer()
+    cache.get_or_render(INDEX_KEY, render)
+    assert cache.get(INDEX_KEY).body == b"page1"
+
+    cache.clear()
+    assert cache.get(INDEX_KEY) is None
+    assert cache.size == 0
+
+
+def test_evicts_least_recently_used():
+    cache = PageCache(10)
+    for name in ("a", "b", "c"):
+        cache.get_or_render(release_key(name), lambda: Response(body=b"xxxx"))
+    # a and b don't fit with c
+    assert cache.get(release_key("a")) is None
+    assert cache.get(release_key("b")) is not None
+
+    cache.get_or_render(release_key("d"), lambda: Response(body=b"xxxx"))
+    assert cache.get(release_key("b")) is not None
+    assert cache.get(release_key("c")) is None
+    assert cache.size == 8
+
+    # Too large to be cached at all
+    cache.get_or_render(release_key("e"), lambda: Response(body=b"x" * 11))
+    assert cache.get(release_key("e")) is None
+    assert cache.size == 8
+
+
+def test_disabled():
+    cache = PageCache(0)
+    render, calls = renderer()
+    cache.get_or_render(INDEX_KEY, render)
+    cache.get_or_render(INDEX_KEY, render)
+    assert len(calls) == 2
+
+
+def test_single_flight():
+    cache = PageCache(1024)
+    rendering = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def render():
+        calls.append(1)
+        rendering.set()
+        release.wait(5)
+        return Response(body=b"page")
+
+    bodies = []
+    threads = [threading.Thread(target=lambda: bodies.append(cache.get_or_render(INDEX_KEY, render).body))]
+    threads[0].start()
+    rendering.wait(5)
+    threads += [threading.Thread(target=lambda: bodies.append(cache.get_or_render(INDEX_KEY, render).body)) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert bodies == [b"page"] * 4
+    assert len(calls) == 1
@@ -0,0 +1,196 @@
+from datetime import datetime
+import logging
+from types import SimpleNamespace
+
+from pyramid import testing
+import pytest
+from sqlalchemy import event
+import transaction
+
+from pyramidprj import models, read_model, release_service
+from pyramidprj.link_rewriter import get_fingerprint
+from pyramidprj.page_cache import release_key
+from pyramidprj.release_resolver import ReleaseResolver
+from pyramidprj.release_service import ReleaseService, RequestType, TaskState
+from pyramidprj.tweens import _get_content_version, resolve_release
+from pyramidprj.views.default import Releases, update_release
+
+
+STATIC_BASE = "https://static.example.com"
+
+SETTINGS = {"static_base": STATIC_BASE}
+
+RELEASE_DIR = "read_model/foo"
+
+
+@pytest.fixture
+def dbsession(dbengine):
+    session = models.get_session_factory(dbengine)()
+    yield session
+    session.rollback()
+    session.close()
+
+
+@pytest.fixture
+def queries(dbengine):
+    """Statements executed on the engine during the test."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(dbengine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(dbengine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(release_service, "settings", SETTINGS)
+    resolver = ReleaseResolver(10, 300)
+    monkeypatch.setattr("pyramidprj.tweens.get_release_resolver", lambda: resolver)
+    with testing.testConfig(settings=SETTINGS) as config:
+        config.include("pyramid_jinja2")
+        yield config
+
+
+def create_release(dbsession, release_dir=RELEASE_DIR):
+    file = f"{release_dir.replace('/', '_')}-(20k999)-2026.zip"
+    data = {
+        "catalog_no": "20k999",
+        "release_dir": release_dir,
+        "file": file,
+        "release_data": {"date": "2026-10-18", "relname": "Foo", "player": '<img src="/rss.png">'},
+        "player_files": [
+            {"file": "02.mp3", "number": 2, "title": "Two", "duration_secs": 3725},
+            {"file": "01.mp3", "number": 1, "title": "One", "duration_secs": 65},
+        ],
+    }
+    service = SimpleNamespace(task_state={(RequestType.UPLOAD, file): TaskState(data=data)})
+    ReleaseService.create_database_objects(service, dbsession, file, '<a href="/humans.txt">h</a>', "ir")
+    dbsession.flush()
+    return dbsession.query(models.Release).filter(models.Release.release_dir == release_dir).one()
+
+
+def release_request(dbsession, release_dir=RELEASE_DIR, **kw):
+    request = testing.DummyRequest(path=f"/Releases/{release_dir}/", dbsession=dbsession, **kw)
+    resolve_release(request, testing.DummyResource(settings=SETTINGS))
+    return request
+
+
+def test_create_writes_row(config, dbsession):
+    release = create_release(dbsession)
+
+    page = dbsession.get(models.PublicReleasePage, RELEASE_DIR)
+    assert page.release_id == release.id
+    assert page.file == release.file
+    assert page.content_rewritten == f'<a href="{STATIC_BASE}/humans.txt">h</a>'
+    assert page.release_data_rewritten["player"] == f'<img src="{STATIC_BASE}/rss.png"/>'
+    assert page.rewrite_fingerprint == get_fingerprint(SETTINGS)
+    assert page.tracklist == [
+        {"file": "01.mp3", "title": "One", "duration": "01:05", "duration_iso8601": "PT1M5S"},
+        {"file": "02.mp3", "title": "Two", "duration": "01:02:05", "duration_iso8601": "PT1H2M5S"},
+    ]
+    assert page.updated_at is not None
+
+
+def test_update_release_syncs_row(config, dbsession):
+    release = create_release(dbsession)
+    page = dbsession.get(models.PublicReleasePage, RELEASE_DIR)
+    page.updated_at = datetime(2000, 1, 1)
+    dbsession.flush()
+
+    # Syncing without changes doesn't touch the row
+    read_model.sync_public_release_page(dbsession, release, SETTINGS)
+    dbsession.flush()
+    assert page.updated_at == datetime(2000, 1, 1)
+
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    request = testing.DummyRequest(
+        dbsession=dbsession,
+        tm=tm,
+        post={
+            "release_id": str(release.id),
+            "release_data": '{"date": "2026-10-18", "relname": "Bar"}',
+            "page_content": "<p>new</p>",
+            "custom_body": "",
+        },
+    )
+    update_release(request)
+    dbsession.flush()
+    tm.abort()
+
+    assert page.release_data == {"date": "2026-10-18", "relname": "Bar"}
+    assert page.content == page.content_rewritten == "<p>new</p>"
+    assert page.updated_at > datetime(2000, 1, 1)
+
+
+def test_delete_removes_row(config, dbsession):
+    release = create_release(dbsession)
+
+    ReleaseService.delete_database_objects(None, dbsession, release.id)
+    dbsession.flush()
+
+    assert dbsession.get(models.PublicReleasePage, RELEASE_DIR) is None
+    assert read_model.get_public_release_page(dbsession, RELEASE_DIR, SETTINGS) is None
+
+
+def test_missing_row_is_built_and_written(config, dbsession, caplog):
+    release = create_release(dbsession)
+    read_model.delete_public_release_page(dbsession, RELEASE_DIR)
+    dbsession.expunge_all()
+
+    with caplog.at_level(logging.INFO, logger=read_model.__name__):
+        page = read_model.get_public_release_page(dbsession, RELEASE_DIR, SETTINGS)
+    assert "read_model.miss" in caplog.text
+    assert page.release_id == release.id
+    dbsession.expunge_all()
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger=read_model.__name__):
+        assert read_model.get_public_release_page(dbsession, RELEASE_DIR, SETTINGS).release_id == release.id
+    assert "read_model.miss" not in caplog.text
+
+
+def test_release_without_page_has_no_row(config, dbsession):
+    dbsession.add(models.Release(release_dir="read_model/legacy"))
+    dbsession.flush()
+
+    assert read_model.get_public_release_page(dbsession, "read_model/legacy", SETTINGS) is None
+    assert dbsession.get(models.PublicReleasePage, "read_model/legacy") is None
+
+
+def test_release_page_is_a_single_row_read(config, dbsession, queries):
+    create_release(dbsession)
+    dbsession.expunge_all()
+    queries.clear()
+
+    request = release_request(dbsession)
+    assert request.public_release_page.release_dir == RELEASE_DIR
+    assert len(queries) == 1
+
+    response = Releases(request)
+    assert len(queries) == 1
+    assert request.links_rewritten is True
+    assert "<title>Foo by" in response.text
+    assert response.text.index("One") < response.text.index("Two")
+
+
+def test_content_version_follows_row(config, dbsession):
+    release = create_release(dbsession)
+    page = dbsession.get(models.PublicReleasePage, RELEASE_DIR)
+    page.updated_at = datetime(2000, 1, 1)
+    dbsession.flush()
+
+    request = release_request(dbsession)
+    assert _get_content_version(request, release_key(RELEASE_DIR)) == (
+        (release.id, datetime(2000, 1, 1)), datetime(2000, 1, 1)
+    )
+
+    release.release_page.content = "<p>changed</p>"
+    read_model.sync_public_release_page(dbsession, release, SETTINGS)
+    dbsession.flush()
+    version, last_modified = _get_content_version(release_request(dbsession), release_key(RELEASE_DIR))
+    assert last_modified > datetime(2000, 1, 1)
+    assert version == (release.id, last_modified)
@@ -0,0 +1,248 @@
+"""A release going through PREVIEW, UPLOAD, the commit and the stages after it, against the fake storage backend,
+in each mode of `ReleaseService`.
+"""
+import atexit
+import io
+import os
+import time
+import zipfile
+from types import SimpleNamespace
+
+from pyramid import testing
+import pytest
+import transaction
+
+from pyramidprj import audio_probe, models, release_service
+from pyramidprj.artifact_cache import ArtifactCache
+from pyramidprj.audio_probe import AudioProbe
+from pyramidprj.fake_storage import FakeStorageClient
+from pyramidprj.manifest import verify_release_directory
+from pyramidprj.page_cache import PageCache
+from pyramidprj.release_service import ReleaseService, RequestType, queue_stages_on_commit
+from pyramidprj.storage_client import CHUNK_GRANULARITY
+from pyramidprj.task_store import TaskStore
+
+
+STATIC_BASE = "https://static.example.com"
+
+FILE = "foo_-_bar-(20k999)-2026.zip"
+
+# Title, album and artist, read by `FakeMutagen`. The first track is larger than an upload chunk.
+MEMBERS = {
+    "01-intro.mp3": b"Intro|Flow Album|Foo\n" + os.urandom(2 * CHUNK_GRANULARITY),
+    "02-outro.mp3": b"Outro|Flow Album|Foo\n",
+    "cover.jpg": b"jpg",
+}
+
+
+class FakeMutagen:
+    """Stands in for `mutagen.File`, reading the tags from the first line of the file."""
+    def File(self, f):
+        title, album, artist = f.readline().decode().strip().split("|")
+        return SimpleNamespace(
+            tags={"TIT2": [title], "TALB": [album], "TPE1": [artist]},
+            info=SimpleNamespace(length=61.0),
+        )
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b""):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeSession:
+    """Serves the objects of the fake storage backend the way the static site does."""
+    def __init__(self, storage):
+        self.storage = storage
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        remote = url.removeprefix(f"{STATIC_BASE}/")
+        self.requests.append(remote)
+        if not self.storage.exists(remote):
+            return FakeResponse(404)
+        return FakeResponse(200, self.storage.download_bytes(remote))
+
+
+class FakeArchiveOrgClient:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_release(self, release, local_dir, on_progress=None, check_cancelled=None):
+        self.uploads.append((release.release_dir, sorted(os.listdir(local_dir))))
+        return "20k999"
+
+    def shutdown(self):
+        pass
+
+
+class FakeJanitor:
+    def sweep(self, busy_files=()):
+        return []
+
+
+def wait_for_task(service, key, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        task_state = service.task_state.get(key)
+        if task_state is not None and task_state.success is not None:
+            assert task_state.success, task_state.exception
+            return task_state
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = FakeStorageClient(str(tmp_path / "bucket"))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as f:
+        for name, data in MEMBERS.items():
+            f.writestr(name, data)
+    storage.upload_bytes(buf.getvalue(), f"Releases/{FILE}", "application/zip")
+    return storage
+
+
+@pytest.fixture
+def session_factory(dbengine, monkeypatch):
+    monkeypatch.setattr(release_service, "settings", {"static_base": STATIC_BASE})
+    monkeypatch.setattr(release_service, "get_page_cache", lambda: PageCache(1024))
+    monkeypatch.setattr(release_service, "purge", lambda *keys: None)
+    session_factory = models.get_session_factory(dbengine)
+    with session_factory.begin() as session:
+        session.query(models.Task).delete()
+    yield session_factory
+    with session_factory.begin() as session:
+        for release in session.query(models.Release).filter(models.Release.file == FILE):
+            ReleaseService.delete_database_objects(None, session, release.id)
+
+
+@pytest.fixture
+def make_service(storage, session_factory, monkeypatch, tmp_path):
+    monkeypatch.setattr(audio_probe, "mutagen", FakeMutagen())
+    services = []
+
+    def make_service(archive_org=None, **kw):
+        # The stages after the commit are tested on their own
+        kw.setdefault("auto_stages", ())
+        cache = ArtifactCache(str(tmp_path / "tmp"), STATIC_BASE, lambda: storage)
+        cache.session = FakeSession(storage)
+        service = ReleaseService(
+            TaskStore(session_factory),
+            FakeJanitor(),
+            cache,
+            AudioProbe(str(tmp_path / "tmp")),
+            session_factory,
+            lambda: storage,
+            lambda: archive_org,
+            n_workers=1,
+            upload_chunk_size=CHUNK_GRANULARITY,
+            **kw,
+        )
+        services.append(service)
+        monkeypatch.setattr(release_service, "get_release_service", lambda: service)
+        return service
+
+    yield make_service
+    for service in services:
+        service.shutdown(timeout=5)
+        atexit.unregister(service.shutdown)
+
+
+def run_release(service, session_factory):
+    """Preview, upload and commit the release, the way the views do. Return the id of the new release."""
+    service.request_preview(FILE)
+    preview = wait_for_task(service, (RequestType.PREVIEW, FILE))
+    assert preview.data["release_dir"] == "foo/flow_album"
+    assert [pf["title"] for pf in preview.data["player_files"]] == ["Intro", "Outro"]
+
+    service.request_upload(FILE)
+    wait_for_task(service, (RequestType.UPLOAD, FILE))
+
+    tm = transaction.TransactionManager(explicit=True)
+    with tm:
+        session = models.get_tm_session(session_factory, tm)
+        artifacts = service.create_database_objects(session, FILE, "<p>Foo</p>", "<p>Flow Album</p>")
+        queue_stages_on_commit(testing.DummyRequest(tm=tm), FILE, artifacts)
+    return artifacts.release_id
+
+
+def check_release(storage, session_factory, release_id):
+    with session_factory() as session:
+        release = session.get(models.Release, release_id)
+        assert release.release_dir == "foo/flow_album"
+        assert [pf.title for pf in release.release_page.player_files] == ["Intro", "Outro"]
+        assert verify_release_directory(storage, release.release_dir, release.manifest)["ok"]
+    for name, data in MEMBERS.items():
+        assert storage.download_bytes(f"Releases/foo/flow_album/{name}") == data
+
+
+@pytest.mark.parametrize("zip_streaming", [False, True])
+def test_release(make_service, storage, session_factory, tmp_path, zip_streaming):
+    service = make_service(zip_streaming=zip_streaming)
+
+    release_id = run_release(service, session_factory)
+
+    check_release(storage, session_factory, release_id)
+    local_dir = service.task_state[RequestType.PREVIEW, FILE].data["local_dir"]
+    # Nothing is extracted in zero-extraction mode
+    assert os.path.isdir(local_dir) is not zip_streaming
+
+
+@pytest.mark.parametrize("zip_streaming", [False, True])
+def test_release_with_pipeline(make_service, storage, session_factory, zip_streaming):
+    service = make_service(zip_streaming=zip_streaming, pipeline=True)
+
+    release_id = run_release(service, session_factory)
+
+    check_release(storage, session_factory, release_id)
+    staged = service.task_state[RequestType.PREVIEW, FILE].data["staged"]
+    assert sorted(os.path.basename(s["to"]) for s in staged) == sorted(MEMBERS)
+    assert all(s["state"] == "succeeded" for s in staged)
+    # UPLOAD copied the staged objects, and deleted them afterwards
+    uploads = service.task_state[RequestType.UPLOAD, FILE].data["completed_uploads"]
+    assert all(u.get("staged") for u in uploads)
+    assert storage.list_metadata("Staging/") == {}
+
+
+@pytest.mark.parametrize("zip_streaming", [False, True])
+def test_stages_after_commit(make_service, storage, session_factory, zip_streaming):
+    archive_org = FakeArchiveOrgClient()
+    warmed = []
+    service = make_service(
+        archive_org,
+        zip_streaming=zip_streaming,
+        auto_stages=(RequestType.IA_UPLOAD, RequestType.WARM_UP),
+        warm_up_release=lambda release_dir: warmed.append(release_dir) or 2,
+    )
+
+    release_id = run_release(service, session_factory)
+
+    ia_upload = wait_for_task(service, (RequestType.IA_UPLOAD, FILE))
+    assert ia_upload.data["release_id"] == release_id
+    assert archive_org.uploads == [("foo/flow_album", sorted(MEMBERS))]
+    # The previewed zip is reused from the artifact cache
+    assert ia_upload.data["zip_version"] == service.task_state[RequestType.PREVIEW, FILE].data["zip_version"]
+    assert service.artifact_cache.session.requests == [f"Releases/{FILE}"]
+    with session_factory() as session:
+        release = session.get(models.Release, release_id)
+        assert release.release_data["archive"] == "https://archive.org/details/20k999"
+
+    # After the commit, and again after the archive.org URL has been added to the page
+    deadline = time.monotonic() + 10
+    while len(warmed) < 2:
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.02)
+    assert warmed == ["foo/flow_album", "foo/flow_album"]
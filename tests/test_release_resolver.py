@@ -0,0 +1,154 @@
+from cachetools import TTLCache
+from pyramid import testing
+import pytest
+from sqlalchemy import event
+import transaction
+
+from pyramidprj import models
+from pyramidprj.read_model import sync_public_release_page
+from pyramidprj.release_resolver import ReleaseResolver, forget_on_commit
+
+
+SETTINGS = {"static_base": "https://static.example.com"}
+
+
+@pytest.fixture
+def dbsession(dbengine):
+    session = models.get_session_factory(dbengine)()
+    yield session
+    session.rollback()
+    session.close()
+
+
+@pytest.fixture
+def queries(dbengine):
+    """Statements executed on the engine during the test."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(dbengine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(dbengine, "before_cursor_execute", before_cursor_execute)
+
+
+def add_release(dbsession, release_dir):
+    release = models.Release(release_dir=release_dir)
+    release.release_page = models.ReleasePage(content="<p>x</p>")
+    dbsession.add(release)
+    dbsession.flush()
+    sync_public_release_page(dbsession, release, SETTINGS)
+    dbsession.flush()
+    return release
+
+
+def test_negative_cache_hit_does_no_query(dbsession, queries):
+    resolver = ReleaseResolver(10, 300)
+    assert resolver.resolve(dbsession, "resolver/missing", SETTINGS) is None
+    n_queries = len(queries)
+    assert n_queries > 0
+
+    assert resolver.resolve(dbsession, "resolver/missing", SETTINGS) is None
+    assert len(queries) == n_queries
+
+
+def test_found_page_is_read_by_primary_key(dbsession, queries):
+    resolver = ReleaseResolver(10, 300)
+    release = add_release(dbsession, "resolver/found")
+    dbsession.expunge_all()
+    queries.clear()
+
+    page = resolver.resolve(dbsession, "resolver/found", SETTINGS)
+    assert page.release_id == release.id
+    assert len(queries) == 1
+    assert "resolver/found" not in resolver.negative
+
+
+def test_release_without_page_is_cached_as_miss(dbsession):
+    resolver = ReleaseResolver(10, 300)
+    dbsession.add(models.Release(release_dir="resolver/legacy"))
+    dbsession.flush()
+
+    assert resolver.resolve(dbsession, "resolver/legacy", SETTINGS) is None
+    assert "resolver/legacy" in resolver.negative
+
+
+def test_negative_cache_is_bounded(dbsession):
+    clock = [0]
+    resolver = ReleaseResolver(2, 300)
+    resolver.negative = TTLCache(maxsize=2, ttl=300, timer=lambda: clock[0])
+
+    for release_dir in ["a", "b", "c"]:
+        resolver.resolve(dbsession, release_dir, SETTINGS)
+    # Least recently used first out
+    assert list(resolver.negative) == ["b", "c"]
+
+    clock[0] = 301
+    assert len(resolver.negative) == 0
+
+
+def test_lookup_racing_with_forget_is_not_cached(dbsession, dbengine):
+    resolver = ReleaseResolver(10, 300)
+
+    # The release is created (and forgotten) while the lookup is running
+    def before_cursor_execute(*args):
+        resolver.forget("resolver/racing")
+
+    event.listen(dbengine, "before_cursor_execute", before_cursor_execute, once=True)
+    assert resolver.resolve(dbsession, "resolver/racing", SETTINGS) is None
+    assert "resolver/racing" not in resolver.negative
+
+    assert resolver.resolve(dbsession, "resolver/racing", SETTINGS) is None
+    assert "resolver/racing" in resolver.negative
+
+
+def test_create_is_forgotten_after_commit(dbsession, monkeypatch):
+    resolver = ReleaseResolver(10, 300)
+    monkeypatch.setattr("pyramidprj.release_resolver.get_release_resolver", lambda: resolver)
+    assert resolver.resolve(dbsession, "resolver/created", SETTINGS) is None
+
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    release = add_release(dbsession, "resolver/created")
+    forget_on_commit(testing.DummyRequest(tm=tm), "resolver/created")
+
+    # Not before the commit
+    assert resolver.resolve(dbsession, "resolver/created", SETTINGS) is None
+    tm.commit()
+    assert "resolver/created" not in resolver.negative
+
+    assert resolver.resolve(dbsession, "resolver/created", SETTINGS).release_id == release.id
+
+
+def test_delete_is_forgotten_after_commit(dbsession, monkeypatch):
+    resolver = ReleaseResolver(10, 300)
+    monkeypatch.setattr("pyramidprj.release_resolver.get_release_resolver", lambda: resolver)
+    release = add_release(dbsession, "resolver/deleted")
+    assert resolver.resolve(dbsession, "resolver/deleted", SETTINGS) is not None
+
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    forget_on_commit(testing.DummyRequest(tm=tm), "resolver/deleted")
+    dbsession.query(models.PublicReleasePage).filter(
+        models.PublicReleasePage.release_dir == "resolver/deleted"
+    ).delete()
+    dbsession.delete(release.release_page)
+    dbsession.delete(release)
+    dbsession.flush()
+    assert resolver.resolve(dbsession, "resolver/deleted", SETTINGS) is None
+    tm.commit()
+    assert "resolver/deleted" not in resolver.negative
+    assert resolver.resolve(dbsession, "resolver/deleted", SETTINGS) is None
+
+
+def test_aborted_change_is_not_forgotten(monkeypatch):
+    resolver = ReleaseResolver(10, 300)
+    monkeypatch.setattr("pyramidprj.release_resolver.get_release_resolver", lambda: resolver)
+    resolver.negative["resolver/aborted"] = True
+
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    forget_on_commit(testing.DummyRequest(tm=tm), "resolver/aborted")
+    tm.abort()
+    assert "resolver/aborted" in resolver.negative
@@ -0,0 +1,807 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+from types import SimpleNamespace
+import zipfile
+
+from google.api_core import exceptions as api_exceptions
+from pyramid import httpexceptions as exc, testing
+import pytest
+from sqlalchemy import event
+import transaction
+
+from pyramidprj import models, release_service
+from pyramidprj.artifact_cache import Artifact
+from pyramidprj.fake_storage import FakeStorageClient
+from pyramidprj.manifest import checksums, compute_manifest
+from pyramidprj.page_cache import PageCache
+from pyramidprj.read_model import sync_public_release_page
+from pyramidprj.release_service import (
+    COMMIT,
+    DEFAULT_AUTO_STAGES,
+    QueuedRequest,
+    ReleaseService,
+    RequestType,
+    StageArtifacts,
+    TaskCancelled,
+    TaskState,
+    queue_stages_on_commit,
+)
+from pyramidprj.storage_client import CHUNK_GRANULARITY
+from pyramidprj.task_store import CANCELLED, FAILED, QUEUED, RUNNING, SUCCEEDED, TaskStore
+from pyramidprj.views import default as views
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+class FakeJanitor:
+    def __init__(self):
+        self.sweeps = []
+
+    def sweep(self, busy_files=()):
+        self.sweeps.append(set(busy_files))
+        return []
+
+
+class FakeAudioProbe:
+    def shutdown(self):
+        pass
+
+
+class FakeUploadStorage:
+    """Records uploads, and the metadata of uploaded objects. `errors[remote]` holds the errors to raise, in
+    order, before an upload of `remote` succeeds. Uploads wait at `rendezvous`, if set, e.g. for other uploads
+    to be running.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploads = []
+        self.objects = {}
+        self.errors = {}
+        self.running = 0
+        self.max_running = 0
+        self.rendezvous = None
+
+    def upload(self, local, remote):
+        with self.lock:
+            errors = self.errors.get(remote)
+            if errors:
+                raise errors.pop(0)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        if self.rendezvous:
+            self.rendezvous.wait()
+        with self.lock:
+            self.running -= 1
+            self.uploads.append((local, remote))
+            self.objects[remote] = {"generation": 1, **checksums(local)}
+
+    def metadata(self, remote):
+        return self.objects.get(remote)
+
+    def list_metadata(self, prefix):
+        with self.lock:
+            return {remote: m for remote, m in self.objects.items() if remote.startswith(prefix)}
+
+    def delete(self, remote):
+        with self.lock:
+            del self.objects[remote]
+
+
+class FakeReleaseService(ReleaseService):
+    """Runs `handlers[request_type](file)` instead of the actual processing. Tasks whose state the handler has
+    set are finished when it returns. The steps that are run for real use `storage` and `archive_org` as
+    clients.
+    """
+
+    def __init__(
+        self, task_store, n_workers=2, storage=None, archive_org=None, auto_stages=DEFAULT_AUTO_STAGES, **handlers
+    ):
+        self.handlers = handlers
+        self.running = set()
+        self.overlaps = []
+        self.processed = []
+        super().__init__(
+            task_store,
+            FakeJanitor(),
+            None,
+            FakeAudioProbe(),
+            task_store.session_factory,
+            lambda: storage,
+            lambda: archive_org,
+            n_workers,
+            auto_stages=auto_stages,
+        )
+
+    def process_request(self, req):
+        with self.lock:
+            if req.file in self.running:
+                self.overlaps.append(req)
+            self.running.add(req.file)
+        try:
+            handler = self.handlers.get(req.request_type.name)
+            if handler:
+                handler(req.file)
+            if (req.request_type, req.file) in self.active:
+                self._finish(req.request_type, req.file)
+        finally:
+            with self.lock:
+                self.running.discard(req.file)
+                self.processed.append((req.request_type, req.file))
+
+
+@pytest.fixture
+def task_store(dbengine):
+    task_store = TaskStore(models.get_session_factory(dbengine), stale_task_secs=60)
+    with task_store.session() as session:
+        session.query(models.Task).delete()
+    return task_store
+
+
+@pytest.fixture
+def services():
+    services = []
+    yield services
+    for service in services:
+        service.shutdown(timeout=5)
+        atexit.unregister(service.shutdown)
+
+
+def state(task_store, key):
+    with task_store.session() as session:
+        return task_store._filter(session.query(models.Task.state), key).scalar()
+
+
+def test_same_file_is_never_processed_concurrently(task_store, services):
+    a_started, a_release = threading.Event(), threading.Event()
+    b_started = threading.Event()
+
+    def preview(file):
+        service._set_task_state(RequestType.PREVIEW, file, TaskState())
+        if file == "a.zip":
+            a_started.set()
+            assert a_release.wait(5)
+        else:
+            b_started.set()
+
+    service = FakeReleaseService(task_store, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    assert a_started.wait(5)
+    service._enqueue(QueuedRequest(RequestType.UPLOAD, "a.zip"))
+    service.request_preview("b.zip")
+
+    # The other worker skips the request for a.zip and takes the one for b.zip
+    assert b_started.wait(5)
+    wait_for(lambda: (RequestType.PREVIEW, "b.zip") in service.processed)
+    assert (RequestType.UPLOAD, "a.zip") not in service.processed
+    assert state(task_store, (RequestType.UPLOAD, "a.zip")) == QUEUED
+
+    a_release.set()
+    wait_for(lambda: len(service.processed) == 3)
+    assert service.processed.index((RequestType.PREVIEW, "a.zip")) < service.processed.index(
+        (RequestType.UPLOAD, "a.zip")
+    )
+    assert service.overlaps == []
+
+
+def test_idle_workers_block(task_store, services):
+    service = FakeReleaseService(task_store, n_workers=2)
+    services.append(service)
+    wait_for(lambda: len(service.cond._waiters) == 2)
+
+    claims = []
+    claim = task_store.claim
+    task_store.claim = lambda *args, **kw: claims.append(1) or claim(*args, **kw)
+    time.sleep(0.2)
+    # Workers that spin would try to claim over and over
+    assert claims == []
+
+    service.request_preview("a.zip")
+    wait_for(lambda: service.processed == [(RequestType.PREVIEW, "a.zip")])
+    assert len(claims) <= 2 * len(service.threads)
+
+
+def test_shutdown_joins_workers_and_leaves_queued_requests(task_store, services):
+    started, release = threading.Event(), threading.Event()
+
+    def preview(file):
+        started.set()
+        release.wait(5)
+
+    service = FakeReleaseService(task_store, n_workers=1, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    assert started.wait(5)
+    service.request_preview("b.zip")
+
+    threading.Timer(0.1, release.set).start()
+    service.shutdown(timeout=5)
+
+    assert not any(thread.is_alive() for thread in service.threads)
+    # The request being processed was finished, the queued one wasn't started
+    assert service.processed == [(RequestType.PREVIEW, "a.zip")]
+    assert state(task_store, (RequestType.PREVIEW, "b.zip")) == QUEUED
+    assert service._next_request() is None
+
+
+def test_task_fails_when_processing_raises(task_store, services):
+    def preview(file):
+        service._set_task_state(RequestType.PREVIEW, file, TaskState())
+        raise ValueError("boom")
+
+    service = FakeReleaseService(task_store, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    wait_for(lambda: service.processed and not service.busy_files)
+
+    task_state = service.task_state[RequestType.PREVIEW, "a.zip"]
+    assert task_state.success is False
+    assert str(task_state.exception) == "ValueError: boom"
+    assert service.active == {}
+    # The worker carries on
+    service.request_preview("b.zip")
+    wait_for(lambda: len(service.processed) == 2)
+
+
+def test_task_fails_when_processing_raises_before_setting_state(task_store, services):
+    def preview(file):
+        raise ValueError("early")
+
+    service = FakeReleaseService(task_store, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    wait_for(lambda: service.processed and not service.busy_files)
+
+    assert state(task_store, (RequestType.PREVIEW, "a.zip")) != RUNNING
+    assert service.task_state[RequestType.PREVIEW, "a.zip"].success is False
+
+
+def test_finished_task_is_not_failed_afterwards(task_store, services):
+    def preview(file):
+        service._set_task_state(RequestType.PREVIEW, file, TaskState())
+        service._finish(RequestType.PREVIEW, file)
+        raise ValueError("after finishing")
+
+    service = FakeReleaseService(task_store, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    wait_for(lambda: service.processed and not service.busy_files)
+
+    task_state = service.task_state[RequestType.PREVIEW, "a.zip"]
+    assert task_state.success is True
+    assert task_state.exception is None
+
+
+def test_worker_stops_when_task_is_taken_for_stale(task_store, services):
+    started, requeued = threading.Event(), threading.Event()
+    steps = []
+
+    def preview(file):
+        service._set_task_state(RequestType.PREVIEW, file, TaskState())
+        started.set()
+        assert requeued.wait(5)
+        steps.append("before")
+        service._task(RequestType.PREVIEW, file).data["step"] = 1
+        service._save(RequestType.PREVIEW, file)
+        steps.append("after")
+
+    service = FakeReleaseService(task_store, n_workers=1, PREVIEW=preview)
+    services.append(service)
+    service.request_preview("a.zip")
+    assert started.wait(5)
+
+    key = (RequestType.PREVIEW, "a.zip")
+    with task_store.session() as session:
+        task_store._filter(session.query(models.Task), key).update(
+            {"updated_at": datetime.utcnow() - timedelta(seconds=120)}
+        )
+    assert task_store.requeue_stale() == 1
+    # Another worker has taken it over
+    other = task_store.claim()
+    assert other.file == "a.zip"
+    requeued.set()
+    wait_for(lambda: service.processed and not service.busy_files)
+
+    assert steps == ["before"]
+    assert service.active == {} and service.claims == {}
+    assert state(task_store, key) == RUNNING
+    assert task_store[key].data == {}
+    assert task_store.save(key, TaskState(success=True), other.claim_token)
+
+
+def test_preview_without_catalog_number_fails(task_store, services, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0)
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.PREVIEW, "foo.zip"))
+    req = service._next_request()
+    service._set_task_state(RequestType.PREVIEW, "foo.zip", TaskState())
+
+    local_dir = tmp_path / "foo"
+    service.process_local_dir("foo.zip", Artifact("v1", str(tmp_path / "foo.zip"), str(local_dir)))
+
+    task_state = service.task_state[RequestType.PREVIEW, "foo.zip"]
+    assert req.file == "foo.zip"
+    assert task_state.success is False
+    assert "No catalog number in 'foo.zip'" in str(task_state.exception)
+
+
+@pytest.fixture
+def upload_storage(monkeypatch):
+    storage = FakeUploadStorage()
+    monkeypatch.setattr("pyramidprj.retry.time.sleep", lambda secs: None)
+    return storage
+
+
+def start_upload(service, tmp_path, n_files=3):
+    """Claim an `UPLOAD` request for a release with `n_files` audio files, extracted to `tmp_path / "foo"`.
+    Return the release zip's artifact.
+    """
+    local_dir = tmp_path / "foo"
+    local_dir.mkdir(exist_ok=True)
+    for name in [f"{i:02}.mp3" for i in range(1, n_files + 1)] + ["cover.jpg"]:
+        (local_dir / name).write_bytes(name.encode())
+    data = {
+        "release_dir": "foo",
+        "local_files": [str(local_dir / f"{i:02}.mp3") for i in range(1, n_files + 1)],
+        "player_files": [{"file": f"{i:02}.mp3"} for i in range(1, n_files + 1)],
+    }
+    service._enqueue(QueuedRequest(RequestType.UPLOAD, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.UPLOAD, "foo.zip", TaskState(data=data))
+    return Artifact("v1", str(tmp_path / "foo.zip"), str(local_dir))
+
+
+def test_player_files_are_uploaded_concurrently(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    artifact = start_upload(service, tmp_path, n_files=5)
+    upload_storage.rendezvous = threading.Barrier(2, timeout=5)
+
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is True
+    assert sorted(remote for _, remote in upload_storage.uploads) == [
+        "Releases/foo/01.mp3", "Releases/foo/02.mp3", "Releases/foo/03.mp3", "Releases/foo/04.mp3",
+        "Releases/foo/05.mp3", "Releases/foo/cover.jpg",
+    ]
+    assert 1 < upload_storage.max_running <= service.upload_executor._max_workers
+    uploads = task_state.data["completed_uploads"]
+    assert [u["state"] for u in uploads] == [SUCCEEDED] * 6
+    assert all(u["bytes"] == u["size"] == 6 for u in uploads if u["to"].endswith(".mp3"))
+
+
+def test_transient_upload_error_is_retried(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    artifact = start_upload(service, tmp_path)
+    upload_storage.errors["Releases/foo/02.mp3"] = [api_exceptions.ServiceUnavailable("busy")] * 2
+
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is True
+    attempts = {u["to"]: u["attempts"] for u in task_state.data["completed_uploads"]}
+    assert attempts["Releases/foo/02.mp3"] == 3
+    assert attempts["Releases/foo/01.mp3"] == 1
+
+
+def test_failed_upload_fails_task_with_its_error(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    artifact = start_upload(service, tmp_path)
+    # Not transient, so not retried
+    upload_storage.errors["Releases/foo/02.mp3"] = [api_exceptions.Forbidden("denied")]
+
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is False
+    assert "denied" in str(task_state.exception)
+    uploads = {u["to"]: u for u in task_state.data["completed_uploads"]}
+    assert uploads["Releases/foo/02.mp3"]["state"] == FAILED
+    assert uploads["Releases/foo/02.mp3"]["attempts"] == 1
+    assert "denied" in uploads["Releases/foo/02.mp3"]["error"]
+    # The other files are uploaded all the same
+    assert uploads["Releases/foo/01.mp3"]["state"] == SUCCEEDED
+    assert uploads["Releases/foo/cover.jpg"]["state"] == SUCCEEDED
+
+
+def test_cancelled_upload_skips_remaining_files(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    service.upload_executor = ThreadPoolExecutor(1)
+    artifact = start_upload(service, tmp_path)
+    # Cancelled while the first file is being uploaded
+    upload_storage.rendezvous = SimpleNamespace(wait=lambda: service.cancel(RequestType.UPLOAD, "foo.zip"))
+
+    service.upload_player_files("foo.zip", artifact)
+    service.upload_executor.shutdown()
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is False
+    assert task_state.cancelled
+    assert upload_storage.uploads == [(str(tmp_path / "foo" / "01.mp3"), "Releases/foo/01.mp3")]
+    assert [u["state"] for u in task_state.data["completed_uploads"]] == [SUCCEEDED] + [CANCELLED] * 3
+
+
+def test_reupload_skips_succeeded_files(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    artifact = start_upload(service, tmp_path)
+    upload_storage.errors["Releases/foo/02.mp3"] = [api_exceptions.Forbidden("denied")]
+    service.upload_player_files("foo.zip", artifact)
+    completed_uploads = service.task_state[RequestType.UPLOAD, "foo.zip"].data["completed_uploads"]
+    upload_storage.uploads.clear()
+    # Like the worker does once done with the request
+    service.busy_files.discard("foo.zip")
+
+    # Uploading the same preview again, like `request_upload` does after a failure
+    start_upload(service, tmp_path)
+    service._task(RequestType.UPLOAD, "foo.zip").data["completed_uploads"] = completed_uploads
+    service.upload_player_files("foo.zip", artifact)
+
+    assert service.task_state[RequestType.UPLOAD, "foo.zip"].success is True
+    assert upload_storage.uploads == [(os.path.join(artifact.local_dir, "02.mp3"), "Releases/foo/02.mp3")]
+
+
+def test_unchanged_files_are_not_uploaded_again(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    artifact = start_upload(service, tmp_path)
+    service.upload_player_files("foo.zip", artifact)
+    service.busy_files.discard("foo.zip")
+    upload_storage.uploads.clear()
+
+    # A new preview of the release, with one track fixed
+    start_upload(service, tmp_path)
+    (tmp_path / "foo" / "02.mp3").write_bytes(b"fixed")
+    service._task(RequestType.UPLOAD, "foo.zip").data["manifest"] = compute_manifest(
+        (os.path.join(artifact.local_dir, name), name) for name in ["01.mp3", "02.mp3", "03.mp3", "cover.jpg"]
+    )
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is True
+    assert upload_storage.uploads == [(os.path.join(artifact.local_dir, "02.mp3"), "Releases/foo/02.mp3")]
+    uploads = {u["to"]: u for u in task_state.data["completed_uploads"]}
+    assert all(u["state"] == SUCCEEDED for u in uploads.values())
+    assert uploads["Releases/foo/01.mp3"]["unchanged"] is True
+    assert "unchanged" not in uploads["Releases/foo/02.mp3"]
+
+
+def test_interrupted_large_upload_is_resumed(task_store, services, tmp_path):
+    storage = FakeStorageClient(str(tmp_path / "bucket"))
+    service = FakeReleaseService(task_store, n_workers=0, storage=storage)
+    services.append(service)
+    service.upload_chunk_size = CHUNK_GRANULARITY
+    service.upload_max_attempts = 1
+    data = os.urandom(3 * CHUNK_GRANULARITY + 1000)
+    artifact = start_upload(service, tmp_path, n_files=1)
+    (tmp_path / "foo" / "01.mp3").write_bytes(data)
+    storage.fail_after_chunks = 2
+
+    service.upload_player_files("foo.zip", artifact)
+    completed_uploads = service.task_state[RequestType.UPLOAD, "foo.zip"].data["completed_uploads"]
+    assert completed_uploads[0]["state"] == FAILED
+    assert completed_uploads[0]["bytes"] == completed_uploads[0]["session"]["offset"] == 2 * CHUNK_GRANULARITY
+    service.busy_files.discard("foo.zip")
+
+    # Uploading the same preview again continues from the last committed chunk
+    storage.fail_after_chunks = None
+    storage.chunks = 0
+    start_upload(service, tmp_path, n_files=1)
+    (tmp_path / "foo" / "01.mp3").write_bytes(data)
+    service._task(RequestType.UPLOAD, "foo.zip").data["completed_uploads"] = completed_uploads
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is True
+    assert storage.chunks == 2
+    assert storage.download_bytes("Releases/foo/01.mp3") == data
+    assert "session" not in task_state.data["completed_uploads"][0]
+
+
+
+def test_zip_members_are_streamed_to_storage(task_store, services, tmp_path):
+    storage = FakeStorageClient(str(tmp_path / "bucket"))
+    service = FakeReleaseService(task_store, n_workers=0, storage=storage)
+    services.append(service)
+    service.upload_chunk_size = CHUNK_GRANULARITY
+    start_upload(service, tmp_path)
+    # One member is larger than a chunk, so it is uploaded through a resumable session
+    members = {"01.mp3": os.urandom(2 * CHUNK_GRANULARITY + 1000), "02.mp3": b"two", "03.mp3": b"three"}
+    members["cover.jpg"] = b"jpg"
+    with zipfile.ZipFile(tmp_path / "foo.zip", "w", zipfile.ZIP_DEFLATED) as f:
+        for name, data in members.items():
+            f.writestr(name, data)
+    artifact = Artifact("v1", str(tmp_path / "foo.zip"), str(tmp_path / "streamed" / "foo"), extracted=False)
+    service._task(RequestType.UPLOAD, "foo.zip").data["local_files"] = [
+        os.path.join(artifact.local_dir, name) for name in ["01.mp3", "02.mp3", "03.mp3"]
+    ]
+
+    service.upload_player_files("foo.zip", artifact)
+
+    task_state = service.task_state[RequestType.UPLOAD, "foo.zip"]
+    assert task_state.success is True, task_state.exception
+    for name, data in members.items():
+        assert storage.download_bytes(f"Releases/foo/{name}") == data
+    assert [u["size"] for u in task_state.data["completed_uploads"]] == [len(d) for d in members.values()]
+    assert not os.path.exists(artifact.local_dir)
+
+
+class FailingAudioProbe:
+    """Probes the files on one thread, and fails on `02.mp3`."""
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def probe(self, path, open_file=None, key=None):
+        if os.path.basename(path) == "02.mp3":
+            raise ValueError("Can't read 02.mp3")
+        return {"tags": {"TALB": "Album", "TPE1": "Artist", "TIT2": "Title"}, "length": 61.0}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def test_staging_stops_when_a_probe_fails(task_store, services, upload_storage, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, storage=upload_storage)
+    services.append(service)
+    service.pipeline = True
+    service.audio_probe = FailingAudioProbe()
+    local_dir = tmp_path / "foo-(20k001)-2026"
+    local_dir.mkdir()
+    for name in ["01.mp3", "02.mp3", "03.mp3", "04.mp3", "cover.jpg"]:
+        (local_dir / name).write_bytes(name.encode())
+    service._enqueue(QueuedRequest(RequestType.PREVIEW, "foo-(20k001)-2026.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.PREVIEW, "foo-(20k001)-2026.zip", TaskState())
+    # Staging uploads are still running when the probe fails
+    staging_done = threading.Event()
+    threading.Timer(0.2, staging_done.set).start()
+    upload_storage.rendezvous = staging_done
+
+    service.process_local_dir(
+        "foo-(20k001)-2026.zip", Artifact("v1", str(tmp_path / "foo-(20k001)-2026.zip"), str(local_dir))
+    )
+
+    task_state = service.task_state[RequestType.PREVIEW, "foo-(20k001)-2026.zip"]
+    assert "Can't read 02.mp3" in str(task_state.exception)
+    # The stagings that had started are done, and nothing is staged afterwards
+    assert upload_storage.running == 0
+    staged = sorted(os.path.basename(remote) for _, remote in upload_storage.uploads)
+    assert staged == ["01.mp3", "cover.jpg"]
+    time.sleep(0.1)
+    assert len(upload_storage.uploads) == 2
+
+class FakeArchiveOrgClient:
+    def __init__(self, connections):
+        self.connections = connections
+        self.uploads = []
+
+    def upload_release(self, release, local_dir, on_progress=None, check_cancelled=None):
+        # No connection is held during the upload, and the detached release has its page loaded
+        assert self.connections() == 0
+        self.uploads.append((release.release_dir, release.release_page.content, local_dir))
+        on_progress([{"file": "01.mp3", "state": SUCCEEDED, "size": 3, "attempts": 1}])
+        return "20k999"
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def connections(dbengine):
+    """Number of database connections checked out of the pool during the test."""
+    counts = {"checkout": 0, "checkin": 0}
+
+    def listener(name):
+        def count(*args):
+            counts[name] += 1
+        return count
+
+    listeners = {name: listener(name) for name in counts}
+    for name, fn in listeners.items():
+        event.listen(dbengine, name, fn)
+    yield lambda: counts["checkout"] - counts["checkin"]
+    for name, fn in listeners.items():
+        event.remove(dbengine, name, fn)
+
+
+@pytest.fixture
+def release_id(dbengine, monkeypatch):
+    """Id of a committed release, with its page."""
+    monkeypatch.setattr(release_service, "settings", {"static_base": "https://static.example.com"})
+    monkeypatch.setattr(release_service, "get_page_cache", lambda: PageCache(1024))
+    monkeypatch.setattr(release_service, "purge", lambda *keys: None)
+    session_factory = models.get_session_factory(dbengine)
+    with session_factory.begin() as session:
+        release = models.Release(release_dir="release_service/foo", file="foo.zip", release_data={"relname": "Foo"})
+        release.release_page = models.ReleasePage(content="<p>foo</p>")
+        session.add(release)
+        session.flush()
+        sync_public_release_page(session, release, release_service.settings)
+        release_id = release.id
+    yield release_id
+    with session_factory.begin() as session:
+        session.query(models.PublicReleasePage).filter(
+            models.PublicReleasePage.release_dir == "release_service/foo"
+        ).delete()
+        release = session.get(models.Release, release_id)
+        session.delete(release.release_page)
+        session.delete(release)
+
+
+def test_upload_to_ia_uses_shared_client_and_short_sessions(task_store, services, connections, release_id, tmp_path):
+    archive_org = FakeArchiveOrgClient(connections)
+    service = FakeReleaseService(task_store, n_workers=0, archive_org=archive_org)
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.IA_UPLOAD, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.IA_UPLOAD, "foo.zip", TaskState())
+
+    service.upload_to_ia("foo.zip", str(tmp_path))
+
+    task_state = service.task_state[RequestType.IA_UPLOAD, "foo.zip"]
+    assert task_state.success is True, task_state.exception
+    assert task_state.data == {
+        "identifier": "20k999",
+        "release_id": release_id,
+        "release_dir": "release_service/foo",
+        "ia_uploads": [{"file": "01.mp3", "state": SUCCEEDED, "size": 3, "attempts": 1}],
+    }
+    assert archive_org.uploads == [("release_service/foo", "<p>foo</p>", str(tmp_path))]
+    assert connections() == 0
+    with service.session() as session:
+        assert session.get(models.Release, release_id).release_data["archive"] == "https://archive.org/details/20k999"
+        page = session.get(models.PublicReleasePage, "release_service/foo")
+        assert page.release_data["archive"] == "https://archive.org/details/20k999"
+
+
+def test_session_is_rolled_back_and_closed_on_error(task_store, services, connections, release_id):
+    service = FakeReleaseService(task_store, n_workers=0)
+    services.append(service)
+
+    with pytest.raises(ValueError):
+        with service.session() as session:
+            session.get(models.Release, release_id).release_data = {"relname": "Changed"}
+            session.flush()
+            raise ValueError()
+    assert connections() == 0
+    with service.session() as session:
+        assert session.get(models.Release, release_id).release_data == {"relname": "Foo"}
+
+
+def test_release_page_is_warmed_up_after_ia_upload(task_store, services, connections, release_id, tmp_path):
+    service = FakeReleaseService(task_store, n_workers=0, archive_org=FakeArchiveOrgClient(connections))
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.IA_UPLOAD, "foo.zip", data={"zip_version": "v1"}))
+    service._next_request()
+    service._set_task_state(RequestType.IA_UPLOAD, "foo.zip", TaskState(data={"zip_version": "v1"}))
+
+    service.upload_to_ia("foo.zip", str(tmp_path))
+    service.busy_files.discard("foo.zip")
+
+    req = service._next_request()
+    assert req.request_type == RequestType.WARM_UP
+    assert req.data == StageArtifacts("release_service/foo", release_id, "v1").to_data()
+
+
+def test_failed_ia_upload_queues_no_stages(task_store, services, connections, release_id, tmp_path):
+    archive_org = FakeArchiveOrgClient(connections)
+    archive_org.upload_release = lambda *args, **kw: 1 / 0
+    service = FakeReleaseService(task_store, n_workers=0, archive_org=archive_org)
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.IA_UPLOAD, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.IA_UPLOAD, "foo.zip", TaskState())
+
+    service.upload_to_ia("foo.zip", str(tmp_path))
+
+    assert service.task_state[RequestType.IA_UPLOAD, "foo.zip"].success is False
+    assert task_store.claim() is None
+
+
+@pytest.mark.parametrize("auto_stages, expected", [
+    (DEFAULT_AUTO_STAGES, [RequestType.WARM_UP, RequestType.IA_UPLOAD]),
+    ((RequestType.WARM_UP,), [RequestType.WARM_UP]),
+    ((), []),
+])
+def test_stages_after_commit_are_the_enabled_ones(task_store, services, auto_stages, expected):
+    service = FakeReleaseService(task_store, n_workers=0, auto_stages=auto_stages)
+    services.append(service)
+    artifacts = StageArtifacts("release_service/foo", release_id=1, zip_version="v1", local_dir="/tmp/foo")
+
+    service.queue_next_stages(COMMIT, "foo.zip", artifacts)
+
+    with task_store.session() as session:
+        tasks = session.query(models.Task).filter(models.Task.state == QUEUED).order_by(models.Task.id).all()
+        assert [RequestType(task.request_type) for task in tasks] == expected
+        assert all(StageArtifacts.from_data(task.payload) == artifacts for task in tasks)
+
+
+def test_stage_artifacts_ignore_other_task_data():
+    data = {"release_dir": "release_service/foo", "release_id": 1, "completed_uploads": [], "staged": []}
+    assert StageArtifacts.from_data(data) == StageArtifacts("release_service/foo", release_id=1)
+    assert StageArtifacts.from_data(data).to_data()["player_files"] is None
+
+
+def test_warm_up_renders_the_release(task_store, services):
+    warmed = []
+    service = FakeReleaseService(task_store, n_workers=0)
+    service.warm_up_release = lambda release_dir: warmed.append(release_dir) or 2
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.WARM_UP, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.WARM_UP, "foo.zip", TaskState(data={"release_dir": "release_service/foo"}))
+
+    service.warm_up("foo.zip")
+
+    task_state = service.task_state[RequestType.WARM_UP, "foo.zip"]
+    assert task_state.success is True, task_state.exception
+    assert task_state.data["n_pages"] == 2
+    assert warmed == ["release_service/foo"]
+
+
+def test_failed_warm_up_fails_task(task_store, services):
+    service = FakeReleaseService(task_store, n_workers=0)
+    service.warm_up_release = lambda release_dir: 1 / 0
+    services.append(service)
+    service._enqueue(QueuedRequest(RequestType.WARM_UP, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.WARM_UP, "foo.zip", TaskState(data={"release_dir": "release_service/foo"}))
+
+    service.warm_up("foo.zip")
+
+    task_state = service.task_state[RequestType.WARM_UP, "foo.zip"]
+    assert task_state.success is False
+    assert str(task_state.exception).startswith("ZeroDivisionError")
+
+
+@pytest.mark.parametrize("commit", [True, False])
+def test_stages_are_queued_once_the_commit_succeeds(task_store, services, monkeypatch, commit):
+    service = FakeReleaseService(task_store, n_workers=0)
+    services.append(service)
+    monkeypatch.setattr(release_service, "get_release_service", lambda: service)
+
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    queue_stages_on_commit(testing.DummyRequest(tm=tm), "foo.zip", StageArtifacts("release_service/foo", 1))
+    # Not before the commit
+    assert task_store.claim() is None
+    if commit:
+        tm.commit()
+    else:
+        tm.abort()
+
+    assert (task_store.claim() is not None) is commit
+
+
+@pytest.mark.parametrize("exception, error", [
+    (None, "still pending"),
+    (ValueError("boom"), "has failed: ValueError: boom"),
+    (TaskCancelled(), "has been cancelled"),
+])
+def test_unfinished_upload_is_not_committed(task_store, services, monkeypatch, exception, error):
+    service = FakeReleaseService(task_store, n_workers=0)
+    services.append(service)
+    monkeypatch.setattr(views, "get_release_service", lambda: service)
+    service._enqueue(QueuedRequest(RequestType.UPLOAD, "foo.zip"))
+    service._next_request()
+    service._set_task_state(RequestType.UPLOAD, "foo.zip", TaskState(data={"release_dir": "release_service/foo"}))
+    if exception is not None:
+        service._finish(RequestType.UPLOAD, "foo.zip", exception)
+
+    with pytest.raises(exc.HTTPBadRequest, match=error):
+        views.commit_release(testing.DummyRequest(post={"file": "foo.zip"}))
+    # Kept, so the upload can be retried and committed
+    assert (RequestType.UPLOAD, "foo.zip") in service.task_state
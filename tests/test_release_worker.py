@@ -0,0 +1,87 @@
+import signal
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pyramidprj import release_service
+from pyramidprj.scripts import release_worker
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+class FakeReleaseService:
+    def __init__(self, n_workers):
+        self.threads = [None] * n_workers
+        self.shutdowns = []
+
+    def shutdown(self, timeout):
+        self.shutdowns.append(timeout)
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    """Runs `release_worker.main` in a thread, against an app configured with `release_service_workers = 0`.
+    The signal handlers are recorded instead of installed.
+    """
+    worker = SimpleNamespace(
+        settings={"release_service_workers": "0"},
+        handlers={},
+        services=[],
+        closed=[],
+    )
+    env = {"registry": SimpleNamespace(settings=worker.settings), "closer": lambda: worker.closed.append(True)}
+
+    def get_release_service():
+        worker.services.append(FakeReleaseService(int(worker.settings["release_service_workers"])))
+        return worker.services[-1]
+
+    monkeypatch.setattr(release_worker, "setup_logging", lambda config_uri: None)
+    monkeypatch.setattr(release_worker, "bootstrap", lambda config_uri: env)
+    monkeypatch.setattr(release_worker.signal, "signal", worker.handlers.__setitem__)
+    monkeypatch.setattr(release_service, "get_release_service", get_release_service)
+
+    def run(*args):
+        thread = threading.Thread(target=release_worker.main, args=(["release_worker", "production.ini", *args],))
+        thread.start()
+        wait_for(lambda: worker.services and signal.SIGTERM in worker.handlers)
+        return thread
+
+    worker.run = run
+    return worker
+
+
+def test_starts_workers_when_app_runs_none(worker):
+    thread = worker.run()
+
+    assert len(worker.services[0].threads) == 1
+    assert thread.is_alive()
+    worker.handlers[signal.SIGTERM](signal.SIGTERM, None)
+    thread.join(5)
+
+
+def test_workers_option(worker):
+    thread = worker.run("--workers", "3")
+
+    assert len(worker.services[0].threads) == 3
+    worker.handlers[signal.SIGINT](signal.SIGINT, None)
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_sigterm_shuts_down_gracefully(worker):
+    thread = worker.run()
+    assert worker.services[0].shutdowns == []
+
+    worker.handlers[signal.SIGTERM](signal.SIGTERM, None)
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert worker.services[0].shutdowns == [release_service.SHUTDOWN_TIMEOUT_SECS]
+    assert worker.closed == [True]
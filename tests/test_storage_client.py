@@ -0,0 +1,159 @@
+import base64
+from contextlib import contextmanager
+import hashlib
+import io
+import os
+import threading
+
+from google.api_core import exceptions as api_exceptions
+import pytest
+
+from pyramidprj import storage_client
+from pyramidprj.fake_storage import SESSIONS_DIRECTORY, FakeStorageClient
+from pyramidprj.storage_client import CHUNK_GRANULARITY, ResumableUploadMixin, get_storage_client
+
+
+SIZE = 3 * CHUNK_GRANULARITY + 1000
+REMOTE = "Releases/a/01.mp3"
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return FakeStorageClient(str(tmp_path / "bucket"))
+
+
+@pytest.fixture
+def data():
+    return os.urandom(SIZE)
+
+
+@pytest.fixture
+def local(tmp_path, data):
+    path = tmp_path / "01.mp3"
+    path.write_bytes(data)
+    return str(path)
+
+
+def md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def sessions(storage):
+    return os.listdir(os.path.join(storage.directory, SESSIONS_DIRECTORY))
+
+
+def test_mixin_is_abstract():
+    with pytest.raises(TypeError):
+        ResumableUploadMixin()
+
+
+def test_upload_resumable(storage, local, data):
+    progress = []
+    metadata = storage.upload_resumable(local, REMOTE, CHUNK_GRANULARITY, on_progress=progress.append)
+
+    assert metadata["size"] == SIZE
+    assert metadata["md5"] == md5(data)
+    assert storage.download_bytes(REMOTE) == data
+    assert [p["offset"] for p in progress] == [0, CHUNK_GRANULARITY, 2 * CHUNK_GRANULARITY, 3 * CHUNK_GRANULARITY, SIZE]
+    assert len({p["uri"] for p in progress}) == 1
+    assert sessions(storage) == []
+
+
+def test_resume_after_failure(storage, local, data):
+    storage.fail_after_chunks = 2
+    progress = []
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        storage.upload_resumable(local, REMOTE, CHUNK_GRANULARITY, on_progress=progress.append)
+    session = progress[-1]
+    assert session["offset"] == 2 * CHUNK_GRANULARITY
+    assert not storage.exists(REMOTE)
+
+    # The session survives a restart, i.e. a new client
+    storage = FakeStorageClient(storage.directory)
+    progress = []
+    metadata = storage.upload_resumable(local, REMOTE, CHUNK_GRANULARITY, session, on_progress=progress.append)
+
+    assert metadata["md5"] == md5(data)
+    assert storage.chunks == 2
+    assert [p["offset"] for p in progress] == [3 * CHUNK_GRANULARITY, SIZE]
+    assert all(p["uri"] == session["uri"] for p in progress)
+    assert sessions(storage) == []
+
+
+def test_partially_committed_chunks_are_sent_again(storage, local, data):
+    storage.commit_partially = True
+    progress = []
+    metadata = storage.upload_resumable(local, REMOTE, 2 * CHUNK_GRANULARITY, on_progress=progress.append)
+
+    assert metadata["md5"] == md5(data)
+    assert [p["offset"] for p in progress] == [0, CHUNK_GRANULARITY, 2 * CHUNK_GRANULARITY, 3 * CHUNK_GRANULARITY, SIZE]
+
+
+def test_expired_or_mismatched_session_is_replaced(storage, local, data):
+    for session in (
+        {"uri": "fake://upload/gone", "size": SIZE, "offset": CHUNK_GRANULARITY},
+        {"uri": storage.create_upload_session(REMOTE, SIZE - 1, None), "size": SIZE - 1, "offset": 0},
+    ):
+        progress = []
+        metadata = storage.upload_resumable(local, REMOTE, CHUNK_GRANULARITY, session, on_progress=progress.append)
+        assert metadata["md5"] == md5(data)
+        assert progress[0]["uri"] != session["uri"]
+        assert progress[0]["offset"] == 0
+
+
+def test_cancelled_upload_can_be_resumed(storage, local, data):
+    class Cancelled(Exception):
+        pass
+
+    progress = []
+
+    def check_cancelled():
+        if len(progress) > 2:
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        storage.upload_resumable(
+            local, REMOTE, CHUNK_GRANULARITY, on_progress=progress.append, check_cancelled=check_cancelled
+        )
+    assert progress[-1]["offset"] == 2 * CHUNK_GRANULARITY
+
+    metadata = storage.upload_resumable(local, REMOTE, CHUNK_GRANULARITY, progress[-1])
+    assert metadata["md5"] == md5(data)
+    assert storage.chunks == 4
+
+
+def test_upload_from_file_object(storage, data):
+    @contextmanager
+    def open_file(name):
+        assert name == "01.mp3"
+        yield io.BytesIO(data)
+
+    metadata = storage.upload_resumable("01.mp3", REMOTE, CHUNK_GRANULARITY, open_file=open_file, size=SIZE)
+    assert metadata["md5"] == md5(data)
+
+
+def test_put_chunk_checks_offset_and_granularity(storage):
+    uri = storage.create_upload_session(REMOTE, SIZE, None)
+    with pytest.raises(api_exceptions.BadRequest):
+        storage.put_chunk(uri, b"x" * CHUNK_GRANULARITY, CHUNK_GRANULARITY, SIZE)
+    with pytest.raises(api_exceptions.BadRequest):
+        storage.put_chunk(uri, b"x" * 1000, 0, SIZE)
+    assert storage.put_chunk(uri, b"", None, SIZE) == (0, None)
+
+
+def test_client_is_created_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        storage_client, "settings", {"storage_backend": "fake", "fake_storage_directory": str(tmp_path)}
+    )
+    get_storage_client.cache_clear()
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(get_storage_client())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(clients) == 8
+    assert all(client is clients[0] for client in clients)
+    assert isinstance(clients[0], FakeStorageClient)
+    get_storage_client.cache_clear()
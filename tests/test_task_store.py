@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from pyramidprj import models
+from pyramidprj.task_store import (
+    CANCELLED,
+    QUEUED,
+    RUNNING,
+    Priority,
+    QueuedRequest,
+    QueueFull,
+    RequestType,
+    TaskState,
+    TaskStore,
+)
+
+
+@pytest.fixture
+def task_store(dbengine):
+    task_store = TaskStore(models.get_session_factory(dbengine), stale_task_secs=60)
+    with task_store.session() as session:
+        session.query(models.Task).delete()
+    return task_store
+
+
+def set_updated_at(task_store, key, updated_at):
+    with task_store.session() as session:
+        task_store._filter(session.query(models.Task), key).update({"updated_at": updated_at})
+
+
+def state(task_store, key):
+    with task_store.session() as session:
+        return task_store._filter(session.query(models.Task.state), key).scalar()
+
+
+def test_claim_in_queue_order(task_store):
+    for file in ("a.zip", "b.zip", "c.zip"):
+        task_store.enqueue(QueuedRequest(RequestType.PREVIEW, file, {"n": file}))
+
+    claimed = [task_store.claim() for _ in range(4)]
+    assert [req and req.file for req in claimed] == ["a.zip", "b.zip", "c.zip", None]
+    assert claimed[0].data == {"n": "a.zip"}
+    assert state(task_store, (RequestType.PREVIEW, "a.zip")) == RUNNING
+
+
+def test_claim_excludes_files_with_running_task(task_store):
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "a.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.UPLOAD, "a.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "b.zip"))
+
+    preview = task_store.claim()
+    assert preview.request_type == RequestType.PREVIEW
+    # The upload of a.zip waits for its preview
+    assert task_store.claim().file == "b.zip"
+    assert task_store.claim() is None
+
+    assert task_store.save((RequestType.PREVIEW, "a.zip"), TaskState(success=True), preview.claim_token)
+    req = task_store.claim()
+    assert (req.request_type, req.file) == (RequestType.UPLOAD, "a.zip")
+
+
+def test_claim_skips_excluded_files(task_store):
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "a.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "b.zip"))
+
+    assert task_store.claim(exclude_files=["a.zip"]).file == "b.zip"
+    assert task_store.claim(exclude_files=["a.zip"]) is None
+
+
+def test_requeue_stale(task_store):
+    for file in ("a.zip", "b.zip"):
+        task_store.enqueue(QueuedRequest(RequestType.PREVIEW, file))
+        task_store.claim()
+    set_updated_at(task_store, (RequestType.PREVIEW, "a.zip"), datetime.utcnow() - timedelta(seconds=120))
+
+    assert task_store.requeue_stale() == 1
+    assert state(task_store, (RequestType.PREVIEW, "a.zip")) == QUEUED
+    assert state(task_store, (RequestType.PREVIEW, "b.zip")) == RUNNING
+    assert task_store.claim().file == "a.zip"
+
+
+def test_heartbeat_keeps_running_task(task_store):
+    key = (RequestType.PREVIEW, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+    task_store.claim()
+    set_updated_at(task_store, key, datetime.utcnow() - timedelta(seconds=120))
+
+    task_store.heartbeat([key])
+    assert task_store.requeue_stale() == 0
+    assert state(task_store, key) == RUNNING
+
+
+def test_save_writes_running_task(task_store):
+    key = (RequestType.PREVIEW, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+    req = task_store.claim()
+
+    assert task_store.save(key, TaskState(data={"step": 1}), req.claim_token)
+    assert task_store[key] == TaskState(data={"step": 1})
+    assert task_store.save(key, TaskState(success=False, exception=ValueError("boom")), req.claim_token)
+    assert task_store[key].success is False
+    assert str(task_store[key].exception) == "ValueError: boom"
+
+    # Finished, so further writes by the worker are dropped
+    assert not task_store.save(key, TaskState(success=True), req.claim_token)
+    assert task_store[key].success is False
+
+
+def test_save_under_lost_claim_is_dropped(task_store):
+    key = (RequestType.PREVIEW, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+    stale = task_store.claim()
+    set_updated_at(task_store, key, datetime.utcnow() - timedelta(seconds=120))
+    task_store.requeue_stale()
+
+    # Queued again
+    assert not task_store.save(key, TaskState(success=True), stale.claim_token)
+    assert state(task_store, key) == QUEUED
+
+    # Running under a new claim
+    req = task_store.claim()
+    assert req.claim_token != stale.claim_token
+    assert not task_store.save(key, TaskState(data={"stale": True}), stale.claim_token)
+    assert task_store[key].data == {}
+    assert task_store.save(key, TaskState(data={"step": 1}), req.claim_token)
+
+    # Deleted
+    with task_store.session() as session:
+        task_store._filter(session.query(models.Task), key).delete()
+    assert not task_store.save(key, TaskState(success=True), req.claim_token)
+
+
+def test_enqueue_skips_duplicate_request(task_store):
+    key = (RequestType.PREVIEW, "a.zip")
+    assert task_store.enqueue(QueuedRequest(*key, {"n": 1}))
+    assert not task_store.enqueue(QueuedRequest(*key, {"n": 2}))
+    req = task_store.claim()
+    assert not task_store.enqueue(QueuedRequest(*key, {"n": 2}))
+
+    # A finished task is replaced
+    task_store.save(key, TaskState(success=True, data={"done": True}), req.claim_token)
+    assert task_store.enqueue(QueuedRequest(*key, {"n": 2}))
+    assert task_store[key].success is None
+    assert task_store[key].data == {}
+    assert task_store.claim().data == {"n": 2}
+
+
+def test_enqueue_raises_when_queue_is_full(task_store):
+    task_store.max_queued = 2
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "a.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "b.zip"))
+
+    with pytest.raises(QueueFull):
+        task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "c.zip"))
+    assert task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "c.zip"), bounded=False)
+
+    # Running tasks don't count
+    task_store.claim()
+    task_store.claim()
+    assert task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "d.zip"))
+
+
+def test_claim_by_priority(task_store):
+    task_store.enqueue(QueuedRequest(RequestType.IA_UPLOAD, "a.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.WARM_UP, "b.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.PREVIEW, "c.zip"))
+    task_store.enqueue(QueuedRequest(RequestType.UPLOAD, "d.zip"))
+
+    stats = task_store.queue_stats()
+    assert list(stats) == [priority.name.lower() for priority in Priority]
+    assert [class_stats["queued"] for class_stats in stats.values()] == [2, 1, 1]
+
+    claimed = [task_store.claim() for _ in range(4)]
+    assert [(req.request_type, req.file) for req in claimed] == [
+        (RequestType.PREVIEW, "c.zip"),
+        (RequestType.UPLOAD, "d.zip"),
+        (RequestType.WARM_UP, "b.zip"),
+        (RequestType.IA_UPLOAD, "a.zip"),
+    ]
+    assert task_store.queue_stats()["interactive"] == {
+        "queued": 0, "running": 2, "oldest_wait_secs": 0.0, "mean_wait_secs": pytest.approx(0, abs=1),
+    }
+
+
+def test_cancel_queued_task(task_store):
+    key = (RequestType.PREVIEW, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+
+    assert task_store.cancel(key) == QUEUED
+    assert task_store[key].cancelled
+    assert task_store[key].success is False
+    assert task_store.claim() is None
+    # A cancelled request can be queued again
+    assert task_store.enqueue(QueuedRequest(*key))
+
+
+def test_cancel_running_task(task_store):
+    key = (RequestType.UPLOAD, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+    req = task_store.claim()
+    assert not task_store.is_cancel_requested(key)
+
+    assert task_store.cancel(key) == RUNNING
+    assert task_store.is_cancel_requested(key)
+    assert state(task_store, key) == RUNNING
+
+    # The worker stops
+    assert task_store.save(key, TaskState(success=False, cancelled=True), req.claim_token)
+    assert state(task_store, key) == CANCELLED
+    assert task_store.cancel(key) == CANCELLED
+    assert task_store.cancel((RequestType.UPLOAD, "b.zip")) is None
+
+
+def test_requeue_stale_cancels_task_being_cancelled(task_store):
+    key = (RequestType.UPLOAD, "a.zip")
+    task_store.enqueue(QueuedRequest(*key))
+    task_store.claim()
+    task_store.cancel(key)
+    set_updated_at(task_store, key, datetime.utcnow() - timedelta(seconds=120))
+
+    assert task_store.requeue_stale() == 0
+    assert state(task_store, key) == CANCELLED
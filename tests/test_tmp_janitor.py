@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from pyramidprj import models
+from pyramidprj.task_store import (
+    FAILED,
+    QUEUED,
+    RUNNING,
+    SUCCEEDED,
+    QueuedRequest,
+    RequestType,
+    TaskState,
+    TaskStore,
+)
+from pyramidprj.tmp_janitor import TmpJanitor, is_done
+
+
+@pytest.mark.parametrize("states, done", [
+    (None, True),
+    ({}, True),
+    ({RequestType.PREVIEW: QUEUED}, False),
+    ({RequestType.PREVIEW: RUNNING}, False),
+    ({RequestType.PREVIEW: SUCCEEDED}, False),
+    ({RequestType.PREVIEW: FAILED}, True),
+    ({RequestType.PREVIEW: SUCCEEDED, RequestType.UPLOAD: SUCCEEDED}, False),
+    ({RequestType.PREVIEW: FAILED, RequestType.UPLOAD: RUNNING}, False),
+    ({RequestType.UPLOAD: SUCCEEDED, RequestType.IA_UPLOAD: RUNNING}, False),
+    ({RequestType.UPLOAD: SUCCEEDED, RequestType.IA_UPLOAD: SUCCEEDED}, True),
+    ({RequestType.UPLOAD: SUCCEEDED, RequestType.IA_UPLOAD: FAILED}, True),
+])
+def test_is_done(states, done):
+    assert is_done(states) == done
+
+
+@pytest.fixture
+def task_store(dbengine):
+    task_store = TaskStore(models.get_session_factory(dbengine))
+    with task_store.session() as session:
+        session.query(models.Task).delete()
+    return task_store
+
+
+def add_task(task_store, request_type, file, success=None):
+    task_store.enqueue(QueuedRequest(request_type, file))
+    if success is not None:
+        req = task_store.claim()
+        task_store.save((request_type, file), TaskState(success=success), req.claim_token)
+
+
+def add_artifact(tmp_directory, file, size, mtime):
+    """Add a downloaded zip of `size` bytes and its (empty) extraction directory."""
+    path = os.path.join(tmp_directory, file)
+    directory = os.path.join(tmp_directory, os.path.splitext(file)[0])
+    os.makedirs(directory)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    for p in (path, directory):
+        os.utime(p, (mtime, mtime))
+
+
+def test_sweep_deletes_finished_releases(task_store, tmp_path):
+    tmp_directory = str(tmp_path)
+    janitor = TmpJanitor(task_store, tmp_directory, max_bytes=10000)
+    add_task(task_store, RequestType.PREVIEW, "running.zip")
+    task_store.claim()
+    add_task(task_store, RequestType.PREVIEW, "failed.zip", success=False)
+    add_task(task_store, RequestType.PREVIEW, "previewed.zip", success=True)
+    add_task(task_store, RequestType.IA_UPLOAD, "archived.zip", success=True)
+    for i, file in enumerate(("running.zip", "failed.zip", "previewed.zip", "archived.zip", "gone.zip")):
+        add_artifact(tmp_directory, file, 100, 1000 + i)
+
+    assert janitor.usage()["releases"] == 5
+    assert sorted(janitor.sweep()) == ["archived.zip", "failed.zip", "gone.zip"]
+    assert sorted(janitor.artifacts()) == ["previewed.zip", "running.zip"]
+    assert sorted(os.listdir(tmp_directory)) == ["previewed", "previewed.zip", "running", "running.zip"]
+    assert janitor.usage()["bytes"] == 200
+
+
+def test_sweep_enforces_budget(task_store, tmp_path):
+    tmp_directory = str(tmp_path)
+    janitor = TmpJanitor(task_store, tmp_directory, max_bytes=350)
+    for i, file in enumerate(("old.zip", "running.zip", "busy.zip", "newer.zip", "newest.zip")):
+        add_task(task_store, RequestType.PREVIEW, file, success=True)
+        add_artifact(tmp_directory, file, 100, 1000 + i)
+    add_task(task_store, RequestType.UPLOAD, "running.zip")
+
+    # Least recently used first, skipping releases that are being processed
+    assert janitor.sweep(busy_files=["busy.zip"]) == ["old.zip", "newer.zip"]
+    assert sorted(janitor.artifacts()) == ["busy.zip", "newest.zip", "running.zip"]
+    assert janitor.usage()["bytes"] == 300
+
+    # Over budget as long as they are
+    janitor.max_bytes = 150
+    assert janitor.sweep(busy_files=["busy.zip", "newest.zip"]) == []
+    assert janitor.sweep() == ["busy.zip", "newest.zip"]
+    assert sorted(janitor.artifacts()) == ["running.zip"]